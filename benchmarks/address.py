@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Measure the cost of `Email.send_to` and `Email.format()` on a message with
+many recipients with and without cached address formatting::
+
+    python -m benchmarks.address
+
+"""
+import timeit
+
+from flask_mailer.mail import Address
+from flask_mailer.mail import Email
+from flask_mailer.mail import sanitize_address
+
+
+def make_email(recipients=500):
+    return Email(subject=u'Привет',
+                 text='Hello, there',
+                 from_addr=(u'Álice', 'alice@example.com'),
+                 to=[(u'Usér %d' % i, 'user%d@example.com' % i)
+                     for i in range(recipients)],
+                 cc=['cc%d@example.com' % i for i in range(recipients // 10)])
+
+
+def send(mail):
+    mail.send_to
+    mail.format()
+
+
+def uncached(self):
+    return sanitize_address(self.address)
+
+
+def measure(number=20):
+    mail = make_email()
+    return min(timeit.repeat(lambda: send(mail), number=number, repeat=3)) / number
+
+
+def main():
+    cached = measure()
+
+    # Python 2 version of __str__ calls __unicode__ under the hood.
+    name = '__unicode__' if hasattr(Address, '__unicode__') else '__str__'
+    original = Address.__dict__[name]
+    setattr(Address, name, uncached)
+    try:
+        baseline = measure()
+    finally:
+        setattr(Address, name, original)
+
+    print('send_to + format(), 550 recipients')
+    print('  uncached: %8.3f ms' % (baseline * 1000))
+    print('  cached:   %8.3f ms' % (cached * 1000))
+    print('  speedup:  %8.2fx' % (baseline / cached))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Load generator which pushes messages through `send_email` into the local
+SMTP sink and reports throughput, latency and the number of connections::
+
+    python -m benchmarks.load -n 2000 -c 16 --latency 0.005
+    python -m benchmarks.load -n 2000 -c 16 --config MAILER_POOL_SIZE=16
+    python -m benchmarks.load -n 2000 -c 4 --processes --failure-rate 0.01
+    python -m benchmarks.load -n 100 -c 1 --recipients 200 --rtt 0.02 \\
+        --extension PIPELINING --extension CHUNKING
+
+Any extension option could be passed via `--config`, so pooling, queueing
+and other modes are compared against the same sink.
+"""
+import argparse
+import json
+import multiprocessing
+import threading
+import time
+
+from flask import Flask
+
+from flask_mailer import Mailer
+from flask_mailer import send_email
+
+from benchmarks.sink import SMTPServer
+
+
+def create_app(config):
+    app = Flask(__name__)
+    app.config.update(config)
+    Mailer(app)
+    return app
+
+
+def send(app, count, size, recipients=1):
+    """Send *count* messages, returns the list of latencies and the number
+    of errors.
+    """
+    text = 'x' * size
+    to = ['to%d@example.com' % i for i in range(recipients)]
+    latencies, errors = [], 0
+    with app.app_context():
+        for _ in range(count):
+            start = time.time()
+            try:
+                send_email('Load test', text, to,
+                           fail_quiet=False)
+            except Exception:
+                errors += 1
+            latencies.append(time.time() - start)
+    return latencies, errors
+
+
+def run_process(args):
+    config, count, size, recipients = args
+    return send(create_app(config), count, size, recipients)
+
+
+def run_threads(config, counts, size, recipients):
+    app = create_app(config)
+    results = [None] * len(counts)
+
+    def target(i):
+        results[i] = send(app, counts[i], size, recipients)
+
+    threads = [threading.Thread(target=target, args=(i,))
+               for i in range(len(counts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    backend = app.extensions['mailer']
+    if hasattr(backend, 'shutdown'):
+        backend.shutdown()
+    return results
+
+
+def percentile(values, fraction):
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def parse_config(options):
+    config = {}
+    for option in options:
+        name, _, value = option.partition('=')
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        config[name] = value
+    return config
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Push messages through the mailer into local SMTP sink.')
+    parser.add_argument('-n', '--messages', type=int, default=1000)
+    parser.add_argument('-c', '--concurrency', type=int, default=8,
+                        help='number of threads or processes')
+    parser.add_argument('--processes', action='store_true',
+                        help='use processes instead of threads')
+    parser.add_argument('--size', type=int, default=1024,
+                        help='message body size in bytes')
+    parser.add_argument('--recipients', type=int, default=1,
+                        help='number of recipients per message')
+    parser.add_argument('--rtt', type=float, default=0,
+                        help='simulated network round trip, seconds')
+    parser.add_argument('--extension', action='append', default=[],
+                        dest='extensions', metavar='NAME',
+                        help='ESMTP extension advertised by sink, '
+                             'e.g. PIPELINING or CHUNKING')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='sink delay before accept message, seconds')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='fraction of messages rejected by sink')
+    parser.add_argument('--config', action='append', default=[],
+                        metavar='MAILER_OPTION=VALUE')
+    args = parser.parse_args(argv)
+
+    sink = SMTPServer(extensions=args.extensions, latency=args.latency,
+                      failure_rate=args.failure_rate, rtt=args.rtt,
+                      keep=False).start()
+    config = dict(MAILER_HOST=sink.host, MAILER_PORT=sink.port)
+    config.update(parse_config(args.config))
+
+    counts = [args.messages // args.concurrency] * args.concurrency
+    counts[0] += args.messages % args.concurrency
+
+    start = time.time()
+    if args.processes:
+        pool = multiprocessing.Pool(args.concurrency)
+        results = pool.map(run_process,
+                           [(config, count, args.size, args.recipients)
+                            for count in counts])
+        pool.close()
+    else:
+        results = run_threads(config, counts, args.size, args.recipients)
+    elapsed = time.time() - start
+    sink.stop()
+
+    latencies = sorted(x for result in results for x in result[0])
+    errors = sum(result[1] for result in results)
+    print('messages:     %d sent, %d received, %d errors' % (
+        len(latencies), sink.received_count, errors))
+    print('throughput:   %.1f msg/s' % (len(latencies) / elapsed))
+    print('latency p50:  %.2f ms' % (percentile(latencies, 0.5) * 1000))
+    print('latency p99:  %.2f ms' % (percentile(latencies, 0.99) * 1000))
+    print('connections:  %d (max %d at once)' % (sink.connections,
+                                                 sink.max_active))
+
+
+if __name__ == '__main__':
+    main()
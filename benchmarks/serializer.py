@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Compare the throughput and peak memory of serializing a message for SMTP
+DATA command via `MIMEText` round trip, via direct bytes serializer and
+chunk by chunk as the SMTP backend streams large messages::
+
+    python -m benchmarks.serializer
+
+Peak memory is measured with `tracemalloc` on Python 3 only.
+"""
+import smtplib
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from flask_mailer.mail import Email
+
+
+def make_email(size):
+    line = 'All work and no play makes Jack a dull boy.\n'
+    return Email(subject='Hello, there',
+                 text=line * (size // len(line)),
+                 from_addr='alice@example.com',
+                 to='bob@example.com')
+
+
+def mimetext(mail):
+    """Serialize the message the way it is done via `smtplib.sendmail`."""
+    data = smtplib.quotedata('\r\n'.join(
+        mail.to_message().as_string().splitlines()))
+    if not isinstance(data, bytes):
+        data = data.encode('ascii')
+    return data
+
+
+def direct(mail):
+    return mail.serialize(escape=True)
+
+
+def streamed(mail):
+    """Serialize the message in chunks, each chunk is written to the socket
+    and dropped.
+    """
+    size = 0
+    for chunk in mail.iter_wire():
+        size += len(chunk)
+    return size
+
+
+def peak_memory(func, mail):
+    if tracemalloc is None:
+        return float('nan')
+    tracemalloc.start()
+    try:
+        func(mail)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    print('%-8s %-10s %12s %12s' % ('body', 'serializer', 'MB/s', 'peak MB'))
+    for size in (1 << 10, 1 << 20, 10 << 20, 25 << 20):
+        mail = make_email(size)
+        number = max(1, (1 << 22) // size)
+        for func in (mimetext, direct, streamed):
+            elapsed = min(timeit.repeat(lambda: func(mail),
+                                        number=number, repeat=3)) / number
+            print('%-8s %-10s %12.1f %12.1f' % (
+                '%dK' % (size >> 10), func.__name__,
+                size / elapsed / (1 << 20),
+                peak_memory(func, mail) / (1 << 20)))
+
+
+if __name__ == '__main__':
+    main()
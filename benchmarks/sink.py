@@ -0,0 +1,303 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+In-process SMTP server stand-in used by the load generator and the tests.
+"""
+import random
+import select
+import socket
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+class SMTPHandler(socketserver.BaseRequestHandler):
+    """Handles a single SMTP session.
+
+    Commands sent without waiting for the reply to the previous one are
+    rejected with 554 unless PIPELINING extension is advertised, non-ascii
+    addresses are rejected with 553 unless SMTPUTF8 parameter is given, as
+    strict servers do.
+    """
+
+    #: Commands which could be followed by another one without waiting for
+    #: the reply when PIPELINING is advertised.
+    pipelined_commands = ('RSET', 'MAIL', 'RCPT', 'BDAT')
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.smtp = self.server.smtp
+        self.buffer = bytearray()
+        self.reset()
+
+    def reset(self):
+        self.sender = None
+        self.params = []
+        self.recipients = []
+        self.chunks = []
+
+    def reply(self, *lines):
+        """Write multiline reply, the last line should be finished
+        with space instead of dash.
+        """
+        code, last = lines[0][:3], len(lines) - 1
+        data = []
+        for i, line in enumerate(lines):
+            sep = ' ' if i == last else '-'
+            text = line[4:] if line[:3] == code else line
+            data.append('%s%s%s\r\n' % (code, sep, text))
+        self.request.sendall(''.join(data).encode('utf-8'))
+
+    def fill(self):
+        """Wait for more data from the client."""
+        if not self.buffer:
+            self.smtp.waited()
+        data = self.request.recv(65536)
+        self.buffer.extend(data)
+        return bool(data)
+
+    def pending(self):
+        """Check that the client has sent more data without waiting for
+        the reply.
+        """
+        return bool(self.buffer or
+                    select.select([self.request], [], [], 0)[0])
+
+    def read(self, size):
+        """Read exactly *size* bytes."""
+        while len(self.buffer) < size:
+            if not self.fill():
+                break
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read_until(self, marker):
+        """Read data up to and including the *marker*."""
+        start = 0
+        while True:
+            index = self.buffer.find(marker, start)
+            if index >= 0:
+                return self.read(index + len(marker))
+            start = max(0, len(self.buffer) - len(marker) + 1)
+            if not self.fill():
+                return self.read(len(self.buffer))
+
+    def handle(self):
+        self.smtp.connected()
+        try:
+            self.session()
+        finally:
+            self.smtp.disconnected()
+
+    def session(self):
+        self.reply('220 localhost ESMTP')
+        while True:
+            line = self.read_until(b'\n')
+            if not line:
+                break
+            command, _, arg = line.decode('utf-8').strip().partition(' ')
+            command = command.upper()
+            self.smtp.commands.append(command)
+            if command != 'BDAT' and self.pending():
+                if not self.pipelining or \
+                   command not in self.pipelined_commands:
+                    self.reply('554 SMTP synchronization error')
+                    break
+                self.smtp.pipelined += 1
+            handler = getattr(self, 'smtp_%s' % command.lower(), None)
+            if handler is None:
+                self.reply('500 Command unrecognized')
+            elif handler(arg) is False:
+                break
+
+    def has_extn(self, name):
+        return name in self.smtp.extensions
+
+    @property
+    def pipelining(self):
+        return self.has_extn('PIPELINING')
+
+    def smtp_ehlo(self, arg):
+        self.reset()
+        lines = ['250 localhost'] + list(self.smtp.extensions)
+        if self.smtp.auth:
+            lines.append('AUTH PLAIN LOGIN')
+        self.reply(*lines)
+
+    def smtp_helo(self, arg):
+        self.reset()
+        self.reply('250 localhost')
+
+    def smtp_auth(self, arg):
+        self.reply('235 Authentication successful')
+
+    def smtp_noop(self, arg):
+        self.reply('250 OK')
+
+    def smtp_rset(self, arg):
+        self.reset()
+        self.reply('250 OK')
+
+    def international(self, address):
+        """Check that non-ascii address is allowed in the transaction."""
+        return 'SMTPUTF8' in self.params or \
+            all(ord(x) < 128 for x in address)
+
+    def smtp_mail(self, arg):
+        if self.smtp.fail():
+            self.reply(self.smtp.failure_reply)
+            # The server closes the session after 421 reply.
+            return not self.smtp.failure_reply.startswith('421')
+        sender, _, params = arg.split(':', 1)[1].strip().partition(' ')
+        self.params = params.upper().split()
+        self.smtp.params.append(self.params)
+        if not self.international(sender):
+            return self.reply('553 Mailbox name not allowed')
+        self.sender = sender
+        self.reply('250 OK')
+
+    def smtp_rcpt(self, arg):
+        if self.sender is None:
+            return self.reply('503 Need MAIL command')
+        recipient = arg.split(':', 1)[1].strip()
+        if not self.international(recipient):
+            return self.reply('553 Mailbox name not allowed')
+        if recipient.strip('<>') in self.smtp.refuse:
+            return self.reply('550 No such user')
+        if len(self.recipients) == self.smtp.max_recipients > 0:
+            return self.reply('452 Too many recipients')
+        self.recipients.append(recipient)
+        self.reply('250 OK')
+
+    def smtp_data(self, arg):
+        if not self.recipients:
+            return self.reply('554 No valid recipients')
+        self.reply('354 End data with <CR><LF>.<CR><LF>')
+        while len(self.buffer) < 3:
+            if not self.fill():
+                return False
+        if self.buffer.startswith(b'.\r\n'):
+            self.read(3)
+            data = b''
+        else:
+            data = self.read_until(b'\r\n.\r\n')[:-3]
+        if data.startswith(b'.'):
+            data = data[1:]
+        self.complete(data.replace(b'\r\n..', b'\r\n.'))
+
+    def smtp_bdat(self, arg):
+        if not self.has_extn('CHUNKING'):
+            return self.reply('500 Command unrecognized')
+        size, _, last = arg.partition(' ')
+        self.chunks.append(self.read(int(size)))
+        if not self.recipients:
+            self.reset()
+            return self.reply('554 No valid recipients')
+        if last.upper() != 'LAST':
+            return self.reply('250 %s octets received' % size)
+        self.complete(b''.join(self.chunks))
+
+    def complete(self, data):
+        time.sleep(self.smtp.latency)
+        self.smtp.received(self.sender, self.recipients, data)
+        self.reset()
+        self.reply('250 OK')
+
+    def smtp_quit(self, arg):
+        self.reply('221 Bye')
+        return False
+
+
+class SMTPServer(object):
+    """In-process SMTP server stand-in. Keeps all received messages in
+    *messages* list as `(sender, recipients, data)` tuples and parameters
+    of each MAIL command in *params* list.
+
+    :param extensions: The list of ESMTP extensions to advertise.
+    :param auth: Advertise AUTH extension and accept any credentials.
+    :param refuse: The list of recipients to reject.
+    :param latency: The number of seconds to wait before accept message data.
+    :param failures: The number of transactions to reject.
+    :param failure_rate: The fraction of transactions to reject randomly.
+    :param failure_reply: The reply to reject transactions with, the session
+                          is closed after 421 reply.
+    :param keep: Keep received messages, otherwise only count them.
+    :param rtt: The number of seconds to wait each time the server waits for
+                the client, simulates the network round trip.
+    :param max_recipients: The number of recipients per transaction to
+                           accept, `0` means no limit.
+    """
+
+    def __init__(self, extensions=(), auth=False, refuse=(), latency=0,
+                 failures=0, failure_rate=0, keep=True, rtt=0,
+                 max_recipients=0, failure_reply='451 Try again later'):
+        self.extensions = extensions
+        self.auth = auth
+        self.refuse = refuse
+        self.latency = latency
+        self.failures = failures
+        self.failure_rate = failure_rate
+        self.failure_reply = failure_reply
+        self.keep = keep
+        self.rtt = rtt
+        self.max_recipients = max_recipients
+        self.received_count = 0
+        self.round_trips = 0
+        self.pipelined = 0
+        self.messages = []
+        self.commands = []
+        self.params = []
+        self.connections = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0),
+                                                      SMTPHandler)
+        self.server.daemon_threads = True
+        self.server.smtp = self
+        self.host, self.port = self.server.server_address
+
+    def connected(self):
+        with self.lock:
+            self.connections += 1
+            self.active += 1
+            self.max_active = max(self.active, self.max_active)
+
+    def disconnected(self):
+        with self.lock:
+            self.active -= 1
+
+    def waited(self):
+        with self.lock:
+            self.round_trips += 1
+        time.sleep(self.rtt)
+
+    def fail(self):
+        with self.lock:
+            if self.failures > 0:
+                self.failures -= 1
+                return True
+            return random.random() < self.failure_rate
+
+    def received(self, sender, recipients, data):
+        with self.lock:
+            self.received_count += 1
+            if self.keep:
+                self.messages.append((sender, list(recipients), data))
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
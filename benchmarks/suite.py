@@ -0,0 +1,221 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks for the message building hot path::
+
+    python -m benchmarks.suite -o results.json
+    python -m benchmarks.suite --compare results.json
+
+Compare mode runs the suite again and exits with non-zero status when any
+benchmark is slower than in the saved results by more than the threshold.
+"""
+import argparse
+import json
+import platform
+import sys
+import timeit
+
+from flask_mailer.compat import text_type
+from flask_mailer.mail import Addresses
+from flask_mailer.mail import Email
+from flask_mailer.mail import SafeHeader
+from flask_mailer.mail import sanitize_address
+from flask_mailer.merge import Template
+
+
+TEXT = {
+    'ascii': u'All work and no play makes Jack a dull boy.\n',
+    'nonascii': u'Тише едешь — дальше будешь. Ça va, Jürgen?\n',
+}
+
+NAMES = {
+    'ascii': (u'Alice', u'alice%d@example.com'),
+    'nonascii': (u'Álice', u'álice%d@exämple.com'),
+}
+
+SIZES = {'1K': 1 << 10, '1M': 1 << 20, '10M': 10 << 20}
+
+
+def make_email(charset='ascii', size=1 << 10, recipients=1):
+    line = TEXT[charset]
+    name, addr = NAMES[charset]
+    return Email(subject=line.strip(),
+                 text=line * (size // len(line.encode('utf-8'))),
+                 from_addr=(name, addr % 0),
+                 to=[(name, addr % i) for i in range(recipients)])
+
+
+# Each benchmark sets up the data and returns the callable to measure.
+
+def bench_sanitize_address(charset):
+    name, addr = NAMES[charset]
+    return lambda: sanitize_address((name, addr % 0))
+
+
+def bench_safe_header(charset):
+    header = SafeHeader(TEXT[charset].strip())
+    return lambda: text_type(header)
+
+
+def bench_addresses_extend(charset):
+    name, addr = NAMES[charset]
+    values = [(name, addr % i) for i in range(10000)]
+    return lambda: Addresses().extend(values)
+
+
+def bench_addresses_from_iterable(charset):
+    name, addr = NAMES[charset]
+    values = [addr % i for i in range(10000)]
+    return lambda: Addresses.from_iterable(values)
+
+
+def bench_addresses_extend_format(charset):
+    name, addr = NAMES[charset]
+    values = [addr % i for i in range(10000)]
+    return lambda: text_type(Addresses(values))
+
+
+def bench_addresses_from_iterable_format(charset):
+    name, addr = NAMES[charset]
+    values = [addr % i for i in range(10000)]
+    return lambda: text_type(Addresses.from_iterable(values))
+
+
+def bench_send_to(charset):
+    mail = make_email(charset, recipients=500)
+    return lambda: mail.send_to
+
+
+def bench_to_message(charset):
+    return make_email(charset).to_message
+
+
+def bench_format(charset, size):
+    mail = make_email(charset, SIZES[size])
+
+    def run():
+        # Drop the cache to measure the serialization itself.
+        mail._fingerprint = None
+        return mail.format()
+    return run
+
+
+def bench_email_per_recipient(charset):
+    template = make_email(charset)
+    name, addr = NAMES[charset]
+
+    def run():
+        # What a campaign without mail merge does for each recipient.
+        return Email(template.subject.value, template.text, (name, addr % 1),
+                     from_addr=template.from_addr).as_bytes()
+    return run
+
+
+def bench_template_render(charset):
+    template = Template(make_email(charset))
+    name, addr = NAMES[charset]
+    return lambda: template.render((name, addr % 1)).as_bytes()
+
+
+BENCHMARKS = []
+for charset in sorted(TEXT):
+    BENCHMARKS.extend([
+        ('sanitize_address/%s' % charset, bench_sanitize_address, (charset,)),
+        ('SafeHeader.__str__/%s' % charset, bench_safe_header, (charset,)),
+        ('Addresses.extend/10k/%s' % charset, bench_addresses_extend,
+         (charset,)),
+        ('Addresses.from_iterable/10k/%s' % charset,
+         bench_addresses_from_iterable, (charset,)),
+        ('Addresses.extend+str/10k/%s' % charset,
+         bench_addresses_extend_format, (charset,)),
+        ('Addresses.from_iterable+str/10k/%s' % charset,
+         bench_addresses_from_iterable_format, (charset,)),
+        ('Email.send_to/500/%s' % charset, bench_send_to, (charset,)),
+        ('Email.to_message/1K/%s' % charset, bench_to_message, (charset,)),
+        ('Email.as_bytes/recipient/%s' % charset, bench_email_per_recipient,
+         (charset,)),
+        ('Template.render/recipient/%s' % charset, bench_template_render,
+         (charset,)),
+    ])
+    for size in sorted(SIZES, key=SIZES.get):
+        BENCHMARKS.append(('Email.format/%s/%s' % (size, charset),
+                           bench_format, (charset, size)))
+
+
+def measure(func, min_time=0.2, repeat=5):
+    """Returns per-call timings of the function in seconds."""
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= min_time / repeat or number >= 1 << 20:
+            break
+        number *= 10
+    timings = sorted(t / number for t in
+                     timeit.repeat(func, number=number, repeat=repeat))
+    return {
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'number': number,
+    }
+
+
+def run(pattern=None):
+    results = {}
+    for name, setup, args in BENCHMARKS:
+        if pattern and pattern not in name:
+            continue
+        results[name] = measure(setup(*args))
+        print('%-36s %12.2f us' % (name, results[name]['min'] * 1e6))
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'benchmarks': results,
+    }
+
+
+def compare(baseline, current, threshold):
+    """Print the comparison table, returns the list of regressions."""
+    regressions = []
+    print('\n%-36s %12s %12s %8s' % ('benchmark', 'baseline', 'current',
+                                      'ratio'))
+    for name, result in sorted(current['benchmarks'].items()):
+        if name not in baseline['benchmarks']:
+            continue
+        before = baseline['benchmarks'][name]['min']
+        ratio = result['min'] / before
+        mark = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            mark = ' slower'
+        elif ratio < 1 - threshold:
+            mark = ' faster'
+        print('%-36s %9.2f us %9.2f us %7.2fx%s' % (
+            name, before * 1e6, result['min'] * 1e6, ratio, mark))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run microbenchmarks for the message building hot path.')
+    parser.add_argument('-o', '--output', help='save results to JSON file')
+    parser.add_argument('-c', '--compare', help='compare with saved results')
+    parser.add_argument('-k', dest='pattern', help='run matching benchmarks')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed slowdown, default is 0.1 (10%%)')
+    args = parser.parse_args(argv)
+
+    results = run(args.pattern)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,7 +2,12 @@
 # -*- coding: utf-8 -*-
 from flask import current_app
 
+from flask_mailer import outbox
 from flask_mailer.mail import Email
+from flask_mailer.mail import encoding_cache
+from flask_mailer.backends.queued import QueuedMailer
+from flask_mailer.backends.relays import RelayMailer
+from flask_mailer.backends.throttled import ThrottledMailer
 from flask_mailer.util import key
 from flask_mailer.util import get_config
 from flask_mailer.util import import_path
@@ -12,10 +17,23 @@ __version__ = '0.4.0'
 __all__ = ('send_email', 'Mailer', 'Email')
 
 
-def send_email(subject, text, to, fail_quiet=True):
-    """Send an email."""
+def send_email(subject, text, to, fail_quiet=True, wait=True, defer=None):
+    """Send an email.
+
+    Pass `wait=False` to return a :class:`Future` instead of waiting until
+    the email is sent.
+
+    Pass `defer=True` to send the email after the response to current
+    request is returned, `MAILER_DEFER` option sets the default.
+    """
     mailer = _get_mailer()
     mail = Email(subject, text, to)
+    if defer is None:
+        defer = current_app.config.get(key('defer'), False)
+    if defer:
+        return outbox.defer(mailer, mail)
+    if not wait:
+        return mailer.submit(mail)
     if fail_quiet:
         return mailer.send_quiet(mail)
     return mailer.send(mail)
@@ -60,6 +78,9 @@ class Mailer(object):
         if config[key('testing')]:
             config[key('backend')] = 'flask_mailer.backends.dummy.DummyMailer'
 
+        if key('encoding_cache_size') in config:
+            encoding_cache.resize(config[key('encoding_cache_size')])
+
         state = self.init_backend(config)
 
         # Register extension themselves for backwards compatibility.
@@ -76,7 +97,15 @@ class Mailer(object):
         if backend_class is None:
             raise RuntimeError("Invalid backend: '%s'" % backend_path)
 
-        return backend_class(**options)
+        if options.get('hosts') and not options.get('testing'):
+            backend = RelayMailer(backend_class, **options)
+        else:
+            backend = backend_class(**options)
+        if options.get('rate_limit') or options.get('domain_rate_limits'):
+            backend = ThrottledMailer(backend, **options)
+        if options.get('queue_workers'):
+            backend = QueuedMailer(backend, **options)
+        return backend
 
     def __getattr__(self, name):
         return getattr(_get_mailer(self), name, None)
@@ -0,0 +1,283 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Asyncio SMTP backend. Requires Python 3.7 or newer, STARTTLS requires
+Python 3.11 or newer.
+"""
+import asyncio
+import base64
+import ssl
+from smtplib import SMTPDataError
+from smtplib import SMTPException
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPResponseException
+from smtplib import SMTPSenderRefused
+from smtplib import SMTPServerDisconnected
+from smtplib import quoteaddr
+import warnings
+
+from flask_mailer.backends.base import Mailer
+from flask_mailer.backends.smtp import transport
+from flask_mailer.compat import text_type
+from flask_mailer.retry import is_disconnected
+
+
+class AsyncSMTP(object):
+    """A single SMTP session over asyncio streams.
+
+    :param reader: The stream reader connected to SMTP server.
+    :param writer: The stream writer connected to SMTP server.
+    :param timeout: The number of seconds to wait for server reply.
+    """
+
+    def __init__(self, reader, writer, timeout=None):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.features = {}
+        self.used = False
+
+    async def write(self, data):
+        """Write the data and wait until the transport buffer is flushed
+        enough, so large messages are not buffered in memory as a whole.
+        """
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+    async def getreply(self):
+        """Read the server reply, returns code and message."""
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                raise SMTPServerDisconnected('Connection unexpectedly closed')
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                break
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        return code, b'\n'.join(lines)
+
+    async def docmd(self, command, arg=''):
+        """Send the command and wait for reply."""
+        line = '%s %s' % (command, arg) if arg else command
+        await self.write(line.encode('utf-8') + b'\r\n')
+        return await self.getreply()
+
+    async def ehlo(self, name='localhost'):
+        code, message = await self.docmd('EHLO', name)
+        if code != 250:
+            code, message = await self.docmd('HELO', name)
+            if code != 250:
+                raise SMTPResponseException(code, message)
+            return
+        self.features = {}
+        for line in message.decode('utf-8').splitlines()[1:]:
+            feature, _, params = line.partition(' ')
+            self.features[feature.lower()] = params
+
+    def has_extn(self, name):
+        return name.lower() in self.features
+
+    async def starttls(self, server_hostname=None):
+        code, message = await self.docmd('STARTTLS')
+        if code != 220:
+            raise SMTPResponseException(code, message)
+        await self.writer.start_tls(ssl.create_default_context(),
+                                    server_hostname=server_hostname)
+
+    async def login(self, username, password):
+        token = ('\0%s\0%s' % (username, password)).encode('utf-8')
+        code, message = await self.docmd(
+            'AUTH', 'PLAIN ' + base64.b64encode(token).decode('ascii'))
+        if code != 235:
+            raise SMTPResponseException(code, message)
+
+    async def rset(self):
+        return await self.docmd('RSET')
+
+    async def sendmail(self, from_addr, to_addrs, data, params=()):
+        """Send the message data prepared for DATA command (see
+        :meth:`~flask_mailer.mail.Email.to_wire`). Returns a dictionary of
+        refused recipients as :meth:`smtplib.SMTP.sendmail` does.
+        """
+        self.used = True
+        code, message = await self.docmd('MAIL', ' '.join(
+            ['FROM:%s' % quoteaddr(from_addr)] + list(params)))
+        if code != 250:
+            raise SMTPSenderRefused(code, message, from_addr)
+
+        refused = {}
+        for addr in to_addrs:
+            code, message = await self.docmd('RCPT', 'TO:%s' % quoteaddr(addr))
+            if code not in (250, 251):
+                refused[addr] = (code, message)
+        if len(refused) == len(to_addrs):
+            raise SMTPRecipientsRefused(refused)
+
+        code, message = await self.docmd('DATA')
+        if code != 354:
+            raise SMTPDataError(code, message)
+        await self.write(data)
+        await self.write(b'.\r\n' if data.endswith(b'\r\n') else
+                         b'\r\n.\r\n')
+        code, message = await self.getreply()
+        if code != 250:
+            raise SMTPDataError(code, message)
+        return refused
+
+    async def quit(self):
+        try:
+            await self.docmd('QUIT')
+        except (SMTPException, OSError, asyncio.TimeoutError):
+            pass
+        await self.close()
+
+    async def close(self):
+        """Close the connection and wait until the socket is closed."""
+        self.writer.close()
+        try:
+            await asyncio.wait_for(self.writer.wait_closed(), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            pass
+
+
+class AsyncSMTPMailer(Mailer):
+    """Asyncio SMTP email backend.
+
+    Sends messages without blocking the thread and runs up to *concurrency*
+    SMTP sessions at once on one event loop::
+
+        await mailer.send_async(mail)
+        results = await mailer.send_many_async(mails)
+
+    Blocking :meth:`send` and :meth:`send_many` run a new event loop and
+    could not be called from a running one.
+    """
+    def __init__(self,
+                 host='localhost',
+                 port=25,
+                 username=None,
+                 password=None,
+                 default_sender=None,
+                 use_tls=False,
+                 concurrency=10,
+                 timeout=30,
+                 **kwargs):
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.username = username
+        self.password = password
+        self.default_sender = default_sender
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+        credentials = (username, password)
+        if any(credentials) and not all(credentials):
+            warnings.warn(
+                'Invalid credentials. Please setup both username and '
+                'password or neither.'
+            )
+            self.username = self.password = None
+
+    async def connect(self):
+        """Opens a new session to SMTP server."""
+        session = None
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+            session = AsyncSMTP(reader, writer, self.timeout)
+            code, message = await session.getreply()
+            if code != 220:
+                raise SMTPResponseException(code, message)
+            await session.ehlo()
+            if self.use_tls:
+                await session.starttls(server_hostname=self.host)
+                await session.ehlo()
+            if self.username and self.password:
+                await session.login(self.username, self.password)
+        except (SMTPException, OSError, asyncio.TimeoutError) as e:
+            if session is not None:
+                await session.close()
+            raise RuntimeError(str(e))
+        return session
+
+    async def deliver(self, session, message):
+        """Send the message over the open session. Returns a dictionary
+        of refused recipients.
+        """
+        message.from_addr = message.from_addr or self.default_sender
+        options, params = transport(message, session.has_extn)
+        if options.get('smtputf8'):
+            from_addr, recipients = message.envelope(smtputf8=True)
+        else:
+            from_addr = text_type(message.from_addr)
+            recipients = [text_type(x) for x in message.send_to]
+        return await session.sendmail(from_addr, recipients,
+                                      message.to_wire(**options), params)
+
+    async def send_async(self, message):
+        """Send the message."""
+        session = await self.connect()
+        try:
+            return await self.deliver(session, message)
+        finally:
+            await session.quit()
+
+    async def send_many_async(self, messages):
+        """Send the messages over up to *concurrency* sessions at once.
+
+        Returns a list with one entry per message: `None` if the message was
+        sent or the exception raised while sending it.
+
+        :param messages: The iterable of messages to send.
+        """
+        results = {}
+        queue = enumerate(messages)
+        await asyncio.gather(*[self._drain(queue, results)
+                               for _ in range(self.concurrency)])
+        return [results[i] for i in range(len(results))]
+
+    async def _drain(self, queue, results):
+        """Deliver messages from the shared queue over one session."""
+        session = None
+        try:
+            for index, message in queue:
+                try:
+                    if session is None:
+                        session = await self.connect()
+                    elif session.used:
+                        await session.rset()
+                    refused = await self.deliver(session, message)
+                    if refused:
+                        raise SMTPRecipientsRefused(refused)
+                except Exception as e:
+                    results[index] = e
+                    if session is not None and (
+                            is_disconnected(e) or
+                            isinstance(e, asyncio.TimeoutError)):
+                        await session.close()
+                        session = None
+                else:
+                    results[index] = None
+        finally:
+            if session is not None:
+                await session.quit()
+
+    def send(self, message):
+        """Send the message."""
+        return asyncio.run(self.send_async(message))
+
+    def send_quiet(self, message):
+        """Send the message but swallow exceptions."""
+        try:
+            return self.send(message)
+        except Exception:
+            return
+
+    def send_many(self, messages):
+        """Send the messages over up to *concurrency* sessions at once."""
+        return asyncio.run(self.send_many_async(messages))
@@ -1,5 +1,6 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+from concurrent.futures import Future
 
 
 class Mailer(object):
@@ -15,3 +16,32 @@ class Mailer(object):
     def send_quiet(self, message):
         """Send the message but swallow exceptions."""
         raise NotImplementedError
+
+    def send_many(self, messages):
+        """Send the messages one by one.
+
+        Returns a list with one entry per message: `None` if the message was
+        sent or the exception raised while sending it.
+
+        :param messages: The iterable of messages to send.
+        """
+        results = []
+        for message in messages:
+            try:
+                self.send(message)
+            except Exception as e:
+                results.append(e)
+            else:
+                results.append(None)
+        return results
+
+    def submit(self, message):
+        """Send the message. Returns a :class:`Future` which is already
+        completed with the result of the send.
+        """
+        future = Future()
+        try:
+            future.set_result(self.send(message))
+        except Exception as e:
+            future.set_exception(e)
+        return future
@@ -18,3 +18,9 @@ class DummyMailer(Mailer):
     def send_quiet(self, message):
         """Actually don't swallow exception."""
         self.send(message)
+
+    def send_many(self, messages):
+        """Sending all messages to the dummy *outbox*."""
+        messages = list(messages)
+        self.outbox.extend(messages)
+        return [None] * len(messages)
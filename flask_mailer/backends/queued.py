@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import atexit
+import threading
+from concurrent.futures import Future
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from flask_mailer.backends.base import Mailer
+
+
+class QueuedMailer(Mailer):
+    """Sends messages in background threads through the wrapped backend.
+
+    Messages are put in a bounded in-memory queue and drained by a pool of
+    worker threads. When the queue is full the *policy* decides what to do:
+
+    - `block` waits for a free slot,
+    - `drop` returns a future failed with :class:`RuntimeError`,
+    - `raise` raises :class:`RuntimeError`.
+
+    :param backend: The backend used to send messages.
+    :param queue_size: The maximum number of messages waiting to be sent.
+    :param queue_workers: The number of worker threads.
+    :param queue_policy: The policy to apply when the queue is full.
+    """
+
+    policies = ('block', 'drop', 'raise')
+
+    def __init__(self,
+                 backend,
+                 queue_size=1000,
+                 queue_workers=4,
+                 queue_policy='block',
+                 **kwargs):
+        if queue_policy not in self.policies:
+            raise ValueError("Invalid queue policy: '%s'" % queue_policy)
+
+        self.backend = backend
+        self.queue = queue.Queue(queue_size)
+        self.workers = queue_workers
+        self.policy = queue_policy
+        self.threads = []
+        self.lock = threading.Lock()
+        self.closed = False
+        atexit.register(self.shutdown)
+
+    def __getattr__(self, name):
+        if name == 'backend':
+            raise AttributeError(name)
+        return getattr(self.backend, name)
+
+    def start(self):
+        """Starts worker threads unless they are already running."""
+        with self.lock:
+            if self.threads:
+                return
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self):
+        """Sends queued messages until receives the stop signal."""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            future, message = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self.backend.send(message))
+                except Exception as e:
+                    future.set_exception(e)
+
+    def submit(self, message):
+        """Queue the message for sending. Returns a :class:`Future`."""
+        if self.closed:
+            raise RuntimeError('Mail queue is shut down')
+        self.start()
+
+        future = Future()
+        # Enqueue under the lock, so the message is never queued after
+        # the stop signals of the workers.
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('Mail queue is shut down')
+            try:
+                self.queue.put((future, message), self.policy == 'block')
+            except queue.Full:
+                if self.policy == 'raise':
+                    raise RuntimeError('Mail queue is full')
+                future.set_exception(RuntimeError('Mail queue is full'))
+        return future
+
+    def send(self, message):
+        """Send the message and wait until it is sent."""
+        return self.submit(message).result()
+
+    def send_quiet(self, message):
+        """Send the message and wait until it is sent, but swallow
+        exceptions. Use :meth:`submit` to not wait.
+        """
+        try:
+            return self.send(message)
+        except Exception:
+            return
+
+    def send_many(self, messages):
+        """Queue the messages and wait until all of them are sent."""
+        futures = [self.submit(message) for message in messages]
+        return [future.exception() for future in futures]
+
+    def shutdown(self, wait=True):
+        """Stop accepting new messages and send already queued ones.
+
+        :param wait: Wait until worker threads finish.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            threads = self.threads
+        for _ in threads:
+            self.queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
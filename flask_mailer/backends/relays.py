@@ -0,0 +1,304 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import itertools
+import threading
+import time
+from smtplib import SMTPRecipientsRefused
+
+from flask_mailer.backends.base import Mailer
+from flask_mailer.compat import string_types
+from flask_mailer.retry import CircuitBreaker
+from flask_mailer.retry import is_transient
+
+
+def undelivered(message, error):
+    """Check that the message failed with transient error was not delivered
+    to any recipient, so it could be sent through another relay.
+    """
+    if error is None or not is_transient(error):
+        return False
+    if isinstance(error, SMTPRecipientsRefused):
+        return len(error.recipients) >= len(message.send_to)
+    return True
+
+
+def parse_relay(value, port=25):
+    """Returns `(host, port, weight)` tuple of relay.
+
+    >>> parse_relay('smtp.example.com:2525')
+    ('smtp.example.com', 2525, 1)
+    >>> parse_relay(('smtp.example.com', 25, 3))
+    ('smtp.example.com', 25, 3)
+    >>> parse_relay({'host': 'smtp.example.com', 'weight': 2})
+    ('smtp.example.com', 25, 2)
+
+    :param value: The relay as `host[:port[:weight]]` string, tuple or
+                  dictionary with `host`, `port` and `weight` keys.
+    :param port: The default port.
+    """
+    if isinstance(value, dict):
+        value = (value['host'], value.get('port', port),
+                 value.get('weight', 1))
+    elif isinstance(value, string_types):
+        value = value.split(':')
+    host, port, weight = (tuple(value) + (port, 1)[len(value) - 1:])[:3]
+    if int(weight) <= 0:
+        raise ValueError("Invalid relay weight: '%s'" % weight)
+    return host, int(port), int(weight)
+
+
+class Relay(object):
+    """The relay server with its own backend and health state.
+
+    :param backend: The backend which sends messages through the relay.
+    :param weight: The relative share of messages sent through the relay.
+    :param breaker: The circuit breaker which ejects failing relay.
+    """
+
+    #: The weight of the last send in the average latency.
+    smoothing = 0.2
+
+    def __init__(self, backend, weight, breaker):
+        self.backend = backend
+        self.weight = weight
+        self.breaker = breaker
+        self.outstanding = 0
+        self.sent = 0
+        self.failed = 0
+        self.latency = 0
+        self.current = 0
+        self.lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self.breaker.name
+
+    def available(self):
+        """Check that the relay could be used. Ejected relay is re-admitted
+        when it passes the health check.
+        """
+        if self.breaker.state == CircuitBreaker.CLOSED:
+            return True
+        if not self.breaker.allow():
+            return False
+        if self.check():
+            self.breaker.success()
+            return True
+        self.breaker.failure()
+        return False
+
+    def check(self):
+        """Check that the relay accepts connections."""
+        check = getattr(self.backend, 'check', None)
+        if check is None:
+            return True
+        try:
+            return check()
+        except Exception:
+            return False
+
+    def done(self, started, error=None):
+        """Record the result of the send. Only transient errors trip the
+        breaker, permanent ones mean the relay answers, but they are not
+        counted in the latency either.
+        """
+        if error is not None:
+            with self.lock:
+                self.failed += 1
+            if is_transient(error):
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            return
+
+        duration = time.time() - started
+        with self.lock:
+            self.sent += 1
+            self.latency += self.smoothing * (duration - self.latency)
+        self.breaker.success()
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'weight': self.weight,
+            'state': self.breaker.state,
+            'outstanding': self.outstanding,
+            'sent': self.sent,
+            'failed': self.failed,
+            'latency': self.latency,
+        }
+
+
+class RelayMailer(Mailer):
+    """Spreads messages across several relays.
+
+    Each relay has its own backend instance, created with the same options
+    but its own host and port. A relay is ejected after *breaker_threshold*
+    consecutive connection errors or 4xx replies, and re-admitted when it
+    passes the health check in *breaker_timeout* seconds. The message is
+    sent through another relay if the chosen one fails.
+
+    Relays are chosen with the *balance* strategy:
+
+    - `round-robin` takes relays in turn according to their weights,
+    - `least-outstanding` takes the relay with the least number of sends in
+      progress per weight,
+    - `latency` takes the relay with the least average send latency
+      multiplied by sends in progress per weight.
+
+    :param backend_class: The class of relay backends.
+    :param hosts: The list of relays, see :func:`parse_relay`.
+    :param balance: The balance strategy.
+    :param breaker_threshold: The number of consecutive failures to eject
+                              the relay.
+    :param breaker_timeout: The number of seconds to wait before the health
+                            check of ejected relay.
+    """
+
+    strategies = ('round-robin', 'least-outstanding', 'latency')
+
+    #: The number of messages sent through one relay at once by
+    #: :meth:`send_many`.
+    batch_size = 100
+
+    def __init__(self,
+                 backend_class,
+                 hosts,
+                 balance='round-robin',
+                 breaker_threshold=3,
+                 breaker_timeout=30,
+                 **kwargs):
+        if balance not in self.strategies:
+            raise ValueError("Invalid balance strategy: '%s'" % balance)
+        if not hosts:
+            raise ValueError('Setup at least one relay')
+
+        self.balance = balance
+        self.lock = threading.Lock()
+        self.relays = []
+
+        kwargs.pop('host', None)
+        default_port = kwargs.pop('port', 25)
+        for value in hosts:
+            host, port, weight = parse_relay(value, default_port)
+            breaker = CircuitBreaker(breaker_threshold, breaker_timeout,
+                                     name='%s:%s' % (host, port))
+            backend = backend_class(host=host, port=port, **kwargs)
+            self.relays.append(Relay(backend, weight, breaker))
+
+    def choose(self, exclude=()):
+        """Returns the next available relay or `None`."""
+        candidates = [relay for relay in self.relays
+                      if relay not in exclude and relay.available()]
+        if not candidates:
+            return None
+
+        with self.lock:
+            if self.balance == 'round-robin':
+                # Smooth weighted round-robin, as nginx does.
+                for relay in candidates:
+                    relay.current += relay.weight
+                relay = max(candidates, key=lambda x: x.current)
+                relay.current -= sum(x.weight for x in candidates)
+            elif self.balance == 'least-outstanding':
+                relay = min(candidates,
+                            key=lambda x: float(x.outstanding) / x.weight)
+            else:
+                relay = min(candidates,
+                            key=lambda x: x.latency *
+                            (x.outstanding + 1) / x.weight)
+            relay.outstanding += 1
+        return relay
+
+    def call(self, method, *args):
+        """Call the backend method of the chosen relay, fail over to the
+        next one on transient errors.
+        """
+        tried = []
+        error = None
+        while True:
+            relay = self.choose(exclude=tried)
+            if relay is None:
+                if error is not None:
+                    raise error
+                raise RuntimeError('No relays available')
+            tried.append(relay)
+
+            started = time.time()
+            try:
+                result = getattr(relay.backend, method)(*args)
+            except Exception as e:
+                error = e
+                relay.done(started, e)
+                if not is_transient(e):
+                    raise
+            else:
+                relay.done(started)
+                return result
+            finally:
+                with self.lock:
+                    relay.outstanding -= 1
+
+    def send(self, message):
+        """Send the message through one of relays."""
+        return self.call('send', message)
+
+    def send_quiet(self, message):
+        """Send the message but swallow exceptions."""
+        try:
+            return self.send(message)
+        except Exception:
+            return
+
+    def send_many(self, messages):
+        """Send the messages through relays in batches of *batch_size*.
+        Messages are consumed lazily batch by batch.
+
+        Returns a list with one entry per message in order of messages, see
+        :meth:`~flask_mailer.backends.base.Mailer.send_many`. Messages
+        failed with transient errors before they are delivered to any
+        recipient are sent through the next relay, delivered ones are never
+        sent again.
+
+        :param messages: The iterable of messages to send.
+        """
+        results = []
+        messages = iter(messages)
+        while True:
+            batch = list(itertools.islice(messages, self.batch_size))
+            if not batch:
+                return results
+            results.extend(self.send_batch(batch))
+
+    def send_batch(self, batch):
+        """Send the list of messages, fail over undelivered ones to the next
+        relay. Returns the list of results.
+        """
+        results = [RuntimeError('No relays available')] * len(batch)
+        pending = list(range(len(batch)))
+        tried = []
+        while pending:
+            relay = self.choose(exclude=tried)
+            if relay is None:
+                break
+            tried.append(relay)
+
+            started = time.time()
+            try:
+                sent = relay.backend.send_many([batch[i] for i in pending])
+            except Exception as e:
+                sent = [e] * len(pending)
+            finally:
+                with self.lock:
+                    relay.outstanding -= 1
+            for index, result in zip(pending, sent):
+                results[index] = result
+            pending = [i for i in pending
+                       if undelivered(batch[i], results[i])]
+            errors = [results[i] for i in pending]
+            relay.done(started, errors[0] if errors else None)
+        return results
+
+    def stats(self):
+        """Returns the list of per-relay stats."""
+        return [relay.stats() for relay in self.relays]
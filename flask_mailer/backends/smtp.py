@@ -1,16 +1,418 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import socket
+import threading
+import time
+from collections import deque
 from smtplib import SMTP
+from smtplib import SMTPDataError
 from smtplib import SMTPException
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPResponseException
+from smtplib import SMTPSenderRefused
+from smtplib import SMTPServerDisconnected
+from smtplib import quoteaddr
 import warnings
 
 from flask_mailer.backends.base import Mailer
-from flask_mailer.compat import text_type
+from flask_mailer.compat import get_ident, text_type
+from flask_mailer.mail import Chunks
+from flask_mailer.mail import Email
+from flask_mailer.merge import MergedEmail
+from flask_mailer.retry import CircuitBreaker
+from flask_mailer.retry import backoff
+from flask_mailer.retry import is_disconnected
+from flask_mailer.retry import is_transient
+from flask_mailer.signals import has_receivers
+from flask_mailer.signals import message_sent
+from flask_mailer.signals import smtp_stage
+from flask_mailer.signals import timed
+
+
+def close_quietly(connection):
+    """Close the connection to SMTP server and ignore any errors."""
+    try:
+        connection.quit()
+    except (SMTPException, socket.error):
+        # This happens when calling quit() on a TLS connection
+        # sometimes.
+        connection.close()
+
+
+def is_closed(connection, error):
+    """Check that the connection is closed after the error: it is lost, or
+    closed by the client after 421 reply (see :meth:`Connection.abort`).
+    """
+    return is_disconnected(error) or connection.sock is None
+
+
+def is_connected(connection):
+    """Check that the server still answers on the connection."""
+    try:
+        return connection.noop()[0] == 250
+    except (SMTPException, socket.error):
+        return False
+
+
+def chunked(items, size):
+    """Split the list into chunks of at most *size* items.
+
+    >>> chunked([1, 2, 3, 4, 5], 2)
+    [[1, 2], [3, 4], [5]]
+
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def refusals(recipients, error):
+    """Returns a dictionary of refused recipients as :meth:`SMTP.sendmail`
+    does for the failed mail transaction. Recipients are refused with the
+    server reply, or with 421 reply if the connection is lost.
+
+    :param recipients: The recipients of the failed transaction.
+    :param error: The exception raised by the transaction.
+    """
+    error = getattr(error, 'reason', error)
+    if isinstance(error, SMTPRecipientsRefused):
+        return error.recipients
+    if isinstance(error, SMTPResponseException):
+        reply = (error.smtp_code, error.smtp_error)
+    else:
+        reply = (421, text_type(error).encode('utf-8'))
+    return dict((addr, reply) for addr in recipients)
+
+
+def transport(message, has_extn):
+    """Returns the serialization options of the message and the parameters
+    of MAIL command for the server. Messages are sent as 8-bit data only if
+    the server supports 8BITMIME extension, non-ascii addresses and subject
+    are sent as is only if it supports SMTPUTF8 extension. Other than
+    :class:`~flask_mailer.mail.Email` and
+    :class:`~flask_mailer.merge.MergedEmail` messages are sent as they are.
+
+    :param message: The message to send.
+    :param has_extn: The callable which checks that the server supports
+                     the extension.
+    """
+    options, params = {}, []
+    if has_extn('8bitmime'):
+        params.append('BODY=8BITMIME')
+        if has_extn('smtputf8') and getattr(message, 'international', False):
+            options['smtputf8'] = True
+            params.append('SMTPUTF8')
+    else:
+        options['eightbit'] = False
+    if not isinstance(message, (Email, MergedEmail)):
+        options = {}
+    return options, params
+
+
+class Connection(SMTP):
+    """SMTP connection which sends already serialized messages."""
+
+    #: The ident of the thread which has released the connection to pool.
+    owner = None
+
+    def connect(self, host='localhost', port=0, *args, **kwargs):
+        result = SMTP.connect(self, host, port, *args, **kwargs)
+        # Commands are small writes each waiting for reply, do not let
+        # Nagle's algorithm delay them.
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return result
+
+    def rcpt_max(self):
+        """Returns the maximum number of recipients per transaction
+        advertised with LIMITS extension or `None`.
+        """
+        for limit in self.esmtp_features.get('limits', '').split():
+            name, _, value = limit.partition('=')
+            if name.upper() == 'RCPTMAX' and value.isdigit():
+                return int(value)
+        return None
+
+    def abort(self, code):
+        """Abort the failed transaction."""
+        if code == 421:
+            self.close()
+            return
+        try:
+            self.rset()
+        except SMTPServerDisconnected:
+            pass
+
+    def data_wire(self, data):
+        """Send message data which is already prepared for DATA command
+        (see :meth:`~flask_mailer.mail.Email.to_wire`), as bytes or as the
+        iterable of chunks (see :meth:`~flask_mailer.mail.Email.iter_wire`).
+        """
+        code, resp = self.docmd('data')
+        if code != 354:
+            raise SMTPDataError(code, resp)
+        last = b''
+        for chunk in [data] if isinstance(data, bytes) else data:
+            if chunk:
+                self.send(chunk)
+                last = chunk
+        self.send(b'.\r\n' if last.endswith(b'\r\n') else b'\r\n.\r\n')
+        return self.getreply()
+
+    def command(self, command, arg):
+        """Send the command as :meth:`docmd` does, but encode it in UTF-8
+        as SMTPUTF8 extension allows.
+        """
+        self.send(('%s %s\r\n' % (command, arg)).encode('utf-8'))
+        return self.getreply()
+
+    def pipeline(self, commands):
+        """Send the commands at once and read their replies. Requires
+        PIPELINING extension.
+
+        :param commands: The list of `(command, argument)` pairs.
+        """
+        self.send(''.join('%s %s\r\n' % command
+                          for command in commands).encode('utf-8'))
+        return [self.getreply() for _ in commands]
+
+    def envelope(self, from_addr, to_addrs, params=()):
+        """Start the mail transaction with MAIL and RCPT commands. Returns
+        a dictionary of refused recipients.
+
+        Commands are sent in one batch if the server supports PIPELINING.
+
+        :param from_addr: The sender address.
+        :param to_addrs: The list of recipient addresses.
+        :param params: The list of MAIL command parameters.
+        """
+        self.ehlo_or_helo_if_needed()
+        mail = ('mail', ' '.join(['FROM:%s' % quoteaddr(from_addr)] +
+                                 list(params)))
+        rcpts = [('rcpt', 'TO:%s' % quoteaddr(addr)) for addr in to_addrs]
+        if self.has_extn('pipelining'):
+            replies = self.pipeline([mail] + rcpts)
+        else:
+            replies = [self.command(*mail)]
+            if replies[0][0] == 250:
+                replies.extend(self.command(*rcpt) for rcpt in rcpts)
+
+        code, resp = replies[0]
+        if code != 250:
+            self.abort(code)
+            raise SMTPSenderRefused(code, resp, from_addr)
+
+        refused = {}
+        for addr, (code, resp) in zip(to_addrs, replies[1:]):
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+        if len(refused) == len(to_addrs):
+            self.abort(code)
+            raise SMTPRecipientsRefused(refused)
+        return refused
+
+    def bdat(self, data, last=True):
+        """Send message data as a single chunk with BDAT command. Requires
+        CHUNKING extension, data is sent as is.
+        """
+        command = 'bdat %d last\r\n' if last else 'bdat %d\r\n'
+        self.send(command % len(data))
+        self.send(data)
+        return self.getreply()
+
+    def bdat_chunks(self, chunks):
+        """Send message data with BDAT command chunk by chunk. Replies are
+        read at once if the server supports PIPELINING. Requires CHUNKING
+        extension.
+        """
+        pipelining = self.has_extn('pipelining')
+        pending = 0
+        reply = (250, b'')
+        for chunk in chunks:
+            if not chunk:
+                continue
+            self.send('bdat %d\r\n' % len(chunk))
+            self.send(chunk)
+            if pipelining:
+                pending += 1
+                continue
+            reply = self.getreply()
+            if reply[0] != 250:
+                return reply
+        for _ in range(pending):
+            code, resp = self.getreply()
+            if code != 250 and reply[0] == 250:
+                reply = (code, resp)
+        if reply[0] != 250:
+            return reply
+        return self.bdat(b'')
+
+    def content(self, data, chunking=False):
+        """Send message data and complete the mail transaction.
+
+        :param data: The message data, prepared for DATA command
+                     (see :meth:`~flask_mailer.mail.Email.to_wire`) or
+                     CRLF-separated bytes if *chunking* is set. Could be
+                     the iterable of chunks to send the message lazily.
+        :param chunking: Send data with BDAT command.
+        """
+        if chunking and not isinstance(data, bytes):
+            code, resp = self.bdat_chunks(data)
+        elif chunking:
+            code, resp = self.bdat(data)
+        else:
+            code, resp = self.data_wire(data)
+        if code != 250:
+            self.abort(code)
+            raise SMTPDataError(code, resp)
+
+    def sendwire(self, from_addr, to_addrs, data):
+        """Send the message as :meth:`sendmail` does, but do not encode and
+        escape message data. Returns a dictionary of refused recipients.
+        """
+        refused = self.envelope(from_addr, to_addrs)
+        self.content(data)
+        return refused
+
+
+class ConnectionPool(object):
+    """Keeps authenticated connections to SMTP server open between sends.
+
+    Each connection is checked with NOOP before reuse, connections idle for
+    more than *timeout* seconds are closed. A thread gets back the
+    connection it has released if it is still idle, so worker threads keep
+    their own sessions across requests.
+
+    No more than *size* connections are open at once, both idle and in use.
+    A thread waits up to *wait* seconds for a connection released by
+    another one, then :class:`RuntimeError` is raised.
+
+    :param connect: The callable which opens a new connection.
+    :param size: The maximum number of connections to keep open.
+    :param timeout: The number of seconds to keep idle connection open.
+    :param wait: The number of seconds to wait for a free connection.
+    """
+
+    def __init__(self, connect, size=1, timeout=60, wait=30):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.wait = wait
+        self.idle = deque()
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        #: The number of connections in use.
+        self.active = 0
+
+    def __len__(self):
+        return len(self.idle)
+
+    def evict(self):
+        """Close connections idle for too long."""
+        expired = []
+        with self.lock:
+            deadline = time.time() - self.timeout
+            while self.idle and self.idle[0][0] < deadline:
+                expired.append(self.idle.popleft()[1])
+        for connection in expired:
+            close_quietly(connection)
+
+    def take(self):
+        """Take the idle connection released by current thread or the most
+        recently released one.
+        """
+        owner = get_ident()
+        with self.lock:
+            if not self.idle:
+                return None
+            for index in range(len(self.idle) - 1, -1, -1):
+                if self.idle[index][1].owner == owner:
+                    break
+            else:
+                index = len(self.idle) - 1
+            entry = self.idle[index]
+            del self.idle[index]
+        return entry[1]
+
+    def reserve(self, wait):
+        """Wait until less than *size* connections are in use and take
+        the place of one more.
+        """
+        deadline = time.time() + wait
+        with self.available:
+            while self.active >= self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RuntimeError('No free connections in the pool '
+                                       'after %s seconds' % wait)
+                self.available.wait(remaining)
+            self.active += 1
+
+    def acquire(self, wait=None):
+        """Returns idle connection or opens a new one.
+
+        :param wait: The number of seconds to wait for a free connection,
+                     defaults to *wait* of the pool.
+        """
+        self.reserve(self.wait if wait is None else wait)
+        try:
+            self.evict()
+            while True:
+                connection = self.take()
+                if connection is None:
+                    break
+                if is_connected(connection):
+                    return connection
+                connection.close()
+            return self.connect()
+        except Exception:
+            self.discard(None)
+            raise
+
+    def release(self, connection):
+        """Returns connection to the pool or closes it when pool is full."""
+        connection.owner = get_ident()
+        with self.available:
+            self.active -= 1
+            self.available.notify()
+            if len(self.idle) < self.size:
+                self.idle.append((time.time(), connection))
+                return
+        close_quietly(connection)
+
+    def discard(self, connection):
+        """Close the connection in use, it is not returned to the pool."""
+        with self.available:
+            self.active -= 1
+            self.available.notify()
+        if connection is not None:
+            close_quietly(connection)
+
+    def clear(self):
+        """Close all idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, deque()
+        for _, connection in idle:
+            close_quietly(connection)
 
 
 class SMTPMailer(Mailer):
-    """SMTP email backend."""
+    """SMTP email backend.
+
+    The backend could be shared between threads, each thread uses its own
+    connection. Set *pool_size* to keep up to that many connections open and
+    reuse them across sends, threads wait up to *pool_wait* seconds for a
+    free connection when all of them are in use.
+
+    Set *retries* to retry sending on connection errors and 4xx replies with
+    jittered exponential backoff. Set *breaker_threshold* to stop connecting
+    to the server after that many consecutive failures, the next attempt is
+    made in *breaker_timeout* seconds.
+
+    Envelope commands are pipelined and message data is sent with BDAT when
+    the server advertises PIPELINING and CHUNKING extensions.
+
+    Messages with more than *max_recipients* recipients (or the limit
+    advertised with LIMITS extension) are delivered in several mail
+    transactions, over up to *fanout_connections* connections at once.
+    """
     def __init__(self,
                  host='localhost',
                  port=25,
@@ -18,13 +420,32 @@ class SMTPMailer(Mailer):
                  password=None,
                  default_sender=None,
                  use_tls=False,
+                 pool_size=0,
+                 pool_timeout=60,
+                 pool_wait=30,
+                 retries=0,
+                 retry_backoff=0.5,
+                 retry_backoff_max=30,
+                 breaker_threshold=0,
+                 breaker_timeout=30,
+                 max_recipients=100,
+                 fanout_connections=1,
                  **kwargs):
+        if fanout_connections < 1:
+            raise ValueError('Setup at least one fan-out connection')
+
         self.host = host
         self.port = port
         self.use_tls = use_tls
         self.username = username
         self.password = password
         self.default_sender = default_sender
+        self.local = threading.local()
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.max_recipients = max_recipients
+        self.fanout_connections = fanout_connections
 
         credentials = (username, password)
         if any(credentials) and not all(credentials):
@@ -34,42 +455,285 @@ class SMTPMailer(Mailer):
             )
             self.username = self.password = None
 
-    def __enter__(self):
-        """Acquires the connection to SMTP server."""
+        self.pool = None
+        if pool_size:
+            self.pool = ConnectionPool(self.connect, pool_size, pool_timeout,
+                                       pool_wait)
+
+        self.breaker = None
+        if breaker_threshold:
+            self.breaker = CircuitBreaker(breaker_threshold, breaker_timeout,
+                                          name='%s:%s' % (host, port))
+
+    @property
+    def connection(self):
+        """The connection used by current thread."""
+        return getattr(self.local, 'connection', None)
+
+    @connection.setter
+    def connection(self, connection):
+        self.local.connection = connection
+
+    def connect(self):
+        """Opens a new connection to SMTP server.
+
+        Raises :class:`RuntimeError` on failure, the original exception is
+        stored in its `reason` attribute.
+        """
+        if self.breaker is not None and not self.breaker.allow():
+            raise RuntimeError('Circuit breaker is open for %s:%s'
+                               % (self.host, self.port))
         try:
-            connection = self.connection = SMTP(self.host, self.port)
-            if self.username and self.password:
-                connection.login(self.username, self.password)
+            with timed(smtp_stage, self, stage='connect'):
+                connection = Connection(self.host, self.port)
+                connection.ehlo_or_helo_if_needed()
             if self.use_tls:
-                connection.ehlo()
-                connection.starttls()
-                connection.ehlo()
+                with timed(smtp_stage, self, stage='tls'):
+                    connection.ehlo()
+                    connection.starttls()
+                    connection.ehlo()
+            if self.username and self.password:
+                with timed(smtp_stage, self, stage='auth'):
+                    connection.login(self.username, self.password)
         except (SMTPException, socket.error) as e:
-            raise RuntimeError(str(e))
+            if self.breaker is not None:
+                self.breaker.failure()
+            error = RuntimeError(str(e))
+            error.reason = e
+            raise error
+        if self.breaker is not None:
+            self.breaker.success()
         return connection
 
+    def check(self):
+        """Check that the server accepts connections."""
+        connection = self.connect()
+        try:
+            return is_connected(connection)
+        finally:
+            close_quietly(connection)
+
+    def acquire(self, wait=None):
+        """Returns pooled connection or opens a new one.
+
+        :param wait: The number of seconds to wait for a free pooled
+                     connection, see :class:`ConnectionPool`.
+        """
+        if self.pool is not None:
+            return self.pool.acquire(wait)
+        return self.connect()
+
+    def release(self, connection):
+        """Returns connection to the pool or closes it."""
+        if self.pool is not None:
+            self.pool.release(connection)
+        else:
+            close_quietly(connection)
+
+    def discard(self, connection):
+        """Closes the broken connection, it is not returned to the pool."""
+        if self.pool is not None:
+            self.pool.discard(connection)
+        else:
+            close_quietly(connection)
+
+    def __enter__(self):
+        """Acquires the connection to SMTP server."""
+        self.connection = self.acquire()
+        return self.connection
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         """Releases the exciting connection to SMTP server."""
+        connection, self.connection = self.connection, None
+        if exc_type is None:
+            self.release(connection)
+        else:
+            self.discard(connection)
+        return False
+
+    def reconnect(self):
+        """Replaces the broken connection with a new one."""
+        self.connection.close()
+        self.connection = self.connect()
+        return self.connection
+
+    def transaction(self, connection, from_addr, recipients, data, chunking,
+                    params=()):
+        """Send the message data to recipients in one mail transaction.
+        Returns a dictionary of refused recipients.
+        """
+        with timed(smtp_stage, self, stage='envelope'):
+            refused = connection.envelope(from_addr, recipients, params)
+        with timed(smtp_stage, self, stage='data'):
+            connection.content(data, chunking)
+        return refused
+
+    def deliver(self, connection, message):
+        """Send the message over the open connection. Returns a dictionary
+        of refused recipients.
+        """
+        message.from_addr = message.from_addr or self.default_sender
+        options, params = transport(message, connection.has_extn)
+        if options.get('smtputf8'):
+            from_addr, recipients = message.envelope(smtputf8=True)
+        else:
+            from_addr = text_type(message.from_addr)
+            recipients = [text_type(x) for x in message.send_to]
+        chunking = connection.has_extn('chunking')
+        if getattr(message, 'streamed', False):
+            # Serialize large message and read attached files while sending.
+            data = Chunks(lambda: message.iter_bytes(**options)) \
+                if chunking else message.iter_wire(**options)
+        else:
+            data = message.as_bytes(**options) if chunking else \
+                message.to_wire(**options)
+
+        limits = [x for x in (self.max_recipients, connection.rcpt_max())
+                  if x]
+        if limits and len(recipients) > min(limits):
+            refused = self.fanout(connection, from_addr,
+                                  chunked(recipients, min(limits)),
+                                  data, chunking, params)
+        else:
+            refused = self.transaction(connection, from_addr, recipients,
+                                       data, chunking, params)
+        if has_receivers(message_sent):
+            message_sent.send(self, message=message, size=len(data),
+                              recipients=len(recipients), refused=len(refused))
+        return refused
+
+    def fanout(self, connection, from_addr, chunks, data, chunking,
+               params=()):
+        """Send the message data to chunks of recipients over the open
+        connection and up to *fanout_connections* - 1 extra ones at once.
+        Returns a merged dictionary of refused recipients, failed
+        transactions refuse all their recipients (see :func:`refusals`).
+        """
+        queue = deque(chunks)
+        reports = []
+        args = (from_addr, queue, data, chunking, reports, params)
+        workers = [threading.Thread(target=self.drain, args=(None,) + args)
+                   for _ in range(min(self.fanout_connections,
+                                      len(chunks)) - 1)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        self.drain(connection, *args)
+        for worker in workers:
+            worker.join()
+
+        refused = {}
+        for report in reports:
+            refused.update(report)
+        if len(refused) == sum(len(x) for x in chunks):
+            raise SMTPRecipientsRefused(refused)
+        return refused
+
+    def drain(self, connection, from_addr, queue, data, chunking, reports,
+              params=()):
+        """Send the message data to chunks of recipients from the shared
+        queue over one connection. Opens an extra connection if
+        *connection* is `None` before it takes any chunk, and leaves the
+        chunks to other connections if could not connect, the pool has no
+        free ones or the extra connection is lost. The connection given
+        reconnects and drains the queue to the end, so every chunk is
+        either sent or refused.
+        """
+        extra = connection is None
+        used = False
+        refused = {}
         try:
-            try:
-                self.connection.quit()
-            except socket.sslerror:
-                # This happens when calling quit() on a TLS connection
-                # sometimes.
-                self.connection.close()
-            except:
-                return False
+            if extra:
+                try:
+                    connection = self.acquire(wait=0)
+                except Exception:
+                    return
+            while True:
+                try:
+                    recipients = queue.popleft()
+                except IndexError:
+                    break
+                try:
+                    if connection is None:
+                        connection = self.reconnect()
+                    elif used:
+                        connection.rset()
+                    used = True
+                    refused.update(self.transaction(
+                        connection, from_addr, recipients, data, chunking,
+                        params))
+                except Exception as e:
+                    refused.update(refusals(recipients, e))
+                    if connection is not None and is_closed(connection, e):
+                        if extra:
+                            self.discard(connection)
+                            connection = None
+                            break
+                        connection.close()
+                        connection = None
         finally:
-            self.connection = None
-            return True
+            reports.append(refused)
+            if extra and connection is not None:
+                self.release(connection)
 
     def send(self, message):
-        """Send the message."""
-        with self as con:
-            message.from_addr = message.from_addr or self.default_sender
-            con.sendmail(text_type(message.from_addr),
-                         text_type(message.send_to),
-                         message.format())
+        """Send the message, retry on transient errors."""
+        attempt = 0
+        while True:
+            try:
+                with self as con:
+                    return self.deliver(con, message)
+            except Exception as e:
+                if attempt >= self.retries or not is_transient(e):
+                    raise
+            time.sleep(backoff(attempt, self.retry_backoff,
+                               self.retry_backoff_max))
+            attempt += 1
+
+    def send_many(self, messages):
+        """Send the messages over a single connection, reset the session
+        with RSET between messages.
+
+        Returns a list with one entry per message: `None` if the message was
+        sent or the exception raised while sending it. Partially delivered
+        message results in :class:`SMTPRecipientsRefused` with the refused
+        recipients. The connection is opened before the first message and
+        after the lost one only when the next message is sent, failed
+        connect is the result of that message.
+
+        :param messages: The iterable of messages to send.
+        """
+        results = []
+        used = False
+        try:
+            for message in messages:
+                try:
+                    if self.connection is None:
+                        self.connection = self.acquire()
+                        used = False
+                    elif used:
+                        self.connection.rset()
+                    used = True
+                    refused = self.deliver(self.connection, message)
+                    if refused:
+                        raise SMTPRecipientsRefused(refused)
+                except Exception as e:
+                    results.append(e)
+                    if self.connection is not None and \
+                       is_closed(self.connection, e):
+                        self.discard(self.connection)
+                        self.connection = None
+                else:
+                    results.append(None)
+        except Exception:
+            connection, self.connection = self.connection, None
+            if connection is not None:
+                self.discard(connection)
+            raise
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            self.release(connection)
+        return results
 
     def send_quiet(self, message):
         """Send the message but swallow exceptions."""
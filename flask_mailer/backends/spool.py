@@ -0,0 +1,258 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import json
+import sqlite3
+import threading
+import time
+from smtplib import SMTPRecipientsRefused
+
+from flask_mailer.backends.base import Mailer
+from flask_mailer.backends.smtp import SMTPMailer
+from flask_mailer.compat import text_type
+from flask_mailer.mail import escape_dots
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS spool (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sender TEXT NOT NULL,
+    recipients TEXT NOT NULL,
+    data BLOB NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    last_error TEXT
+)
+'''
+
+
+def open_spool(path, sync='full'):
+    """Open the spool database and create the schema if necessary.
+
+    :param path: The path to the spool database.
+    :param sync: The SQLite synchronous mode, `full` calls fsync on every
+                 commit, `normal` survives application crash but not power
+                 loss.
+    """
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=%s' % sync.upper())
+    db.execute(SCHEMA)
+    db.commit()
+    return db
+
+
+class SpooledEmail(object):
+    """A message stored in the spool.
+
+    Provides the same interface as :class:`~flask_mailer.mail.Email` does
+    for backends, but keeps already serialized message as CRLF-separated
+    7-bit bytes, which any server accepts.
+    """
+
+    def __init__(self, id, from_addr, send_to, data, attempts=0):
+        self.id = id
+        self.from_addr = from_addr
+        self.send_to = send_to
+        self.data = data
+        self.attempts = attempts
+
+    def as_bytes(self, eightbit=True, smtputf8=False):
+        return self.data
+
+    def to_wire(self, eightbit=True, smtputf8=False):
+        return escape_dots(self.data)
+
+
+class SpoolMailer(Mailer):
+    """Spool email backend.
+
+    Appends serialized messages to the local SQLite database instead of
+    sending them. Use :class:`SpoolDrainer` in a separate process to deliver
+    spooled messages. Messages are stored 7-bit encoded, as the server they
+    are delivered to may not support 8BITMIME extension.
+
+    Concurrent sends share one commit (group commit), so each send waits for
+    a single fsync at most.
+
+    :param spool_path: The path to the spool database.
+    :param spool_sync: The SQLite synchronous mode, `full` or `normal`.
+    :param default_sender: The default message sender.
+    """
+
+    def __init__(self,
+                 spool_path='mailer.spool',
+                 spool_sync='full',
+                 default_sender=None,
+                 **kwargs):
+        self.path = spool_path
+        self.default_sender = default_sender
+        self.db = open_spool(spool_path, spool_sync)
+        self.lock = threading.Lock()
+        self.commit_lock = threading.Lock()
+        self.written = self.committed = 0
+
+    def write(self, message):
+        """Append the message to the current transaction."""
+        message.from_addr = message.from_addr or self.default_sender
+        self.db.execute(
+            'INSERT INTO spool (sender, recipients, data) VALUES (?, ?, ?)',
+            (text_type(message.from_addr),
+             json.dumps([text_type(x) for x in message.send_to]),
+             sqlite3.Binary(message.as_bytes(eightbit=False))))
+        self.written += 1
+        return self.written
+
+    def commit(self, seq):
+        """Wait until the write with given sequence number is committed.
+
+        The first waiting thread commits writes of all other threads.
+        """
+        with self.commit_lock:
+            if self.committed >= seq:
+                return
+            with self.lock:
+                self.db.commit()
+                self.committed = self.written
+
+    def send(self, message):
+        """Append the message to the spool."""
+        with self.lock:
+            seq = self.write(message)
+        self.commit(seq)
+
+    def send_quiet(self, message):
+        """Append the message to the spool but swallow exceptions."""
+        try:
+            return self.send(message)
+        except Exception:
+            return
+
+    def send_many(self, messages):
+        """Append the messages to the spool in one transaction."""
+        results = []
+        seq = 0
+        with self.lock:
+            for message in messages:
+                try:
+                    seq = self.write(message)
+                except Exception as e:
+                    results.append(e)
+                else:
+                    results.append(None)
+        self.commit(seq)
+        return results
+
+
+class SpoolDrainer(object):
+    """Delivers spooled messages through the backend in batches.
+
+    Delivered messages are deleted from the spool in the same transaction
+    which records failures, so the drainer could be restarted at any time.
+    Failed messages are retried with exponential delay, messages failed
+    *max_attempts* times are kept in the spool but never retried.
+
+    :param spool_path: The path to the spool database.
+    :param backend: The backend used to deliver messages.
+    :param batch_size: The number of messages to deliver at once.
+    :param retry_delay: The delay before the first retry in seconds.
+    :param max_attempts: The maximum number of delivery attempts.
+    """
+
+    def __init__(self,
+                 spool_path,
+                 backend,
+                 batch_size=100,
+                 retry_delay=60,
+                 max_attempts=10):
+        self.db = open_spool(spool_path)
+        self.backend = backend
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+
+    def pending(self, now=None):
+        """Returns the batch of messages ready for delivery."""
+        now = time.time() if now is None else now
+        rows = self.db.execute(
+            'SELECT id, sender, recipients, data, attempts FROM spool '
+            'WHERE next_attempt <= ? AND attempts < ? ORDER BY id LIMIT ?',
+            (now, self.max_attempts, self.batch_size))
+        return [SpooledEmail(id, sender, json.loads(recipients), bytes(data),
+                             attempts)
+                for id, sender, recipients, data, attempts in rows]
+
+    def deliver(self, messages):
+        """Deliver the batch and record the results."""
+        try:
+            results = self.backend.send_many(messages)
+        except Exception as e:
+            results = [e] * len(messages)
+
+        now = time.time()
+        delivered = 0
+        with self.db:
+            for message, error in zip(messages, results):
+                if error is None:
+                    delivered += 1
+                    self.db.execute('DELETE FROM spool WHERE id = ?',
+                                    (message.id,))
+                    continue
+
+                recipients = message.send_to
+                if isinstance(error, SMTPRecipientsRefused):
+                    # Retry only refused recipients.
+                    recipients = [x for x in recipients
+                                  if x in error.recipients]
+                delay = self.retry_delay * 2 ** message.attempts
+                self.db.execute(
+                    'UPDATE spool SET recipients = ?, attempts = ?, '
+                    'next_attempt = ?, last_error = ? WHERE id = ?',
+                    (json.dumps(recipients), message.attempts + 1,
+                     now + delay, text_type(error), message.id))
+        return delivered
+
+    def drain(self):
+        """Deliver all messages ready for delivery. Returns the number of
+        delivered messages.
+        """
+        delivered = 0
+        now = time.time()
+        while True:
+            messages = self.pending(now)
+            if not messages:
+                return delivered
+            delivered += self.deliver(messages)
+
+    def run(self, interval=1):
+        """Drain the spool forever."""
+        while True:
+            self.drain()
+            time.sleep(interval)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Deliver spooled messages through SMTP server.')
+    parser.add_argument('spool_path')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=25)
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--use-tls', action='store_true')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--interval', type=float, default=1)
+    args = parser.parse_args(argv)
+
+    backend = SMTPMailer(host=args.host,
+                         port=args.port,
+                         username=args.username,
+                         password=args.password,
+                         use_tls=args.use_tls)
+    drainer = SpoolDrainer(args.spool_path, backend, args.batch_size)
+    drainer.run(args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from flask_mailer.backends.base import Mailer
+from flask_mailer.ratelimit import RateLimiter
+
+
+class ThrottledMailer(Mailer):
+    """Limits the rate of sending through the wrapped backend.
+
+    Messages over the budget are delayed rather than rejected, so bursts are
+    smoothed to the allowed rate.
+
+    :param backend: The backend used to send messages.
+    :param rate_limit: The number of messages per second, `0` means no limit.
+    :param rate_burst: The number of messages could be sent at once.
+    :param domain_rate_limits: The dictionary of recipients per second by
+                               recipient domain, the `*` key sets the limit
+                               for each other domain.
+    """
+
+    def __init__(self,
+                 backend,
+                 rate_limit=0,
+                 rate_burst=None,
+                 domain_rate_limits=None,
+                 **kwargs):
+        self.backend = backend
+        self.limiter = RateLimiter(rate_limit, rate_burst, domain_rate_limits)
+
+    def __getattr__(self, name):
+        if name == 'backend':
+            raise AttributeError(name)
+        return getattr(self.backend, name)
+
+    def throttle(self, messages):
+        """Yield the messages as the budget allows."""
+        for message in messages:
+            self.limiter.wait(message)
+            yield message
+
+    def send(self, message):
+        """Wait for the budget and send the message."""
+        self.limiter.wait(message)
+        return self.backend.send(message)
+
+    def send_quiet(self, message):
+        """Wait for the budget and send the message but swallow exceptions."""
+        try:
+            return self.send(message)
+        except Exception:
+            return
+
+    def send_many(self, messages):
+        """Send the messages, each one waits for the budget before it is
+        handed to the backend.
+        """
+        return self.backend.send_many(self.throttle(messages))
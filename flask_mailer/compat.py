@@ -4,18 +4,27 @@ import sys
 
 
 if sys.version_info[0] >= 3:
+    from base64 import encodebytes
+    from threading import get_ident
+
     text_type = str
     string_types = str,
     iteritems = lambda o: o.items()
     itervalues = lambda o: o.values()
 
+    native_string = lambda s: s.decode('utf-8') if isinstance(s, bytes) else s
     unicode_compatible = lambda x: x
 else:
+    from base64 import encodestring as encodebytes
+    from thread import get_ident
+
     text_type = unicode
     string_types = basestring,
     iteritems = lambda o: o.iteritems()
     itervalues = lambda o: o.itervalues()
 
+    native_string = lambda s: s.encode('utf-8') if isinstance(s, unicode) else s
+
     def unicode_compatible(cls):
         """A decorator which defines `__str__` and `__unicode__` methods in
         decorated class.
@@ -1,11 +1,45 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+import mimetypes
+import mmap
+import os
+import random
+import re
+import tempfile
+import threading
+from binascii import b2a_qp
+from collections import OrderedDict
+from email import message_from_string
 from email.mime.text import MIMEText
 from email.header import Header
+from email.utils import encode_rfc2231
 from email.utils import parseaddr
 from email.utils import formataddr
+from timeit import default_timer
 
-from flask_mailer.compat import string_types, text_type, unicode_compatible
+from flask_mailer.compat import encodebytes, native_string, string_types, \
+    text_type, unicode_compatible
+from flask_mailer.signals import has_receivers
+from flask_mailer.signals import message_built
+
+
+#: Matches email address which could be sent to: both parts are present and
+#: contain no whitespaces or angle brackets.
+ADDRESS_RE = re.compile(r'[^@\s<>]+@[^@\s<>]+\Z', re.UNICODE)
+
+#: Matches newline separated list of plain addresses.
+ADDRESS_LIST_RE = re.compile(r'(?:[^@\s<>]+@[^@\s<>]+(?:\n|\Z))*\Z',
+                             re.UNICODE)
+
+#: Matches the name which should be quoted in the address.
+SPECIALS_RE = re.compile(r'[][\\()<>@,:;".]')
+
+#: Bytes of 7-bit text.
+ASCII_BYTES = bytes(bytearray(range(1, 128)))
+
+#: Bytes which quoted-printable encoding keeps as is.
+QP_SAFE_BYTES = bytes(bytearray(range(32, 61)) + bytearray(range(62, 127)) +
+                      bytearray(b'\t\r\n'))
 
 
 def to_list(el):
@@ -19,8 +53,79 @@ def utf8(s):
     return s.encode('utf-8') if isinstance(s, text_type) else s
 
 
-def contains_nonascii_characters(raw):
-    return not all(ord(c) < 128 for c in raw)
+if hasattr(str, 'isascii'):
+    def contains_nonascii_characters(raw):
+        return not raw.isascii()
+else:
+    def contains_nonascii_characters(raw):
+        try:
+            raw.encode('ascii')
+        except UnicodeError:
+            return True
+        return False
+
+
+class LRUCache(object):
+    """Thread-safe cache which keeps up to *maxsize* recently used values.
+
+    >>> cache = LRUCache(maxsize=2)
+    >>> cache.get('a', lambda: 1), cache.get('a', lambda: 2)
+    (1, 1)
+    >>> cache.stats()['hits']
+    1
+
+    :param maxsize: The maximum number of values to keep, `0` disables cache.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key, build):
+        """Returns the cached value, build and cache it if necessary.
+
+        :param key: The hashable key of the value.
+        :param build: The callable which returns the value.
+        """
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.data[key] = value
+                return value
+
+        value = build()
+        with self.lock:
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+        return value
+
+    def resize(self, maxsize):
+        """Change the maximum size, drop least recently used values."""
+        with self.lock:
+            self.maxsize = maxsize
+            while len(self.data) > maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.data), 'maxsize': self.maxsize}
+
+
+#: Encoded header strings and IDNA domains. Newsletters repeat the same
+#: subjects, names and domains, so encode each of them once.
+encoding_cache = LRUCache()
 
 
 def rfc_compliant(s, encoding):
@@ -28,11 +133,23 @@ def rfc_compliant(s, encoding):
     string if is contains only ascii letters.
     """
     if contains_nonascii_characters(s):
-        return Header(s, encoding).encode()
+        return encoding_cache.get(
+            ('header', s, encoding), lambda: Header(s, encoding).encode())
     return s
 
 
-def sanitize_address(addr, encoding='utf-8'):
+def idna(domain):
+    """Encode the domain with IDNA.
+
+    >>> idna(u'exämple.com') == 'xn--exmple-cua.com'
+    True
+
+    """
+    return encoding_cache.get(
+        ('idna', domain), lambda: domain.encode('idna').decode('ascii'))
+
+
+def sanitize_address(addr, encoding='utf-8', smtputf8=False):
     """Sanitize email address into RFC 2822-compliant string.
 
     Adopted version from Django mail package
@@ -40,11 +157,18 @@ def sanitize_address(addr, encoding='utf-8'):
 
     :param addr: The address to process.
     :param encoding: The character set that the address was encoded in.
+    :param smtputf8: Keep non-ascii name and address as is, the server
+                     should support SMTPUTF8 extension.
     """
     if isinstance(addr, string_types):
         addr = parseaddr(addr)
     nm, addr = addr
 
+    if smtputf8:
+        if SPECIALS_RE.search(nm):
+            nm = '"%s"' % nm.replace('\\', '\\\\').replace('"', '\\"')
+        return ''.join(('%s <%s>' % (nm, addr) if nm else addr).splitlines())
+
     try:
         nm = rfc_compliant(nm, encoding)
     except UnicodeEncodeError:
@@ -56,7 +180,7 @@ def sanitize_address(addr, encoding='utf-8'):
         if '@' in addr:
             localpart, domain = addr.split('@', 1)
             localpart = rfc_compliant(localpart, encoding)
-            domain = domain.encode('idna').decode('ascii')
+            domain = idna(domain)
             addr = '@'.join([localpart, domain])
         else:
             addr = rfc_compliant(addr, encoding)
@@ -64,6 +188,402 @@ def sanitize_address(addr, encoding='utf-8'):
     return ''.join(formataddr((nm, addr)).splitlines())
 
 
+def fold_header(line, sep='\r\n', width=78):
+    """Fold long header line at whitespaces.
+
+    >>> fold_header('To: alice@example.com, bob@example.com', width=25)
+    'To: alice@example.com,\\r\\n bob@example.com'
+
+    Lines which are already folded are kept as is, but separated with *sep*.
+
+    :param line: The header line to fold.
+    :param sep: The line separator.
+    :param width: The preferred maximum line length.
+    """
+    if '\n' in line or '\r' in line:
+        return sep.join(line.splitlines())
+    if len(line) <= width:
+        return line
+
+    lines, current = [], None
+    for word in line.split(' '):
+        if current is None:
+            current = word
+        elif len(current) + len(word) + 1 > width:
+            lines.append(current)
+            current = ' ' + word
+        else:
+            current += ' ' + word
+    lines.append(current)
+    return sep.join(lines)
+
+
+def normalize_newlines(data, sep=b'\r\n'):
+    """Replace any line ending in *data* bytes with *sep*.
+
+    >>> normalize_newlines(b'a\\rb\\nc\\r\\n') == b'a\\r\\nb\\r\\nc\\r\\n'
+    True
+
+    """
+    if b'\r' in data:
+        data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    if sep != b'\n':
+        data = data.replace(b'\n', sep)
+    return data
+
+
+def escape_dots(data):
+    """Escape dots at the beginning of the lines as SMTP DATA command
+    requires. Lines should be separated with CRLF.
+
+    >>> escape_dots(b'.a\\r\\n.b\\r\\nc') == b'..a\\r\\n..b\\r\\nc'
+    True
+
+    """
+    if data.startswith(b'.'):
+        data = b'.' + data
+    if b'\n.' in data:
+        data = data.replace(b'\n.', b'\n..')
+    return data
+
+
+def normalize_chunks(chunks, sep=b'\r\n', escape=False):
+    """Normalize line endings and escape leading dots as
+    :func:`normalize_newlines` and :func:`escape_dots` do, but chunk by
+    chunk. Line endings and lines could be split between chunks.
+
+    >>> chunks = normalize_chunks([b'a\\r', b'\\n.b\\n', b'.c\\r', b'd'],
+    ...                           escape=True)
+    >>> b''.join(chunks) == b'a\\r\\n..b\\r\\n..c\\r\\nd'
+    True
+
+    :param chunks: The iterable of bytes.
+    :param sep: The line separator.
+    :param escape: Escape leading dots as SMTP DATA command requires.
+    """
+    line_start, carriage_return = True, False
+    for chunk in chunks:
+        if carriage_return and chunk.startswith(b'\n'):
+            # The line ending is already written with the previous chunk.
+            chunk = chunk[1:]
+        carriage_return = chunk.endswith(b'\r')
+        if carriage_return:
+            chunk = normalize_newlines(chunk[:-1], sep) + sep
+        elif chunk:
+            chunk = normalize_newlines(chunk, sep)
+        else:
+            continue
+        if escape:
+            if line_start and chunk.startswith(b'.'):
+                chunk = b'.' + chunk
+            if b'\n.' in chunk:
+                chunk = chunk.replace(b'\n.', b'\n..')
+        line_start = chunk.endswith(b'\n')
+        yield chunk
+
+
+def iter_text(text, size):
+    """Returns the iterator over the text encoded in UTF-8, slice by slice
+    of *size* characters.
+    """
+    if len(text) <= size:
+        yield utf8(text)
+        return
+    for start in range(0, len(text), size):
+        yield utf8(text[start:start + size])
+
+
+#: Encoded message bodies. The same text or HTML is often sent to many
+#: recipients, so encode it once.
+body_cache = LRUCache(maxsize=64)
+
+
+def transfer_encoding(chunks):
+    """Returns the transfer encoding to send the text through 7-bit server:
+    `7bit` for ascii text with lines up to 998 characters, otherwise the
+    one of `quoted-printable` and `base64` which results in less bytes.
+    The sizes are estimated without encoding the text.
+
+    >>> transfer_encoding([b'Hello'])
+    '7bit'
+    >>> transfer_encoding([b'Caf\\xc3\\xa9 au lait'])
+    'quoted-printable'
+    >>> transfer_encoding([b'\\xd0\\x9f\\xd1\\x80\\xd0\\xb8'])
+    'base64'
+
+    :param chunks: The iterable of UTF-8 encoded text chunks.
+    """
+    size = escaped = nonascii = longest = line = 0
+    for chunk in chunks:
+        size += len(chunk)
+        escaped += len(chunk.translate(None, QP_SAFE_BYTES))
+        nonascii += len(chunk.translate(None, ASCII_BYTES))
+        lines = chunk.replace(b'\r', b'\n').split(b'\n')
+        line += len(lines[0])
+        if len(lines) > 1:
+            longest = max([longest, line] + [len(x) for x in lines[1:-1]])
+            line = len(lines[-1])
+    if not nonascii and max(longest, line) <= 998:
+        return '7bit'
+    # Quoted-printable escapes take 3 bytes, base64 takes 4 bytes per 3.
+    if size + 2 * escaped <= (size + 2) // 3 * 4:
+        return 'quoted-printable'
+    return 'base64'
+
+
+def encode_chunks(chunks, sep=b'\r\n', escape=False, encoding='8bit'):
+    """Returns the iterator over the text chunks encoded with the transfer
+    encoding.
+
+    :param chunks: The iterable of UTF-8 encoded text chunks.
+    :param sep: The line separator.
+    :param escape: Escape leading dots as SMTP DATA command requires.
+    :param encoding: The transfer encoding, `7bit`, `8bit`,
+                     `quoted-printable` or `base64`.
+    """
+    if encoding == 'base64':
+        # Line breaks of the text are encoded in canonical form.
+        return encode_base64_chunks(normalize_chunks(chunks), sep)
+    if encoding == 'quoted-printable':
+        return encode_quoted_printable(normalize_chunks(chunks, b'\n'),
+                                       sep, escape)
+    return normalize_chunks(chunks, sep, escape)
+
+
+def encode_text(text, sep=b'\r\n', escape=False, size=1 << 16,
+                encoding='8bit'):
+    """Returns the iterable of encoded text chunks. Texts up to *size*
+    characters are encoded at once and cached, longer ones are encoded
+    lazily slice by slice.
+
+    :param text: The text to encode.
+    :param sep: The line separator.
+    :param escape: Escape leading dots as SMTP DATA command requires.
+    :param size: The number of characters to encode at once.
+    :param encoding: The transfer encoding, see :func:`encode_chunks`.
+    """
+    def encode(chunks):
+        return encode_chunks(chunks, sep, escape, encoding)
+
+    if len(text) > size:
+        return encode(iter_text(text, size))
+    return [body_cache.get((text, sep, escape, encoding),
+                           lambda: b''.join(encode([utf8(text)])))]
+
+
+def encode_base64(data, sep=b'\r\n'):
+    """Encode data into base64 lines of 76 characters.
+
+    >>> encode_base64(b'\\x00' * 60) == b'A' * 76 + b'\\r\\nAAAA\\r\\n'
+    True
+
+    """
+    data = encodebytes(data)
+    if sep != b'\n':
+        data = data.replace(b'\n', sep)
+    return data
+
+
+def encode_base64_chunks(chunks, sep=b'\r\n'):
+    """Returns the iterator over base64-encoded chunks as
+    :func:`encode_base64` encodes their concatenation.
+
+    :param chunks: The iterable of bytes.
+    :param sep: The line separator.
+    """
+    rest = b''
+    for chunk in chunks:
+        if rest:
+            chunk = rest + chunk
+        # Short chunks are carried over, padding is allowed only at the end
+        # of the data.
+        end = len(chunk) - len(chunk) % 57
+        chunk, rest = chunk[:end], chunk[end:]
+        if chunk:
+            yield encode_base64(chunk, sep)
+    if rest:
+        yield encode_base64(rest, sep)
+
+
+def encode_quoted_printable(chunks, sep=b'\r\n', escape=False):
+    """Returns the iterator over quoted-printable encoded chunks. Chunks
+    are encoded by whole lines.
+
+    >>> chunks = encode_quoted_printable([b'Caf\\xc3', b'\\xa9\\n.a'],
+    ...                                  escape=True)
+    >>> b''.join(chunks) == b'Caf=C3=A9\\r\\n..a'
+    True
+
+    :param chunks: The iterable of bytes with LF line endings.
+    :param sep: The line separator.
+    :param escape: Escape leading dots as SMTP DATA command requires.
+    """
+    def lines():
+        rest = b''
+        for chunk in chunks:
+            if rest:
+                chunk = rest + chunk
+            end = chunk.rfind(b'\n') + 1
+            chunk, rest = chunk[:end], chunk[end:]
+            if chunk:
+                yield b2a_qp(chunk, istext=True)
+        if rest:
+            yield b2a_qp(rest, istext=True)
+
+    return normalize_chunks(lines(), sep, escape)
+
+
+def read_file(path, size):
+    """Returns the iterator over the file content in chunks of *size* bytes.
+    The file is memory-mapped if possible.
+    """
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # Empty files and special files could not be mapped.
+            for chunk in iter(lambda: f.read(size), b''):
+                yield chunk
+            return
+        try:
+            for start in range(0, len(data), size):
+                yield data[start:start + size]
+        finally:
+            data.close()
+
+
+def buffer_stream(stream, size, max_size):
+    """Copy the stream into a temporary file, which is kept in memory until
+    it grows larger than *max_size* bytes. Returns the file rewound to the
+    beginning.
+    """
+    buffer = tempfile.SpooledTemporaryFile(max_size)
+    for chunk in iter(lambda: stream.read(size), b''):
+        buffer.write(chunk)
+    buffer.seek(0)
+    return buffer
+
+
+class Attachment(object):
+    """A file attached to the email.
+
+    The file is read and base64-encoded lazily in chunks while the message
+    is written, so it is never kept in memory as a whole. Files given by
+    path are memory-mapped.
+
+    :param source: The path to the file or binary file object. The file
+                   object is read from its initial position on each send,
+                   concurrent sends share it safely. Non-seekable streams
+                   are copied to a temporary file at once.
+    :param filename: The name of the file, defaults to the base name of the
+                     path.
+    :param content_type: The content type, guessed by filename by default.
+    """
+
+    #: The number of bytes to encode at once, 57 bytes are encoded into one
+    #: line of 76 characters.
+    chunk_size = 57 * 1024
+
+    #: The size of non-seekable stream kept in memory, larger streams are
+    #: copied to a temporary file on disk.
+    buffer_size = 1 << 20
+
+    def __init__(self, source, filename=None, content_type=None):
+        self.source = source
+        self.offset = None
+        self.lock = threading.Lock()
+        if isinstance(source, string_types):
+            filename = filename or os.path.basename(source)
+        else:
+            name = getattr(source, 'name', None)
+            if not filename and isinstance(name, string_types):
+                filename = os.path.basename(name)
+            try:
+                if getattr(source, 'seekable', lambda: True)():
+                    self.offset = source.tell()
+            except (AttributeError, EnvironmentError, ValueError):
+                pass
+            if self.offset is None:
+                # The stream could be read only once, but the message
+                # could be sent several times.
+                self.source = buffer_stream(source, self.chunk_size,
+                                            self.buffer_size)
+                self.offset = 0
+        self.filename = ''.join((filename or '').splitlines())
+        self.content_type = ''.join((
+            content_type or mimetypes.guess_type(self.filename)[0] or
+            'application/octet-stream').splitlines())
+
+    def headers(self):
+        """Returns the list of MIME part headers as `(name, value)` pairs."""
+        disposition = 'attachment'
+        if contains_nonascii_characters(self.filename):
+            disposition += "; filename*=%s" % encode_rfc2231(
+                native_string(self.filename), 'utf-8')
+        elif self.filename:
+            disposition += '; filename="%s"' % self.filename \
+                .replace('\\', '\\\\').replace('"', '\\"')
+        return [
+            ('Content-Type', self.content_type),
+            ('Content-Transfer-Encoding', 'base64'),
+            ('Content-Disposition', disposition),
+        ]
+
+    def read(self, size):
+        """Returns the iterator over the file content in chunks of at most
+        *size* bytes.
+        """
+        if isinstance(self.source, string_types):
+            return read_file(self.source, size)
+        return self.read_stream(size)
+
+    def read_stream(self, size):
+        """Returns the iterator over the file object content. Each iterator
+        keeps its own position in the file, so the file could be read by
+        several threads at once.
+        """
+        position = self.offset
+        while True:
+            with self.lock:
+                self.source.seek(position)
+                chunk = self.source.read(size)
+            if not chunk:
+                return
+            position += len(chunk)
+            yield chunk
+
+    def encode(self, sep=b'\r\n'):
+        """Returns the iterator over base64-encoded file content.
+
+        :param sep: The line separator.
+        """
+        for chunk in encode_base64_chunks(self.read(self.chunk_size), sep):
+            yield chunk
+
+
+class Chunks(object):
+    """The message serialized lazily, chunk by chunk. Could be iterated
+    several times, each time the message is serialized again.
+
+    :param build: The callable which returns the iterator over chunks.
+    """
+
+    def __init__(self, build):
+        self.build = build
+        self.size = 0
+
+    def __iter__(self):
+        size = 0
+        for chunk in self.build():
+            size += len(chunk)
+            yield chunk
+        self.size = size
+
+    def __len__(self):
+        """Returns the number of bytes of the last complete iteration."""
+        return self.size
+
+
 class Proxy(object):
     """Create a proxy descriptor.
 
@@ -118,8 +638,17 @@ class SafeHeader(object):
             return rfc_compliant(''.join(self.value.splitlines()), self.encoding)
         return text_type(self.value)
 
+    def format(self, smtputf8=False):
+        """Returns the formatted header. Non-ascii value is kept as is if
+        *smtputf8* is set.
+        """
+        if smtputf8 and isinstance(self.value, string_types):
+            return ''.join(self.value.splitlines())
+        return text_type(self)
+
     def __nonzero__(self):
         return isinstance(self.value, string_types) and bool(self.value)
+    __bool__ = __nonzero__
 
 
 @unicode_compatible
@@ -138,17 +667,51 @@ class Address(object):
     >>> str(Address(('Alice', 'alice@example.com')))
     'Alice <alice@example.com>'
 
+    Formated address is cached until another address is assigned.
+
     :param address: The email address
     """
 
     def __init__(self, address):
         self.address = address
 
+    @classmethod
+    def trusted(cls, address, formatted=None):
+        """Create the address which is already validated.
+
+        :param address: The email address.
+        :param formatted: The formatted address if it is known.
+        """
+        self = cls.__new__(cls)
+        self._address = address
+        self._formatted = formatted
+        return self
+
+    @property
+    def address(self):
+        return self._address
+
+    @address.setter
+    def address(self, value):
+        self._address = value
+        self._formatted = None
+
     def __str__(self):
-        return sanitize_address(self.address)
+        if self._formatted is None:
+            self._formatted = sanitize_address(self.address)
+        return self._formatted
+
+    def format(self, smtputf8=False):
+        """Returns the formatted address. Non-ascii name and address are
+        kept as is if *smtputf8* is set, see :func:`sanitize_address`.
+        """
+        if smtputf8:
+            return sanitize_address(self.address, smtputf8=True)
+        return text_type(self)
 
     def __nonzero__(self):
         return bool(self.address)
+    __bool__ = __nonzero__
 
     def __eq__(self, obj):
         if isinstance(obj, Address):
@@ -198,9 +761,94 @@ class Addresses(list):
 
         self.extend(values)
 
+    #: Invalid values skipped by :meth:`from_iterable`.
+    invalid = ()
+
+    @classmethod
+    def from_iterable(cls, values, strict=False):
+        """Build the list from a large number of values at once.
+
+        Plain addresses are validated with a single match of the whole list,
+        the values are checked one by one only if some of them are named or
+        invalid. Invalid values are skipped and kept in the `invalid`
+        attribute of the list::
+
+        >>> to = Addresses.from_iterable(['alice@example.com', 'bob'])
+        >>> str(to), to.invalid
+        ('alice@example.com', ['bob'])
+
+        Plain ascii addresses are formatted as is, without parsing.
+
+        :param values: The iterable of addresses as strings, `(name, address)`
+                       pairs or :class:`Address` instances.
+        :param strict: Raise :class:`ValueError` listing all invalid values
+                       instead of skip them.
+        """
+        values = list(values)
+        try:
+            text = '\n'.join(values)
+        except (TypeError, UnicodeError):
+            text = None
+
+        if text is not None and text.count('\n') == len(values) - 1 and \
+           ADDRESS_LIST_RE.match(text):
+            # Fast path: all values are plain addresses.
+            trusted = Address.trusted
+            if contains_nonascii_characters(text):
+                addresses = [trusted(x, None if contains_nonascii_characters(x)
+                                     else x) for x in values]
+            else:
+                addresses = [trusted(x, x) for x in values]
+            invalid = []
+        else:
+            addresses, invalid = cls.validate(values)
+
+        if invalid and strict:
+            raise ValueError('Invalid addresses (%d): %s' % (
+                len(invalid), ', '.join(map(repr, invalid[:10]))))
+
+        result = cls()
+        list.extend(result, addresses)
+        result.invalid = invalid
+        return result
+
+    @staticmethod
+    def validate(values):
+        """Returns the list of :class:`Address` instances for valid values
+        and the list of invalid values.
+        """
+        addresses, invalid = [], []
+        match = ADDRESS_RE.match
+        trusted = Address.trusted
+        for value in values:
+            if isinstance(value, Address):
+                addresses.append(value)
+                continue
+
+            formatted = None
+            if isinstance(value, string_types):
+                email = value = value.strip()
+                if '<' in email:
+                    email = parseaddr(email)[1]
+                elif not contains_nonascii_characters(email):
+                    formatted = email
+            elif isinstance(value, (tuple, list)) and len(value) == 2:
+                email = value[1]
+            else:
+                email = None
+            if not isinstance(email, string_types) or not match(email):
+                invalid.append(value)
+            else:
+                addresses.append(trusted(value, formatted))
+        return addresses, invalid
+
     def __str__(self):
         return ', '.join(map(text_type, self))
 
+    def format(self, smtputf8=False):
+        """Returns the formatted list, see :meth:`Address.format`."""
+        return ', '.join(x.format(smtputf8) for x in self)
+
     def append(self, value):
         return self.extend([value,])
 
@@ -234,6 +882,10 @@ class Email(object):
 
     """
 
+    #: The number of characters of the text to encode at once. Longer
+    #: texts are sent chunk by chunk by backends.
+    chunk_size = 1 << 16
+
     subject = Proxy(SafeHeader, '_subject')
     from_addr = Proxy(Address, '_from_addr')
     reply_to = Proxy(Address, '_reply_to')
@@ -248,8 +900,16 @@ class Email(object):
                  from_addr=None,
                  cc=None,
                  bcc=None,
-                 reply_to=None):
+                 reply_to=None,
+                 attachments=None,
+                 html=None):
+        self._fingerprint = self._cache = None
+        self._boundary = self._alternative_boundary = None
+        self.attachments = []
+        for attachment in attachments or ():
+            self.attach(attachment)
         self.text = text
+        self.html = html
         self.subject = subject
         self.from_addr = from_addr
         self.to = to
@@ -260,44 +920,295 @@ class Email(object):
     @property
     def send_to(self):
         """Returns list of unique recipients of the email. List includes direct
-        addressees as well as Cc and Bcc entries.
+        addressees as well as Cc and Bcc entries, in that order.
         """
-        to = map(text_type, self.to)
-        cc = map(text_type, self.cc)
-        bcc = map(text_type, self.bcc)
-        uniq = set(to) | set(cc) | set(bcc)
-        return Addresses(uniq)
+        unique = OrderedDict()
+        for address in list(self.to) + list(self.cc) + list(self.bcc):
+            unique.setdefault(text_type(address), address)
+        return Addresses(list(unique.values()))
+
+    def attach(self, source, filename=None, content_type=None):
+        """Attach the file to the email, see :class:`Attachment`. Returns
+        the attachment.
+        """
+        if not isinstance(source, Attachment):
+            source = Attachment(source, filename, content_type)
+        self.attachments.append(source)
+        return source
+
+    def make_boundary(self, boundary=None):
+        """Returns the *boundary* or a new one if it occurs in the text or
+        HTML of the message.
+        """
+        while boundary is None or boundary in (self.text or '') or \
+                boundary in (self.html or ''):
+            boundary = '===============%019d==' % random.randrange(10 ** 19)
+        return boundary
 
-    def to_message(self):
-        """Returns the email as MIMEText object."""
-        if not self.text or not self.subject or \
+    @property
+    def boundary(self):
+        """The boundary of the attachments multipart."""
+        self._boundary = self.make_boundary(self._boundary)
+        return self._boundary
+
+    @property
+    def alternative_boundary(self):
+        """The boundary of the text and HTML multipart."""
+        self._alternative_boundary = \
+            self.make_boundary(self._alternative_boundary)
+        return self._alternative_boundary
+
+    def text_headers(self, subtype='plain', encoding='8bit'):
+        """Returns the list of the text part headers."""
+        return [
+            ('Content-Type', 'text/%s; charset=utf-8' % subtype),
+            ('Content-Transfer-Encoding', encoding),
+        ]
+
+    def transfer_encoding(self, text, eightbit=True):
+        """Returns the transfer encoding of the text, see
+        :func:`transfer_encoding`.
+
+        :param text: The text of the message part.
+        :param eightbit: The server accepts 8-bit data (8BITMIME extension).
+        """
+        if eightbit:
+            return '8bit'
+        if len(text) > self.chunk_size:
+            # Do not keep long texts alive in the cache.
+            return transfer_encoding(iter_text(text, self.chunk_size))
+        return body_cache.get(('encoding', text),
+                              lambda: transfer_encoding([utf8(text)]))
+
+    def body(self, eightbit=True):
+        """Returns the MIME tree of the message body as `(headers, content)`
+        pair. The content is the text, the :class:`Attachment` or the
+        `(boundary, parts)` pair of multipart, where each part is the
+        `(headers, content)` pair as well.
+
+        :param eightbit: The server accepts 8-bit data, otherwise non-ascii
+                         texts are encoded with quoted-printable or base64.
+        """
+        parts = []
+        for subtype, text in (('plain', self.text), ('html', self.html)):
+            if text:
+                parts.append((self.text_headers(
+                    subtype, self.transfer_encoding(text, eightbit)), text))
+        if len(parts) > 1:
+            boundary = self.alternative_boundary
+            parts = [([('Content-Type', 'multipart/alternative; '
+                                        'boundary="%s"' % boundary)],
+                      (boundary, parts))]
+        if self.attachments:
+            boundary = self.boundary
+            parts = [([('Content-Type', 'multipart/mixed; '
+                                        'boundary="%s"' % boundary)],
+                      (boundary, parts + [(x.headers(), x)
+                                          for x in self.attachments]))]
+        return parts[0]
+
+    def headers(self, eightbit=True, smtputf8=False):
+        """Returns the list of message headers as `(name, value)` pairs.
+
+        :param eightbit: The server accepts 8-bit data, see :meth:`body`.
+        :param smtputf8: Keep non-ascii addresses and subject as is, the
+                         server should support SMTPUTF8 extension.
+        """
+        if not (self.text or self.html) or not self.subject or \
            not self.to or not self.from_addr:
             raise ValueError('Fill in mailing parameters first')
 
-        msg = MIMEText(utf8(self.text))
+        headers = [
+            ('MIME-Version', '1.0'),
+            ('From', self.from_addr.format(smtputf8)),
+            ('To', self.to.format(smtputf8)),
+            ('Subject', self.subject.format(smtputf8)),
+        ]
+        headers.extend(self.body(eightbit)[0])
+
+        if self.cc:
+            headers.append(('Cc', self.cc.format(smtputf8)))
+
+        if self.reply_to:
+            headers.append(('Reply-To', self.reply_to.format(smtputf8)))
+
+        return headers
+
+    @property
+    def international(self):
+        """Check that the message has non-ascii addresses or subject, which
+        could be sent as is to the server supporting SMTPUTF8 extension.
+        """
+        return any(contains_nonascii_characters(x.format(smtputf8=True))
+                   for x in (self.subject, self.from_addr, self.to,
+                             self.cc, self.bcc, self.reply_to) if x)
+
+    def envelope(self, smtputf8=False):
+        """Returns the sender and the list of unique recipients to use in
+        SMTP envelope.
+
+        :param smtputf8: Keep non-ascii addresses as is.
+        """
+        recipients = OrderedDict.fromkeys(
+            x.format(smtputf8) for x in list(self.to) + list(self.cc) +
+            list(self.bcc))
+        return self.from_addr.format(smtputf8), list(recipients)
+
+    def to_message(self):
+        """Returns the email as MIMEText object, or as parsed message if it
+        has HTML or attachments.
+        """
+        if self.attachments or self.html:
+            return message_from_string(native_string(self.serialize(b'\n')))
+
+        headers = self.headers()
+        msg = MIMEText('')
 
         # really MIMEText is sucks, it does not override values on setitem,
         # it appends them. Remove some predefined fields
         del msg['Content-Type']
         del msg['Content-Transfer-Encoding']
 
-        msg['From'] = text_type(self.from_addr)
-        msg['To'] = text_type(self.to)
-        msg['Subject'] = text_type(self.subject)
-        msg['Content-Type'] = 'text/plain; charset=utf-8'
-        msg['Content-Transfer-Encoding'] = '8bit'
+        # Set payload as is, MIMEText encodes non-ascii text on python 3.
+        msg.set_payload(native_string(self.text))
 
-        if self.cc:
-            msg['Cc'] = text_type(self.cc)
-
-        if self.reply_to:
-            msg['Reply-To'] = text_type(self.reply_to)
+        for name, value in headers[1:]:
+            msg[name] = value
 
         return msg
 
+    def fingerprint(self):
+        """Returns the values the formatted message depends on. Any change
+        of message text or headers, including in-place changes of address
+        lists, results in another fingerprint.
+        """
+        return (self.text, self.html, tuple(self.attachments)) + tuple(
+            text_type(x) if x else '' for x in (
+                self.subject, self.from_addr, self.to, self.cc,
+                self.reply_to))
+
+    def cached(self, key, build):
+        """Returns the cached serialized message, build it if message has
+        been changed since the last call. Messages with attachments are not
+        cached, attached files could be large or change.
+
+        :param key: The kind of serialized message.
+        :param build: The callable to serialize the message.
+        """
+        fingerprint = self.fingerprint()
+        if self._fingerprint != fingerprint:
+            self._fingerprint, self._cache = fingerprint, {}
+        if key in self._cache:
+            return self._cache[key]
+
+        if has_receivers(message_built):
+            start = default_timer()
+            value = build()
+            message_built.send(self, kind=key,
+                               duration=default_timer() - start,
+                               size=len(value))
+        else:
+            value = build()
+        if not self.attachments:
+            self._cache[key] = value
+        return value
+
+    @property
+    def streamed(self):
+        """Check that the message is large enough to send it chunk by chunk
+        (see :meth:`iter_wire`) instead of serialize it at once.
+        """
+        return bool(self.attachments) or \
+            max(len(self.text or ''), len(self.html or '')) > self.chunk_size
+
+    def iter_bytes(self, sep=b'\r\n', escape=False, eightbit=True,
+                   smtputf8=False):
+        """Serialize the message into bytes chunk by chunk. Text and HTML
+        are encoded when the message is serialized, the encoded ones are
+        reused by messages with the same text. Long texts are encoded in
+        slices of *chunk_size* characters, attached files are read and
+        encoded lazily.
+
+        :param sep: The line separator.
+        :param escape: Escape leading dots as SMTP DATA command requires.
+        :param eightbit: The server accepts 8-bit data, see :meth:`body`.
+        :param smtputf8: The server supports SMTPUTF8, see :meth:`headers`.
+        """
+        text_sep = sep.decode('ascii')
+
+        def format_headers(headers):
+            return text_sep.join(fold_header('%s: %s' % header, text_sep)
+                                 for header in headers).encode('utf-8')
+
+        def content(headers, value):
+            if isinstance(value, Attachment):
+                return value.encode(sep)
+            if isinstance(value, tuple):
+                return multipart(*value)
+            return encode_text(value, sep, escape, self.chunk_size,
+                               dict(headers)['Content-Transfer-Encoding'])
+
+        def multipart(boundary, parts):
+            delimiter = b'--' + boundary.encode('ascii')
+            for headers, value in parts:
+                yield b''.join((delimiter, sep, format_headers(headers),
+                                sep, sep))
+                for chunk in content(headers, value):
+                    yield chunk
+                yield sep
+            yield delimiter + b'--' + sep
+
+        yield format_headers(self.headers(eightbit, smtputf8)) + sep + sep
+        for chunk in content(*self.body(eightbit)):
+            yield chunk
+
+    def serialize(self, sep=b'\r\n', escape=False, eightbit=True,
+                  smtputf8=False):
+        """Serialize the message straight into bytes.
+
+        :param sep: The line separator.
+        :param escape: Escape leading dots as SMTP DATA command requires.
+        :param eightbit: The server accepts 8-bit data, see :meth:`body`.
+        :param smtputf8: The server supports SMTPUTF8, see :meth:`headers`.
+        """
+        return b''.join(self.iter_bytes(sep, escape, eightbit, smtputf8))
+
+    def as_bytes(self, sep=b'\r\n', eightbit=True, smtputf8=False):
+        """Returns the message as bytes. The result is cached until message
+        text or headers are changed.
+        """
+        key = ('bytes', sep) if eightbit and not smtputf8 else \
+            ('bytes', sep, eightbit, smtputf8)
+        return self.cached(key, lambda: self.serialize(
+            sep, eightbit=eightbit, smtputf8=smtputf8))
+
+    def to_wire(self, eightbit=True, smtputf8=False):
+        """Returns the message as bytes ready to send with SMTP DATA command:
+        lines are separated with CRLF and leading dots are escaped. The result
+        is cached until message text or headers are changed.
+
+        :param eightbit: The server accepts 8-bit data, see :meth:`body`.
+        :param smtputf8: The server supports SMTPUTF8, see :meth:`headers`.
+        """
+        key = 'wire' if eightbit and not smtputf8 else \
+            ('wire', eightbit, smtputf8)
+        return self.cached(key, lambda: self.serialize(
+            escape=True, eightbit=eightbit, smtputf8=smtputf8))
+
+    def iter_wire(self, eightbit=True, smtputf8=False):
+        """Returns the message as :meth:`to_wire` does, but as the
+        iterator over chunks. Neither the whole message nor attached files
+        are kept in memory.
+        """
+        return Chunks(lambda: self.iter_bytes(
+            escape=True, eightbit=eightbit, smtputf8=smtputf8))
+
     def format(self, sep='\r\n'):
-        """Format message into a string."""
-        return sep.join(self.to_message().as_string().splitlines())
+        """Format message into a string. The result is cached until message
+        text or headers are changed.
+        """
+        return self.cached(('format', sep), lambda: native_string(
+            self.serialize(sep.encode('ascii'))))
 
     def __str__(self):
         return self.format(sep='\n')
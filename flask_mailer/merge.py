@@ -0,0 +1,251 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import copy
+import re
+from timeit import default_timer
+
+from flask_mailer.compat import text_type
+from flask_mailer.mail import Addresses
+from flask_mailer.mail import SafeHeader
+from flask_mailer.mail import encode_chunks
+from flask_mailer.mail import escape_dots
+from flask_mailer.mail import fold_header
+from flask_mailer.mail import normalize_newlines
+from flask_mailer.mail import transfer_encoding
+from flask_mailer.mail import utf8
+from flask_mailer.signals import has_receivers
+from flask_mailer.signals import merge_row_skipped
+from flask_mailer.signals import message_built
+
+
+#: Matches `{name}` placeholder of the template field.
+PLACEHOLDER_RE = re.compile(r'\{(\w+)\}')
+
+#: The slot of formatted recipient in compiled template.
+TO = ('to',)
+
+#: The slot of formatted subject in compiled template.
+SUBJECT = ('subject',)
+
+#: The slot of the transfer encoding header in compiled template.
+ENCODING = ('encoding',)
+
+
+def split_fields(text, fields):
+    """Split the text into literal parts and names of the fields. Literal
+    parts are at even positions.
+
+    >>> split_fields('Hello, {name}! {unknown}', ['name'])
+    ['Hello, ', 'name', '! {unknown}']
+
+    :param text: The text with `{name}` placeholders.
+    :param fields: The names of the fields to substitute.
+    """
+    parts, start = [], 0
+    for match in PLACEHOLDER_RE.finditer(text):
+        if match.group(1) in fields:
+            parts.extend((text[start:match.start()], match.group(1)))
+            start = match.end()
+    parts.append(text[start:])
+    return parts
+
+
+def substitute(parts, values, convert=text_type):
+    """Join the parts returned by :func:`split_fields` replacing the field
+    names with their values.
+    """
+    return [part if i % 2 == 0 else convert(values[part])
+            for i, part in enumerate(parts)]
+
+
+class MergedEmail(object):
+    """A message rendered from :class:`Template` for one recipient.
+
+    Provides the same interface as :class:`~flask_mailer.mail.Email` does
+    for backends, but keeps already serialized message as CRLF-separated
+    bytes. The body is sent as 8-bit data, or re-encoded for the server
+    which does not accept it.
+
+    :param head: The pair of encoded headers before and after the transfer
+                 encoding header.
+    :param body: The 8-bit encoded body.
+    """
+
+    def __init__(self, from_addr, to, send_to, head, body, fields,
+                 sep=b'\r\n'):
+        self.from_addr = from_addr
+        self.to = to
+        self.send_to = send_to
+        self.head = head
+        self.body = body
+        self.fields = fields
+        self.sep = sep
+        self.data = self.serialize('8bit', body)
+
+    def serialize(self, encoding, body):
+        before, after = self.head
+        return b''.join((before, b'Content-Transfer-Encoding: ',
+                         encoding.encode('ascii'), self.sep, after, body))
+
+    def as_bytes(self, eightbit=True, smtputf8=False):
+        """Returns the message as bytes.
+
+        :param eightbit: The server accepts 8-bit data, otherwise the body
+                         is encoded with quoted-printable or base64 if
+                         necessary.
+        :param smtputf8: Ignored, the headers are always encoded.
+        """
+        if eightbit:
+            return self.data
+        encoding = transfer_encoding([self.body])
+        body = b''.join(encode_chunks([self.body], self.sep,
+                                      encoding=encoding))
+        return self.serialize(encoding, body)
+
+    def to_wire(self, eightbit=True, smtputf8=False):
+        return escape_dots(self.as_bytes(eightbit))
+
+
+class Template(object):
+    """Email compiled once into pre-encoded byte segments to send it to many
+    recipients (mail merge).
+
+    Rendering the message for a recipient only formats the To header and
+    substitutes `{name}` placeholders of the *fields* in the subject and the
+    text, other headers are encoded once. Rendered message is the same as
+    the template email sent to the recipient would be::
+
+    >>> from flask_mailer.mail import Email
+    >>> template = Template(Email('Hello, {name}', 'Your code is {code}',
+    ...                           'nobody', from_addr='me@example.com'),
+    ...                     fields=['name', 'code'])
+    >>> mail = template.render({'to': 'alice@example.com',
+    ...                         'name': 'Alice', 'code': 42})
+    >>> b'Subject: Hello, Alice' in mail.as_bytes()
+    True
+
+    Cc and Bcc addresses of the template are kept in each message.
+
+    :param email: The template :class:`~flask_mailer.mail.Email`, the
+                  recipients in its To header are ignored.
+    :param fields: The names of the fields to substitute.
+    :param sep: The line separator.
+    """
+
+    def __init__(self, email, fields=(), sep=b'\r\n'):
+        if not email.text:
+            raise ValueError('Text is required in templates')
+        if email.attachments:
+            raise ValueError('Attachments are not supported in templates')
+        if email.html:
+            raise ValueError('HTML is not supported in templates')
+
+        self.fields = frozenset(fields)
+        self.sep = sep
+        self.from_addr = email.from_addr
+        self.copies = [text_type(x) for x in email.cc] + \
+            [text_type(x) for x in email.bcc]
+        self.encoding = email.subject.encoding
+        self.subject = split_fields(''.join(email.subject.value.splitlines()),
+                                    self.fields)
+        #: The number of invalid rows skipped by :meth:`merge`.
+        self.invalid = 0
+
+        text = email.text.replace('\r\n', '\n').replace('\r', '\n')
+        self.body = [self.encode(part) if i % 2 == 0 else part
+                     for i, part in enumerate(split_fields(text,
+                                                           self.fields))]
+
+        # Take the headers from the copy with any recipient, so they are
+        # in the same order as the email has them.
+        email = copy.copy(email)
+        email.to = 'to@localhost'
+        self.parts = []
+        for name, value in email.headers():
+            if name == 'To':
+                self.parts.append(TO)
+            elif name == 'Subject' and len(self.subject) > 1:
+                self.parts.append(SUBJECT)
+            elif name == 'Content-Transfer-Encoding':
+                # Formatted by the message, which could re-encode the body.
+                self.parts.append(ENCODING)
+                continue
+            else:
+                self.parts.append(self.header(name, value))
+            self.parts.append(sep)
+        self.parts.append(sep)
+
+    def header(self, name, value):
+        """Returns the encoded header line."""
+        return fold_header('%s: %s' % (name, value),
+                           self.sep.decode('ascii')).encode('utf-8')
+
+    def encode(self, value):
+        """Returns the encoded value of the field in the text."""
+        return normalize_newlines(utf8(text_type(value)), self.sep)
+
+    def render(self, row):
+        """Returns the :class:`MergedEmail` for the row.
+
+        Raises :class:`ValueError` if the recipient address is invalid or
+        the row misses a field.
+
+        :param row: The recipient address or the dictionary with the
+                    recipient in `to` key and the values of the fields.
+        """
+        if isinstance(row, dict):
+            to, fields = row.get('to'), row
+        else:
+            to, fields = row, {}
+        addresses, invalid = Addresses.validate([to])
+        if invalid:
+            raise ValueError('Invalid address: %r' % (to,))
+        missing = self.fields.difference(fields)
+        if missing:
+            raise ValueError('Missing fields: %s' % ', '.join(sorted(missing)))
+
+        to = text_type(addresses[0])
+        values = {TO: self.header('To', to)}
+        if len(self.subject) > 1:
+            subject = ''.join(substitute(self.subject, fields))
+            values[SUBJECT] = self.header(
+                'Subject', SafeHeader(subject, self.encoding))
+
+        head = [values.get(part, part) if isinstance(part, tuple) else part
+                for part in self.parts]
+        split = head.index(ENCODING)
+        head = (b''.join(head[:split]), b''.join(head[split + 1:]))
+        body = b''.join(substitute(self.body, fields, self.encode))
+        send_to = [to] + [x for x in self.copies if x != to]
+        return MergedEmail(self.from_addr, to, send_to, head, body, fields,
+                           self.sep)
+
+    def merge(self, rows):
+        """Render the message for each row. Rows are consumed lazily, pass
+        the result straight to backend `send_many` method to send messages
+        without keeping them in memory. Invalid rows are skipped, counted
+        in the `invalid` attribute and reported with `merge_row_skipped`
+        signal.
+
+        :param rows: The iterable of rows, see :meth:`render`.
+        """
+        for row in rows:
+            timing = has_receivers(message_built)
+            start = default_timer() if timing else None
+            try:
+                message = self.render(row)
+            except ValueError as e:
+                self.invalid += 1
+                if has_receivers(merge_row_skipped):
+                    merge_row_skipped.send(self, row=row, error=e)
+                continue
+            if timing:
+                message_built.send(self, kind='merge',
+                                   duration=default_timer() - start,
+                                   size=len(message.data))
+            yield message
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
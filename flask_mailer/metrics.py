@@ -0,0 +1,196 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+In-process metrics collected from the extension signals::
+
+    from flask_mailer import metrics
+
+    metrics.enable()
+
+    @app.route('/metrics')
+    def scrape():
+        return metrics.registry.render(), 200, {
+            'Content-Type': 'text/plain; version=0.0.4'}
+
+Collected metrics are exposed in Prometheus text format, or as a plain
+dictionary with :meth:`Registry.snapshot`.
+"""
+import threading
+from bisect import bisect_left
+
+from flask_mailer.signals import message_built
+from flask_mailer.signals import message_sent
+from flask_mailer.signals import smtp_stage
+
+
+#: The default histogram buckets in seconds.
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def format_labels(labels):
+    """Format labels as Prometheus does.
+
+    >>> format_labels((('stage', 'data'),))
+    '{stage="data"}'
+
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % label for label in labels)
+
+
+class Counter(object):
+    """A monotonically increasing value."""
+
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Histogram(object):
+    """Counts observed values in buckets.
+
+    :param buckets: The sorted upper bounds of the buckets.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def snapshot(self):
+        with self.lock:
+            return {'count': sum(self.counts), 'sum': self.sum,
+                    'buckets': dict(zip(self.buckets, self.counts))}
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            yield (name + '_bucket', labels + (('le', bound),), cumulative)
+        yield name + '_sum', labels, total
+        yield name + '_count', labels, cumulative
+
+
+class Registry(object):
+    """Keeps metrics by name and labels."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get(self, factory, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(key, factory())
+        return metric
+
+    def counter(self, name, **labels):
+        """Returns the counter, creates it if necessary."""
+        return self.get(Counter, name, labels)
+
+    def histogram(self, name, **labels):
+        """Returns the histogram, creates it if necessary."""
+        return self.get(Histogram, name, labels)
+
+    def clear(self):
+        with self.lock:
+            self.metrics.clear()
+
+    def items(self):
+        """Returns the list of `((name, labels), metric)` pairs. Metrics
+        could be registered by other threads meanwhile.
+        """
+        with self.lock:
+            return list(self.metrics.items())
+
+    def snapshot(self):
+        """Returns the values of all metrics as dictionary, keys are names
+        with labels as they are rendered.
+        """
+        return dict((name + format_labels(labels), metric.snapshot())
+                    for (name, labels), metric in self.items())
+
+    def render(self):
+        """Returns all metrics in Prometheus text format."""
+        lines = []
+        seen = set()
+        for (name, labels), metric in sorted(self.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE %s %s' % (name, metric.kind))
+            for sample, sample_labels, value in metric.samples(name, labels):
+                lines.append('%s%s %s' % (sample, format_labels(sample_labels),
+                                          value))
+        return '\n'.join(lines) + '\n'
+
+
+#: The default registry.
+registry = Registry()
+
+# Signal receivers by registry id, signals keep references to them.
+_receivers = {}
+
+
+def enable(registry=registry):
+    """Start collecting metrics to the registry."""
+    if id(registry) in _receivers:
+        return
+
+    def on_built(message, kind, duration, size):
+        kind = kind[0] if isinstance(kind, tuple) else kind
+        registry.histogram('mailer_build_seconds', kind=kind).observe(duration)
+
+    def on_stage(backend, stage, duration, error):
+        registry.histogram('mailer_smtp_stage_seconds',
+                           stage=stage).observe(duration)
+        if error is not None:
+            registry.counter('mailer_smtp_errors_total', stage=stage).inc()
+
+    def on_sent(backend, message, size, recipients, refused):
+        registry.counter('mailer_messages_sent_total').inc()
+        registry.counter('mailer_bytes_sent_total').inc(size)
+        registry.counter('mailer_recipients_total').inc(recipients)
+        registry.counter('mailer_recipients_refused_total').inc(refused)
+
+    receivers = {message_built: on_built, smtp_stage: on_stage,
+                 message_sent: on_sent}
+    for signal, receiver in receivers.items():
+        signal.connect(receiver, weak=False)
+    _receivers[id(registry)] = receivers
+
+
+def disable(registry=registry):
+    """Stop collecting metrics to the registry."""
+    receivers = _receivers.pop(id(registry), {})
+    for signal, receiver in receivers.items():
+        signal.disconnect(receiver)
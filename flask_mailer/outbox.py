@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Request-scoped outbox. Mails deferred while handling a request are sent in
+one batch after the response is returned to the client, so the view does
+not wait for SMTP server::
+
+    send_email('Welcome', text, user.email, defer=True)
+
+Send errors are not raised, they are reported with
+:data:`~flask_mailer.signals.deferred_send_failed` signal.
+"""
+from flask import after_this_request
+from flask import g
+from flask import has_request_context
+
+from flask_mailer.signals import deferred_send_failed
+
+
+def defer(backend, message):
+    """Send the message when the response to current request is closed.
+    Outside of request the message is sent immediately.
+
+    :param backend: The backend to send the message with.
+    :param message: The message to send.
+    """
+    if not has_request_context():
+        flush(backend, [message])
+        return
+
+    outbox = getattr(g, '_mailer_outbox', None)
+    if outbox is None:
+        outbox = g._mailer_outbox = []
+
+        @after_this_request
+        def flush_on_close(response):
+            response.call_on_close(lambda: flush(backend, outbox))
+            return response
+
+    outbox.append(message)
+
+
+def flush(backend, messages):
+    """Send the messages in one batch and report failed ones. Returns the
+    list of results as :meth:`send_many` does.
+    """
+    if not messages:
+        return []
+    try:
+        results = backend.send_many(messages)
+    except Exception as e:
+        results = [e] * len(messages)
+
+    for message, error in zip(messages, results):
+        if error is not None:
+            deferred_send_failed.send(backend, message=message, error=error)
+    return results
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import defaultdict
+from email.utils import parseaddr
+
+from flask_mailer.compat import iteritems, text_type
+
+
+def domain_of(address):
+    """Returns the lowercased domain of the email address.
+
+    >>> domain_of('Alice <alice@Example.com>') == 'example.com'
+    True
+
+    """
+    return parseaddr(text_type(address))[1].rpartition('@')[2].lower()
+
+
+class TokenBucket(object):
+    """Token bucket which smooths requests instead of rejecting them.
+
+    Tokens are refilled at *rate* per second up to *burst*. Reserving more
+    tokens than available borrows them from the future and returns the
+    number of seconds to wait, so concurrent callers are spaced out evenly.
+
+    :param rate: The number of tokens per second.
+    :param burst: The bucket capacity, defaults to *rate* but at least one.
+    :param clock: The function which returns current time in seconds.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time):
+        self.rate = float(rate)
+        self.burst = max(burst or rate, 1)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """Take the tokens, returns the number of seconds to wait until
+        they are actually available.
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def full(self):
+        """Check that the bucket has refilled to its capacity, so it is the
+        same as a new one.
+        """
+        with self.lock:
+            return self.tokens + (self.clock() - self.updated) * self.rate \
+                >= self.burst
+
+
+class RateLimiter(object):
+    """Limits the rate of messages and the rate of recipients per domain.
+
+    :param rate: The number of messages per second, `0` means no limit.
+    :param burst: The number of messages could be sent at once.
+    :param domain_rates: The dictionary of recipients per second by domain,
+                         the `*` key sets the limit for each other domain.
+    :param clock: The function which returns current time in seconds.
+    :param sleep: The function which waits given number of seconds.
+    """
+
+    #: The number of domain buckets to keep before the full ones are
+    #: dropped, the limit grows if most of buckets are in use.
+    max_domains = 1024
+
+    def __init__(self, rate=0, burst=None, domain_rates=None,
+                 clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.bucket = TokenBucket(rate, burst, clock) if rate else None
+        self.domain_rates = dict((domain.lower(), value)
+                                 for domain, value in
+                                 iteritems(domain_rates or {}))
+        self.domains = {}
+        self.limit = self.max_domains
+        self.lock = threading.Lock()
+
+    def domain_bucket(self, domain):
+        """Returns the bucket of the domain or `None` if it is not
+        limited.
+        """
+        bucket = self.domains.get(domain)
+        if bucket is None:
+            rate = self.domain_rates.get(domain, self.domain_rates.get('*'))
+            if not rate:
+                return None
+            with self.lock:
+                bucket = self.domains.get(domain)
+                if bucket is None:
+                    if len(self.domains) >= self.limit:
+                        self.prune()
+                    bucket = self.domains[domain] = TokenBucket(
+                        rate, clock=self.clock)
+        return bucket
+
+    def prune(self):
+        """Drop the buckets which have refilled to full capacity, a new
+        bucket is created when the domain is sent to again. Should be
+        called with the lock held.
+        """
+        self.domains = dict((domain, bucket)
+                            for domain, bucket in iteritems(self.domains)
+                            if not bucket.full())
+        self.limit = max(self.max_domains, 2 * len(self.domains))
+
+    def reserve(self, message):
+        """Take the budget for the message, returns the number of seconds
+        to wait before send it.
+        """
+        delay = 0
+        if self.bucket is not None:
+            delay = self.bucket.reserve()
+        if self.domain_rates:
+            recipients = defaultdict(int)
+            for address in message.send_to:
+                recipients[domain_of(address)] += 1
+            for domain, count in iteritems(recipients):
+                bucket = self.domain_bucket(domain)
+                if bucket is not None:
+                    delay = max(delay, bucket.reserve(count))
+        return delay
+
+    def wait(self, message):
+        """Wait until the message could be sent."""
+        delay = self.reserve(message)
+        if delay > 0:
+            self.sleep(delay)
+        return delay
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import random
+import socket
+import threading
+import time
+from smtplib import SMTPException
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPResponseException
+from smtplib import SMTPServerDisconnected
+
+from flask_mailer.signals import circuit_state_changed
+
+
+def is_transient(error):
+    """Check whether the error is temporary and the action could be retried.
+
+    Connection errors and 4xx replies are transient, 5xx replies are
+    permanent.
+
+    :param error: The exception to check. Uses exception stored in `reason`
+                  attribute if present.
+    """
+    error = getattr(error, 'reason', error)
+    if isinstance(error, SMTPRecipientsRefused):
+        return all(400 <= code < 500
+                   for code, _ in error.recipients.values())
+    if isinstance(error, SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return is_disconnected(error)
+
+
+def is_disconnected(error):
+    """Check whether the error means the connection is lost. SMTP errors
+    are socket errors on python 3, but only disconnection and 421 reply,
+    after which the server closes the connection, lose the session.
+    """
+    error = getattr(error, 'reason', error)
+    if isinstance(error, SMTPServerDisconnected):
+        return True
+    if isinstance(error, SMTPResponseException):
+        return error.smtp_code == 421
+    return isinstance(error, socket.error) and \
+        not isinstance(error, SMTPException)
+
+
+def backoff(attempt, base=0.5, cap=30):
+    """Returns jittered exponential delay before the next attempt.
+
+    >>> 0 <= backoff(3, base=1, cap=5) <= 5
+    True
+
+    :param attempt: The number of already failed attempts, starts from zero.
+    :param base: The upper bound of the first delay in seconds.
+    :param cap: The maximum delay in seconds.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    """Fails fast while the server is unhealthy.
+
+    The circuit opens after *threshold* consecutive failures. When *timeout*
+    seconds passed, a single probe is allowed (half-open state): its success
+    closes the circuit, failure opens it again. Each state change sends
+    :data:`~flask_mailer.signals.circuit_state_changed` signal.
+
+    :param threshold: The number of consecutive failures to open the circuit.
+    :param timeout: The number of seconds to wait before the probe.
+    :param name: The name to distinguish breakers in signal receivers.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, timeout=30, name=None):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Check whether the request to the server is allowed."""
+        with self.lock:
+            old = self.state
+            if old == self.OPEN and time.time() - self.opened_at >= self.timeout:
+                self.state = self.HALF_OPEN
+            allowed = old != self.HALF_OPEN and self.state != self.OPEN
+        self.changed(old, self.HALF_OPEN)
+        return allowed
+
+    def success(self):
+        """Record successful request."""
+        with self.lock:
+            old, self.state = self.state, self.CLOSED
+            self.failures = 0
+        self.changed(old, self.CLOSED)
+
+    def failure(self):
+        """Record failed request."""
+        with self.lock:
+            old = self.state
+            self.failures += 1
+            if old == self.HALF_OPEN or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+        self.changed(old, self.OPEN)
+
+    def changed(self, old, new):
+        """Send the signal if the state has been changed to *new* one."""
+        if old != new and self.state == new:
+            circuit_state_changed.send(self, old=old, new=new)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
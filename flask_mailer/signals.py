@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Signals sent by the extension. Requires `blinker` to be installed::
+
+    from flask_mailer.signals import circuit_state_changed
+
+    def log_state(breaker, old, new):
+        log.warning('%s: %s -> %s', breaker.name, old, new)
+
+    circuit_state_changed.connect(log_state)
+
+Timing signals are sent only if they have receivers, so instrumentation costs
+nothing until it is used (see :mod:`flask_mailer.metrics`).
+"""
+from contextlib import contextmanager
+from timeit import default_timer
+
+from flask.signals import Namespace
+
+
+_signals = Namespace()
+
+#: Sent when circuit breaker changes its state, receives the breaker as
+#: sender and `old` and `new` states as keyword arguments.
+circuit_state_changed = _signals.signal('circuit-state-changed')
+
+#: Sent when the message is serialized, receives the message as sender and
+#: `kind` of serialization, `duration` in seconds and `size` in bytes as
+#: keyword arguments. Cached results are not reported.
+message_built = _signals.signal('message-built')
+
+#: Sent when SMTP backend completes one stage of sending: `connect`, `tls`,
+#: `auth`, `envelope` or `data`. Receives the backend as sender and `stage`,
+#: `duration` in seconds and `error` (the exception or `None`) as keyword
+#: arguments.
+smtp_stage = _signals.signal('smtp-stage')
+
+#: Sent when SMTP backend delivers the message, receives the backend as
+#: sender and `message`, `size` of message data in bytes, the number of
+#: `recipients` and the number of `refused` ones as keyword arguments.
+message_sent = _signals.signal('message-sent')
+
+#: Sent when the deferred message could not be sent, receives the backend
+#: as sender and `message` and `error` as keyword arguments.
+deferred_send_failed = _signals.signal('deferred-send-failed')
+
+
+#: Sent when the mail merge skips the invalid row, receives the template
+#: as sender and `row` and `error` as keyword arguments.
+merge_row_skipped = _signals.signal('merge-row-skipped')
+
+
+def has_receivers(signal):
+    """Check that anybody listens to the signal."""
+    return bool(getattr(signal, 'receivers', None))
+
+
+@contextmanager
+def timed(signal, sender, **kwargs):
+    """Measure the duration of the block and send it with the signal.
+
+    Does nothing if the signal has no receivers.
+    """
+    if not has_receivers(signal):
+        yield
+        return
+
+    start = default_timer()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        signal.send(sender, duration=default_timer() - start, error=error,
+                    **kwargs)
@@ -61,6 +61,11 @@ class pytest(Command):
 __version__ = get_version()
 
 
+install_requires = ['Flask']
+if sys.version_info < (3, 2):
+    install_requires.append('futures')
+
+
 setup(
     name='Flask-Mailer',
     version=__version__,
@@ -71,8 +76,8 @@ setup(
     url='https://github.com/vitalk/flask-mailer',
     download_url='https://github.com/vitalk/flask-mailer/tarball/%s' % __version__,
     long_description=__doc__,
-    packages=find_packages(exclude=['tests']),
-    install_requires=['Flask'],
+    packages=find_packages(exclude=['tests', 'benchmarks', 'benchmarks.*']),
+    install_requires=install_requires,
     tests_require=['pytest', 'pytest-cov'],
     cmdclass={'test': pytest},
     zip_safe=False,
@@ -5,6 +5,8 @@ import pytest
 from flask import Flask
 from flask_mailer.util import key
 
+from .server import SMTPServer
+
 
 def create_app(**options):
     """Create a Flask instance. Converts option keys to upper case.
@@ -47,3 +49,11 @@ def app(request):
             app.config[key(name)] = value
 
     return app
+
+
+@pytest.fixture
+def smtpd(request):
+    """Start in-process SMTP server for the duration of a test."""
+    server = SMTPServer().start()
+    request.addfinalizer(server.stop)
+    return server
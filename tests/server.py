@@ -0,0 +1,11 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+The SMTP server used by the tests. It is shared with the load generator
+and lives in the `benchmarks` package, which is not installed, so the
+tests run from the source tree only.
+"""
+from benchmarks.sink import SMTPHandler
+from benchmarks.sink import SMTPServer
+
+__all__ = ('SMTPHandler', 'SMTPServer')
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import sys
+from smtplib import SMTPRecipientsRefused
+
+import pytest
+
+from flask_mailer import Email
+
+from .server import SMTPServer
+from .test_mail import mail
+
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 7),
+                                reason='requires python 3.7 or newer')
+
+
+def run(coroutine):
+    import asyncio
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def server(request):
+    server = SMTPServer(refuse=['bad@example.com'], latency=0.05).start()
+    request.addfinalizer(server.stop)
+    return server
+
+
+@pytest.fixture
+def mailer(server):
+    from flask_mailer.backends.aiosmtp import AsyncSMTPMailer
+    return AsyncSMTPMailer(host=server.host, port=server.port, concurrency=3)
+
+
+def test_send_async(server, mailer, mail):
+    assert run(mailer.send_async(mail)) == {}
+    sender, recipients, data = server.messages[0]
+    assert sender == '<alice@wonderland.com>'
+    assert len(recipients) == 4
+    assert data.endswith(b'without pictures or conversation?\r\n')
+
+
+def test_send_blocking(server, mailer, mail):
+    mailer.send(mail)
+    assert len(server.messages) == 1
+
+
+def test_send_many_async_runs_sessions_concurrently(server, mailer, mail):
+    results = run(mailer.send_many_async([mail] * 6))
+    assert results == [None] * 6
+    assert len(server.messages) == 6
+    assert server.connections == 3
+    assert server.max_active == 3
+    assert server.commands.count('RSET') == 3
+
+
+def test_send_many_async_reports_per_message_results(server, mailer, mail):
+    refused = Email('Subject', 'Text', 'bad@example.com',
+                    from_addr='me@example.com')
+    results = run(mailer.send_many_async(iter([mail, refused, mail])))
+    assert results[0] is None
+    assert isinstance(results[1], SMTPRecipientsRefused)
+    assert results[2] is None
+
+
+def test_send_many_async_reconnects_after_421_reply(request, mail):
+    from flask_mailer.backends.aiosmtp import AsyncSMTPMailer
+    server = SMTPServer(failures=1, failure_reply='421 Closing').start()
+    request.addfinalizer(server.stop)
+    mailer = AsyncSMTPMailer(host=server.host, port=server.port,
+                             concurrency=1)
+    results = run(mailer.send_many_async([mail] * 3))
+    assert results[0].smtp_code == 421
+    assert results[1:] == [None, None]
+    assert server.connections == 2
+
+
+def test_connection_error_raises_runtime_error(mail):
+    from flask_mailer.backends.aiosmtp import AsyncSMTPMailer
+    mailer = AsyncSMTPMailer(host='127.0.0.1', port=1)
+    with pytest.raises(RuntimeError):
+        mailer.send(mail)
+
+
+def test_transfer_encoding_follows_server_extensions(request, mail):
+    from flask_mailer.backends.aiosmtp import AsyncSMTPMailer
+    mail.text = u'Привет, мир!'
+    for extensions, encoding in (((), b'base64'), (['8BITMIME'], b'8bit')):
+        server = SMTPServer(extensions=extensions).start()
+        request.addfinalizer(server.stop)
+        AsyncSMTPMailer(host=server.host, port=server.port).send(mail)
+        _, _, data = server.messages[0]
+        assert b'Content-Transfer-Encoding: ' + encoding in data
+    assert server.params == [['BODY=8BITMIME']]
+
+
+class Writer(object):
+    """Stream writer which records calls."""
+
+    def __init__(self):
+        self.calls = []
+
+    def write(self, data):
+        self.calls.append('write')
+
+    def drain(self):
+        import asyncio
+        self.calls.append('drain')
+        return asyncio.sleep(0)
+
+    def close(self):
+        self.calls.append('close')
+
+    def wait_closed(self):
+        import asyncio
+        self.calls.append('wait_closed')
+        return asyncio.sleep(0)
+
+
+def test_session_waits_for_writes_and_close():
+    from flask_mailer.backends.aiosmtp import AsyncSMTP
+    session = AsyncSMTP(None, Writer())
+    run(session.write(b'data'))
+    run(session.close())
+    assert session.writer.calls == ['write', 'drain', 'close', 'wait_closed']
+
+
+def test_send_large_message(server, mailer, mail):
+    mail.text = ('x' * 70 + '\n') * 100000
+    run(mailer.send_async(mail))
+    _, _, data = server.messages[0]
+    assert data == mail.as_bytes(eightbit=False)
@@ -1,12 +1,25 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+import io
+import os
+import socket
+from email import message_from_string
+import threading
+import time
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPResponseException
+from smtplib import SMTPSenderRefused
+
 import pytest
 
-from flask_mailer.compat import text_type
+from flask_mailer import Email
+from flask_mailer.compat import native_string, text_type
 from flask_mailer.backends.base import Mailer
 from flask_mailer.backends.smtp import SMTPMailer
+from flask_mailer.backends.smtp import refusals
 from flask_mailer.backends.dummy import DummyMailer
 
+from .server import SMTPServer
 from .test_mail import mail
 
 
@@ -35,11 +48,21 @@ def test_base_mailer_does_not_implement_send_quiet_method(base):
         base.send_quiet(None)
 
 
+def test_base_mailer_send_many_returns_errors(base):
+    results = base.send_many([None, None])
+    assert [type(x) for x in results] == [NotImplementedError] * 2
+
+
 def test_dummy_mailer_push_send_messages_into_outbox(dummy, mail):
     dummy.send(mail)
     assert dummy.outbox == [mail,]
 
 
+def test_dummy_mailer_send_many(dummy, mail):
+    assert dummy.send_many(iter([mail, mail])) == [None, None]
+    assert dummy.outbox == [mail, mail]
+
+
 def test_smtp_missed_password(recwarn):
     smtp = SMTPMailer(username='me')
     w = recwarn.pop()
@@ -76,3 +99,514 @@ def test_smtp_raises_error_on_send_if_no_smtp_server_is_available(smtp, mail):
 
 def test_smtp_swallow_errors_on_send_quiet(smtp, mail):
     smtp.send_quiet(mail)
+
+
+@pytest.fixture
+def pooled(smtpd):
+    return SMTPMailer(host=smtpd.host, port=smtpd.port, pool_size=2)
+
+
+def test_smtp_sends_message_to_server(smtpd, mail):
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port)
+    smtp.send(mail)
+    smtp.send(mail)
+    assert len(smtpd.messages) == 2
+    assert smtpd.connections == 2
+
+
+def test_smtp_pool_reuses_connection_across_sends(smtpd, pooled, mail):
+    for _ in range(3):
+        pooled.send(mail)
+    assert len(smtpd.messages) == 3
+    assert smtpd.connections == 1
+    assert len(pooled.pool) == 1
+
+
+def test_smtp_pool_checks_connection_before_reuse(smtpd, pooled, mail):
+    pooled.send(mail)
+    pooled.send(mail)
+    assert smtpd.commands.count('NOOP') == 1
+
+
+def test_smtp_pool_replaces_dropped_connection(smtpd, pooled, mail):
+    pooled.send(mail)
+    for _, connection in pooled.pool.idle:
+        connection.sock.shutdown(socket.SHUT_RDWR)
+    pooled.send(mail)
+    assert len(smtpd.messages) == 2
+    assert smtpd.connections == 2
+
+
+def test_smtp_pool_evicts_idle_connections(smtpd, mail):
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port,
+                      pool_size=1, pool_timeout=-1)
+    smtp.send(mail)
+    smtp.send(mail)
+    assert smtpd.connections == 2
+    assert 'NOOP' not in smtpd.commands
+
+
+def test_smtp_pool_size_limits_open_connections(smtpd, pooled):
+    connections = [pooled.pool.acquire() for _ in range(2)]
+    with pytest.raises(RuntimeError):
+        pooled.pool.acquire(wait=0.05)
+    for connection in connections:
+        pooled.pool.release(connection)
+    assert len(pooled.pool) == 2
+    assert smtpd.connections == 2
+    pooled.pool.clear()
+    assert len(pooled.pool) == 0
+
+
+def test_smtp_pool_waits_for_released_connection(smtpd, pooled):
+    connections = [pooled.pool.acquire() for _ in range(2)]
+    timer = threading.Timer(0.05, pooled.pool.release, [connections[0]])
+    timer.start()
+    assert pooled.pool.acquire(wait=5) is connections[0]
+    timer.join()
+
+
+def test_smtp_pool_frees_place_of_failed_connection(smtpd, mail):
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port, pool_size=1,
+                      pool_wait=0)
+    bad = Email('Subject', 'Text', 'to@example.com')
+    for _ in range(3):
+        with pytest.raises(Exception):
+            smtp.send(bad)
+    smtp.send(mail)
+    assert smtp.pool.active == 0
+
+
+def test_smtp_send_many_reuses_single_session(smtpd, mail):
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port)
+    assert smtp.send_many([mail] * 3) == [None] * 3
+    assert len(smtpd.messages) == 3
+    assert smtpd.connections == 1
+    assert smtpd.commands.count('RSET') == 2
+
+
+def test_smtp_send_many_reports_per_message_results(request, mail):
+    smtpd = SMTPServer(refuse=['bad@example.com']).start()
+    request.addfinalizer(smtpd.stop)
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port)
+
+    partial = Email('Subject', 'Text', ['bad@example.com', 'to@example.com'],
+                    from_addr='me@example.com')
+    refused = Email('Subject', 'Text', 'bad@example.com',
+                    from_addr='me@example.com')
+    results = smtp.send_many([mail, partial, refused, mail])
+
+    assert results[0] is None
+    assert isinstance(results[1], SMTPRecipientsRefused)
+    assert list(results[1].recipients) == ['bad@example.com']
+    assert isinstance(results[2], SMTPRecipientsRefused)
+    assert results[3] is None
+    assert len(smtpd.messages) == 3
+
+
+def test_smtp_send_many_reconnects_after_421_reply(request, mail):
+    smtpd = SMTPServer(failures=1, failure_reply='421 Closing').start()
+    request.addfinalizer(smtpd.stop)
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port)
+    results = smtp.send_many([mail] * 3)
+    assert isinstance(results[0], SMTPResponseException)
+    assert results[0].smtp_code == 421
+    assert results[1:] == [None, None]
+    assert len(smtpd.messages) == 2
+    assert smtpd.connections == 2
+
+
+def test_smtp_send_many_keeps_results_when_reconnect_fails(request, mail):
+    class Mailer(SMTPMailer):
+        connects = 0
+
+        def connect(self):
+            self.connects += 1
+            if self.connects == 2:
+                raise RuntimeError('Connection refused')
+            return super(Mailer, self).connect()
+
+    smtpd = SMTPServer(failures=1, failure_reply='421 Closing').start()
+    request.addfinalizer(smtpd.stop)
+    smtp = Mailer(host=smtpd.host, port=smtpd.port)
+    results = smtp.send_many([mail])
+    # Does not reconnect after the last message.
+    assert results[0].smtp_code == 421
+    assert smtp.connects == 1
+
+    smtpd.failures = 1
+    smtp.connects = 0
+    results = smtp.send_many([mail] * 3)
+    assert results[0].smtp_code == 421
+    assert isinstance(results[1], RuntimeError)
+    assert results[2] is None
+    assert smtp.connects == 3
+
+
+def test_smtp_send_delivers_to_every_recipient(smtpd, mail):
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port)
+    smtp.send(mail)
+    _, recipients, _ = smtpd.messages[0]
+    assert len(recipients) == len(mail.send_to)
+
+
+def test_smtp_sends_serialized_message(smtpd, mail):
+    mail.text = '.leading dot\nand newline'
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port)
+    smtp.send(mail)
+    _, _, data = smtpd.messages[0]
+    assert data == mail.as_bytes(eightbit=False) + b'\r\n'
+
+
+@pytest.fixture
+def esmtpd(request):
+    """SMTP server which advertises PIPELINING and CHUNKING extensions."""
+    smtpd = SMTPServer(extensions=['PIPELINING', 'CHUNKING'],
+                       refuse=['bad@example.com']).start()
+    request.addfinalizer(smtpd.stop)
+    return smtpd
+
+
+@pytest.fixture
+def crowd():
+    return Email('Subject', 'Text',
+                 ['to%d@example.com' % i for i in range(50)],
+                 from_addr='me@example.com')
+
+
+def test_smtp_sends_envelope_in_lockstep_without_pipelining(smtpd, crowd):
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port)
+    smtp.send(crowd)
+    assert len(smtpd.messages) == 1
+    assert smtpd.pipelined == 0
+    assert smtpd.round_trips > 50
+
+
+def test_smtp_pipelines_envelope(esmtpd, crowd):
+    smtp = SMTPMailer(host=esmtpd.host, port=esmtpd.port)
+    smtp.send(crowd)
+    _, recipients, _ = esmtpd.messages[0]
+    assert len(recipients) == 50
+    assert esmtpd.pipelined >= 50
+    assert esmtpd.round_trips < 10
+
+
+def test_smtp_server_rejects_unadvertised_pipelining(smtpd):
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port)
+    connection = smtp.connect()
+    connection.send('mail FROM:<me@example.com>\r\n'
+                    'rcpt TO:<to@example.com>\r\n')
+    assert connection.getreply()[0] == 554
+    assert 'RCPT' not in smtpd.commands
+
+
+def test_smtp_pipelined_partial_refusal(esmtpd):
+    smtp = SMTPMailer(host=esmtpd.host, port=esmtpd.port)
+    mail = Email('Subject', 'Text', ['bad@example.com', 'to@example.com'],
+                 from_addr='me@example.com')
+    refused = smtp.send(mail)
+    assert list(refused) == ['bad@example.com']
+    _, recipients, _ = esmtpd.messages[0]
+    assert recipients == ['<to@example.com>']
+
+
+def test_smtp_pipelined_sender_refusal_keeps_session(request, mail):
+    smtpd = SMTPServer(extensions=['PIPELINING'], failures=1).start()
+    request.addfinalizer(smtpd.stop)
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port)
+
+    results = smtp.send_many([mail, mail])
+    assert isinstance(results[0], SMTPSenderRefused)
+    assert results[1] is None
+    assert len(smtpd.messages) == 1
+    assert smtpd.connections == 1
+
+
+def test_smtp_sends_data_in_chunks(esmtpd, mail):
+    mail.text = '.leading dot\nand newline'
+    smtp = SMTPMailer(host=esmtpd.host, port=esmtpd.port)
+    smtp.send(mail)
+    _, _, data = esmtpd.messages[0]
+    assert data == mail.as_bytes(eightbit=False)
+    assert 'BDAT' in esmtpd.commands
+    assert 'DATA' not in esmtpd.commands
+
+
+def test_smtp_chunking_rejected_when_all_recipients_refused(esmtpd):
+    smtp = SMTPMailer(host=esmtpd.host, port=esmtpd.port)
+    mail = Email('Subject', 'Text', 'bad@example.com',
+                 from_addr='me@example.com')
+    with pytest.raises(SMTPRecipientsRefused):
+        smtp.send(mail)
+    assert 'BDAT' not in esmtpd.commands
+
+
+def test_smtp_streams_attachments(request, esmtpd, mail):
+    mail.attach(io.BytesIO(b'\0' * 300000), 'zeros.bin')
+    plain = SMTPServer().start()
+    request.addfinalizer(plain.stop)
+    for smtpd in (plain, esmtpd):
+        smtp = SMTPMailer(host=smtpd.host, port=smtpd.port)
+        smtp.send(mail)
+        _, _, data = smtpd.messages[0]
+        assert data == mail.as_bytes(eightbit=False)
+    # Pipelined chunks of the message and the last empty one.
+    assert esmtpd.commands.count('BDAT') > 3
+    assert 'DATA' not in esmtpd.commands
+
+
+def test_smtp_streams_large_message(smtpd, mail):
+    mail.text = '.leading dot\r\nand more text\n' * 10000
+    assert mail.streamed
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port)
+    smtp.send(mail)
+    _, _, data = smtpd.messages[0]
+    assert data == mail.as_bytes(eightbit=False)
+
+
+def parse(data):
+    return message_from_string(native_string(data))
+
+
+def test_smtp_encodes_text_for_7bit_server(smtpd, mail):
+    mail.text = u'Привет, мир!\n.'
+    mail.html = u'<p>Café au lait</p>'
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port)
+    smtp.send(mail)
+    _, _, data = smtpd.messages[0]
+    text, html = parse(data).get_payload()
+    assert text['Content-Transfer-Encoding'] == 'base64'
+    assert text.get_payload(decode=True) == u'Привет, мир!\r\n.'.encode(
+        'utf-8')
+    assert html['Content-Transfer-Encoding'] == 'quoted-printable'
+    assert html.get_payload(decode=True) == u'<p>Café au lait</p>'.encode(
+        'utf-8')
+    assert smtpd.params == [[]]
+
+
+def test_smtp_sends_8bit_data_to_8bitmime_server(mail):
+    mail.text = u'Привет, мир!'
+    for extensions in (['8BITMIME'], ['8BITMIME', 'PIPELINING', 'CHUNKING']):
+        smtpd = SMTPServer(extensions=extensions).start()
+        try:
+            SMTPMailer(host=smtpd.host, port=smtpd.port).send(mail)
+        finally:
+            smtpd.stop()
+        _, _, data = smtpd.messages[0]
+        assert data.rstrip(b'\r\n') == mail.as_bytes()
+        assert smtpd.params == [['BODY=8BITMIME']]
+
+
+def test_smtp_sends_international_addresses_as_is(request, mail):
+    mail.to = (u'Алиса', u'алиса@пример.рф')
+    mail.cc = mail.bcc = None
+    mail.subject = u'Привет'
+    plain = SMTPServer(extensions=['8BITMIME']).start()
+    request.addfinalizer(plain.stop)
+    utf8 = SMTPServer(extensions=['8BITMIME', 'SMTPUTF8',
+                                  'PIPELINING']).start()
+    request.addfinalizer(utf8.stop)
+
+    SMTPMailer(host=utf8.host, port=utf8.port).send(mail)
+    _, recipients, data = utf8.messages[0]
+    assert recipients == [u'<алиса@пример.рф>']
+    assert utf8.params == [['BODY=8BITMIME', 'SMTPUTF8']]
+    assert u'To: Алиса <алиса@пример.рф>\r\nSubject: Привет\r\n'.encode(
+        'utf-8') in data
+
+    SMTPMailer(host=plain.host, port=plain.port).send(mail)
+    _, recipients, data = plain.messages[0]
+    assert recipients[0].endswith('@xn--e1afmkfd.xn--p1ai>')
+    assert b'Subject: =?utf-8?' in data
+
+
+def run_threads(target, count):
+    threads = [threading.Thread(target=target, args=(n,))
+               for n in range(count)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start
+
+
+@pytest.mark.parametrize('pool_size', [0, 4])
+def test_smtp_concurrent_sends_do_not_cross_talk(request, pool_size):
+    smtpd = SMTPServer(latency=0.02).start()
+    request.addfinalizer(smtpd.stop)
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port, pool_size=pool_size)
+    threads, count = 4, 5
+    errors = []
+
+    def send(n, i):
+        to = 'thread%d-%d@example.com' % (n, i)
+        smtp.send(Email('Subject %s' % to, 'Text %s' % to, to,
+                        from_addr='me@example.com'))
+
+    def worker(n):
+        for i in range(count):
+            try:
+                send(n, i)
+            except Exception as e:
+                errors.append(e)
+
+    concurrent = run_threads(worker, threads)
+    assert errors == []
+    assert len(smtpd.messages) == threads * count
+    for _, recipients, data in smtpd.messages:
+        to = recipients[0].strip('<>')
+        assert ('Subject: Subject %s' % to).encode('ascii') in data
+        assert data.endswith(('Text %s\r\n' % to).encode('ascii'))
+
+    start = time.time()
+    for n in range(threads):
+        for i in range(count):
+            send(n, i)
+    serialized = time.time() - start
+    assert concurrent < serialized / 2
+
+
+def test_smtp_pool_returns_thread_own_connection(smtpd, pooled):
+    first, second = pooled.pool.acquire(), pooled.pool.acquire()
+    pooled.pool.release(first)
+    released, proceed = threading.Event(), threading.Event()
+    acquired = []
+
+    def worker():
+        pooled.pool.release(second)
+        released.set()
+        proceed.wait(5)
+        acquired.append(pooled.pool.acquire())
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    released.wait(5)
+    # The second connection is released last, but the first one is ours.
+    assert pooled.pool.acquire() is first
+    proceed.set()
+    thread.join()
+    assert acquired == [second]
+    assert smtpd.connections == 2
+
+
+def recipients_of(smtpd):
+    return sorted(len(recipients) for _, recipients, _ in smtpd.messages)
+
+
+def test_smtp_splits_recipients_by_server_limit(request, crowd):
+    smtpd = SMTPServer(max_recipients=20).start()
+    request.addfinalizer(smtpd.stop)
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port, max_recipients=0)
+    assert len(smtp.send(crowd)) == 30
+
+    smtpd.messages = []
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port, max_recipients=20)
+    assert smtp.send(crowd) == {}
+    assert recipients_of(smtpd) == [10, 20, 20]
+    assert smtpd.connections == 2
+
+
+def test_smtp_splits_recipients_by_advertised_limit(request, crowd):
+    smtpd = SMTPServer(extensions=['PIPELINING', 'LIMITS RCPTMAX=15'],
+                       max_recipients=15).start()
+    request.addfinalizer(smtpd.stop)
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port)
+    assert smtp.send(crowd) == {}
+    assert recipients_of(smtpd) == [5, 15, 15, 15]
+
+
+def test_smtp_fans_out_chunks_over_connections(request, crowd):
+    smtpd = SMTPServer(latency=0.05).start()
+    request.addfinalizer(smtpd.stop)
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port, pool_size=4,
+                      max_recipients=10, fanout_connections=3)
+    smtp.send(crowd)
+    assert recipients_of(smtpd) == [10] * 5
+    assert smtpd.max_active == 3
+    # Extra connections are returned to the pool.
+    assert len(smtp.pool) == 3
+
+
+def test_smtp_fan_out_sends_every_chunk_when_extra_connect_fails(request,
+                                                                 crowd):
+    class Mailer(SMTPMailer):
+        def acquire(self, wait=None):
+            if wait == 0:
+                # The extra connection fails after the main one has sent
+                # the rest of chunks.
+                time.sleep(0.1)
+                raise socket.error('Connection refused')
+            return super(Mailer, self).acquire(wait)
+
+    crowd.to = crowd.to[:30]
+    smtpd = SMTPServer().start()
+    request.addfinalizer(smtpd.stop)
+    smtp = Mailer(host=smtpd.host, port=smtpd.port, max_recipients=10,
+                  fanout_connections=2)
+    assert smtp.send(crowd) == {}
+    assert recipients_of(smtpd) == [10, 10, 10]
+
+
+def test_smtp_fans_out_file_object_attachment(request, crowd):
+    data = os.urandom(300000)
+    crowd.attach(io.BytesIO(data), 'data.bin')
+    smtpd = SMTPServer().start()
+    request.addfinalizer(smtpd.stop)
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port, max_recipients=10,
+                      fanout_connections=5)
+    smtp.send(crowd)
+    assert recipients_of(smtpd) == [10] * 5
+    for _, _, message in smtpd.messages:
+        attachment = parse(message).get_payload()[1]
+        assert attachment.get_payload(decode=True) == data
+
+
+def test_smtp_fan_out_merges_refused_recipients(request, crowd):
+    recipients = [text_type(x) for x in crowd.send_to]
+    smtpd = SMTPServer(refuse=[recipients[-1]], failures=1).start()
+    request.addfinalizer(smtpd.stop)
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port, max_recipients=10)
+    refused = smtp.send(crowd)
+    # The first chunk is rejected with 451 reply, another one partially.
+    assert len(refused) == 11
+    assert refused[recipients[0]][0] == 451
+    assert refused[recipients[-1]][0] == 550
+    assert recipients_of(smtpd) == [9, 10, 10, 10]
+
+
+def test_smtp_fan_out_reconnects_after_421_reply(request, crowd):
+    recipients = [text_type(x) for x in crowd.send_to]
+    smtpd = SMTPServer(failures=1, failure_reply='421 Closing').start()
+    request.addfinalizer(smtpd.stop)
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port, max_recipients=10,
+                      fanout_connections=1)
+    refused = smtp.send(crowd)
+    assert len(refused) == 10
+    assert refused[recipients[0]][0] == 421
+    assert recipients_of(smtpd) == [10, 10, 10, 10]
+    assert smtpd.connections == 2
+
+
+def test_smtp_fan_out_raises_when_all_recipients_refused(request, crowd):
+    smtpd = SMTPServer(refuse=crowd.send_to).start()
+    request.addfinalizer(smtpd.stop)
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port, max_recipients=10,
+                      fanout_connections=2)
+    with pytest.raises(SMTPRecipientsRefused) as error:
+        smtp.send(crowd)
+    assert len(error.value.recipients) == 50
+
+
+def test_smtp_invalid_fanout_connections():
+    with pytest.raises(ValueError):
+        SMTPMailer(fanout_connections=0)
+
+
+def test_smtp_refusals_of_failed_transaction():
+    refused = refusals(['a@example.com'], socket.error('Connection reset'))
+    assert refused['a@example.com'][0] == 421
+    refused = refusals(['a@example.com', 'b@example.com'],
+                       SMTPSenderRefused(550, b'Denied', 'me@example.com'))
+    assert refused == {'a@example.com': (550, b'Denied'),
+                       'b@example.com': (550, b'Denied')}
@@ -1,13 +1,29 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+import base64
+import io
+from email import message_from_string
+import os
+import random
+
 import pytest
 
 from flask_mailer import Email
+from flask_mailer import Mailer
+from flask_mailer import mail as mail_module
 from flask_mailer.mail import Proxy
 from flask_mailer.mail import Address
+from flask_mailer.mail import Attachment
+from flask_mailer.mail import body_cache
 from flask_mailer.mail import Addresses
+from flask_mailer.mail import LRUCache
 from flask_mailer.mail import SafeHeader
-from flask_mailer.compat import text_type
+from flask_mailer.mail import encode_text
+from flask_mailer.mail import escape_dots
+from flask_mailer.mail import normalize_chunks
+from flask_mailer.mail import normalize_newlines
+from flask_mailer.mail import transfer_encoding
+from flask_mailer.compat import native_string, text_type
 
 
 @pytest.fixture(params=[None, ''])
@@ -76,6 +92,16 @@ class TestAddress:
         addr = Address((u'Álice', u'alice@example.com'))
         assert text_type(addr) == '=?utf-8?b?w4FsaWNl?= <alice@example.com>'
 
+    def test_cache_formatted_address(self, alice, monkeypatch):
+        assert text_type(alice) == 'alice@example.com'
+        monkeypatch.setattr('flask_mailer.mail.sanitize_address', None)
+        assert text_type(alice) == 'alice@example.com'
+
+    def test_reset_cache_on_assign(self, alice):
+        assert text_type(alice) == 'alice@example.com'
+        alice.address = ('Alice', 'alice@example.com')
+        assert text_type(alice) == 'Alice <alice@example.com>'
+
     def test_strip_newlines_from_address(self):
         addr = Address(('Alice\n', 'alice\r\n@example.com\r'))
         assert text_type(addr) == 'Alice <alice@example.com>'
@@ -127,6 +153,51 @@ class TestAddresses(object):
         assert text_type(self.addresses) == 'Alice <alice@example.com>'
 
 
+class TestAddressesFromIterable:
+
+    def test_plain_addresses(self):
+        values = ['alice@example.com', 'bob@example.com']
+        addresses = Addresses.from_iterable(iter(values))
+        assert isinstance(addresses, Addresses)
+        assert addresses == values
+        assert addresses.invalid == []
+
+    def test_mixed_values(self, alice):
+        addresses = Addresses.from_iterable([
+            ' bob@example.com\n',
+            ('Carol', 'carol@example.com'),
+            'Dave <dave@example.com>',
+            alice,
+        ])
+        assert text_type(addresses) == (
+            'bob@example.com, Carol <carol@example.com>, '
+            'Dave <dave@example.com>, alice@example.com')
+
+    def test_nonascii_addresses_are_sanitized(self):
+        addresses = Addresses.from_iterable([u'alice@exämple.com',
+                                             'bob@example.com'])
+        assert text_type(addresses) == \
+            'alice@xn--exmple-cua.com, bob@example.com'
+
+    def test_collects_invalid_values(self):
+        values = ['alice@example.com', 'bob', 'a b@example.com',
+                  'x@y\nBcc: z@example.com', ('Eve', None), 42, '']
+        addresses = Addresses.from_iterable(values)
+        assert addresses == ['alice@example.com']
+        assert addresses.invalid == values[1:]
+
+    def test_strict_raises_on_invalid_values(self):
+        with pytest.raises(ValueError) as e:
+            Addresses.from_iterable(['alice@example.com', 'bob', 'eve'],
+                                    strict=True)
+        assert 'Invalid addresses (2)' in str(e.value)
+
+    def test_matches_per_item_path(self):
+        values = ['user%d@example.com' % i for i in range(100)]
+        assert text_type(Addresses.from_iterable(values)) == \
+            text_type(Addresses(values))
+
+
 class TestSafeHeader(object):
 
     subject = Proxy(SafeHeader, '_subject')
@@ -244,7 +315,16 @@ class TestMail:
 
     def test_add_destination_address_to_mail(self, mail):
         mail.to.append('hatter@wonderland.com')
-        assert mail.send_to == ['bcc@example.com', 'hatter@wonderland.com', 'cc@example.com', 'one@example.com', 'two@example.com']
+        assert mail.send_to == ['one@example.com', 'two@example.com',
+                                'hatter@wonderland.com', 'cc@example.com',
+                                'bcc@example.com']
+
+    def test_recipient_list_reuses_addresses(self, mail):
+        mail.cc.append(mail.to[0])
+        send_to = mail.send_to
+        assert send_to[0] is mail.to[0]
+        assert send_to[-1] is mail.bcc[0]
+        assert len(send_to) == 4
 
     def test_raises_error_if_mailing_parameters_is_blank(self):
         mail = Email()
@@ -286,3 +366,408 @@ Cc: cc@example.com
 Reply-To: noreply@wonderland.com
 
 What is the use of a book without pictures or conversation?'''
+
+    def test_mail_to_wire(self, mail):
+        mail.text = '.leading dot\nbare newline\rand\r\n.another dot'
+        wire = mail.to_wire()
+        assert wire.startswith(b'MIME-Version: 1.0\r\nFrom: ')
+        assert wire.endswith(b'\r\n\r\n..leading dot\r\nbare newline\r\n'
+                             b'and\r\n..another dot')
+
+    def test_mail_as_bytes(self, mail):
+        mail.text = u'Привет\n.'
+        assert mail.as_bytes().endswith(u'\r\n\r\nПривет\r\n.'.encode('utf-8'))
+        assert mail.as_bytes(b'\n').endswith(u'\n\nПривет\n.'.encode('utf-8'))
+
+    def test_fold_long_headers(self, mail):
+        mail.to = ['user%d@example.com' % i for i in range(20)]
+        lines = mail.to_wire().split(b'\r\n')
+        assert all(len(line) <= 78 for line in lines)
+        assert lines[2].startswith(b'To: user0@example.com, ')
+        assert lines[3].startswith(b' user')
+        subject = lines.index(b'Subject: Down the Rabbit-Hole')
+        assert lines[subject - 1].endswith(b' user19@example.com')
+
+    def test_format_matches_mimetext(self, mail):
+        message = mail.to_message().as_string()
+        assert text_type(mail) == '\n'.join(message.splitlines())
+
+
+class TestFormatCache:
+
+    def test_format_is_cached(self, mail, monkeypatch):
+        formatted = mail.format()
+        monkeypatch.setattr(Email, 'to_message', None)
+        assert mail.format() is formatted
+
+    def test_reset_cache_on_text_change(self, mail):
+        formatted = mail.format()
+        mail.text = 'Curiouser and curiouser!'
+        assert mail.format() != formatted
+        assert mail.format().endswith('Curiouser and curiouser!')
+
+    def test_reset_cache_on_header_change(self, mail):
+        mail.format()
+        mail.subject = 'Advice from a Caterpillar'
+        assert 'Subject: Advice from a Caterpillar' in mail.format()
+
+    def test_reset_cache_on_address_list_change(self, mail):
+        mail.format()
+        mail.to.append('hatter@wonderland.com')
+        assert 'hatter@wonderland.com' in mail.format()
+
+    def test_reset_cache_on_subject_encoding_change(self):
+        mail = Email(u'Привет', 'Text', 'to@example.com', 'me@example.com')
+        mail.format()
+        mail.subject.encoding = 'cp1251'
+        assert '=?cp1251?b?z/Do4uXy?=' in mail.format()
+
+    def test_cache_depends_on_line_separator(self, mail):
+        assert '\r\n' in mail.format()
+        assert '\r\n' not in mail.format(sep='\n')
+
+
+class TestEncodingCache:
+
+    @pytest.fixture
+    def cache(self, monkeypatch):
+        cache = LRUCache(maxsize=2)
+        monkeypatch.setattr(mail_module, 'encoding_cache', cache)
+        return cache
+
+    def test_evicts_least_recently_used(self, cache):
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        cache.get('a', lambda: None)
+        cache.get('c', lambda: 3)
+        assert list(cache.data) == ['a', 'c']
+        assert cache.stats() == {'hits': 1, 'misses': 3, 'size': 2,
+                                 'maxsize': 2}
+
+    def test_resize(self, cache):
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        cache.resize(1)
+        assert list(cache.data) == ['b']
+
+    def test_does_not_cache_errors(self, cache):
+        def fail():
+            raise UnicodeEncodeError('ascii', u'', 0, 1, 'fail')
+        with pytest.raises(UnicodeEncodeError):
+            cache.get('a', fail)
+        assert cache.get('a', lambda: 1) == 1
+
+    def test_header_is_encoded_once(self, cache):
+        first = text_type(SafeHeader(u'Привет'))
+        assert text_type(SafeHeader(u'Привет')) == first
+        assert cache.stats()['hits'] == 1
+
+    def test_ascii_header_is_not_cached(self, cache):
+        text_type(SafeHeader('Hello'))
+        assert cache.stats()['size'] == 0
+
+    def test_idna_domain_is_cached(self, cache):
+        assert text_type(Address(u'alice@exämple.com')) == \
+            'alice@xn--exmple-cua.com'
+        text_type(Address(u'bob@exämple.com'))
+        assert ('idna', u'exämple.com') in cache.data
+        assert cache.stats()['hits'] == 1
+
+    def test_extension_sets_cache_size(self, request, app):
+        cache = mail_module.encoding_cache
+        request.addfinalizer(lambda: cache.resize(1024))
+        app.config['MAILER_ENCODING_CACHE_SIZE'] = 10
+        Mailer(app)
+        assert cache.maxsize == 10
+
+
+class ShortReads(io.RawIOBase):
+    """Non-seekable stream which returns at most 1000 bytes per read."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        chunk, self.data = self.data[:min(size, 1000)], self.data[1000:]
+        return chunk
+
+
+class TestAttachments:
+
+    @pytest.fixture
+    def data(self):
+        return os.urandom(Attachment.chunk_size * 3 + 100)
+
+    @pytest.fixture
+    def path(self, tmpdir, data):
+        path = tmpdir.join('report.pdf')
+        path.write_binary(data)
+        return str(path)
+
+    def parts(self, mail):
+        message = mail.to_message()
+        assert message.is_multipart()
+        return message.get_payload()
+
+    def test_attach_file_by_path(self, dummy, path, data):
+        dummy.attach(path)
+        text, attachment = self.parts(dummy)
+        assert text.get_payload() == 'Plain text'
+        assert attachment.get_content_type() == 'application/pdf'
+        assert attachment.get_filename() == 'report.pdf'
+        assert attachment.get_payload(decode=True) == data
+
+    def test_attach_file_object(self, dummy, data):
+        source = io.BytesIO(b'skipped' + data)
+        source.seek(7)
+        dummy.attach(source, 'data.bin')
+        assert self.parts(dummy)[1].get_payload(decode=True) == data
+        # The file is read again from the initial position.
+        assert self.parts(dummy)[1].get_payload(decode=True) == data
+
+    def test_attach_stream_with_short_reads(self, dummy, data):
+        dummy.attach(ShortReads(data), 'data.bin', 'application/x-data')
+        wire = dummy.to_wire()
+        attachment = self.parts(dummy)[1]
+        assert attachment.get_content_type() == 'application/x-data'
+        encoded = wire.split(b'\r\n\r\n')[3].split(b'\r\n--')[0]
+        assert base64.b64decode(encoded) == data
+        assert max(len(x) for x in encoded.split(b'\r\n')) == 76
+
+    def test_stream_is_buffered_to_send_again(self, dummy, data):
+        dummy.attach(ShortReads(data), 'data.bin')
+        assert self.parts(dummy)[1].get_payload(decode=True) == data
+        assert self.parts(dummy)[1].get_payload(decode=True) == data
+
+    def test_file_object_is_read_concurrently(self, data):
+        attachment = Attachment(io.BytesIO(data), 'data.bin')
+        first = attachment.read(1000)
+        second = attachment.read(1000)
+        # Interleaved reads do not move the position of each other.
+        chunks = list(zip(first, second))
+        assert b''.join(x for x, _ in chunks) == data
+        assert b''.join(x for _, x in chunks) == data
+
+    def test_nonascii_filename(self, dummy):
+        dummy.attach(io.BytesIO(b'data'), u'отчёт.txt')
+        attachment = self.parts(dummy)[1]
+        assert "filename*=utf-8''%D0%BE" in attachment['Content-Disposition']
+        assert attachment.get_content_type() == 'text/plain'
+
+    def test_filename_is_quoted(self, dummy):
+        dummy.attach(io.BytesIO(b'data'), 'a "quoted"\nname')
+        assert 'filename="a \\"quoted\\"name"' in dummy.format()
+
+    def test_attachments_in_constructor(self, path):
+        mail = Email('Subject', 'Text', 'to@example.com', 'me@example.com',
+                     attachments=[path, Attachment(io.BytesIO(b'data'),
+                                                   'data.txt')])
+        assert [x.filename for x in mail.attachments] == ['report.pdf',
+                                                          'data.txt']
+
+    def test_boundary_does_not_occur_in_text(self, dummy):
+        dummy.attach(io.BytesIO(b'data'), 'data.txt')
+        boundary = dummy.boundary
+        dummy.text = 'Text with %s boundary' % boundary
+        assert dummy.boundary != boundary
+        assert 'boundary="%s"' % dummy.boundary in dummy.format()
+
+    def test_text_lines_are_escaped(self, dummy):
+        dummy.text = '.leading dot'
+        dummy.attach(io.BytesIO(b'data'), 'data.txt')
+        assert b'\r\n\r\n..leading dot\r\n--' in dummy.to_wire()
+        assert dummy.to_wire() == b''.join(dummy.iter_wire())
+
+    def test_message_with_attachments_is_not_cached(self, dummy, path):
+        dummy.attach(path)
+        first = dummy.as_bytes()
+        with open(path, 'wb') as f:
+            f.write(b'changed')
+        assert dummy.as_bytes() != first
+
+    def test_chunks_are_bounded(self, dummy, path):
+        dummy.attach(path)
+        chunks = list(dummy.iter_wire())
+        assert max(len(x) for x in chunks) < Attachment.chunk_size * 2
+
+    def test_memory_is_flat(self, dummy, tmpdir):
+        tracemalloc = pytest.importorskip('tracemalloc')
+        path = tmpdir.join('large.bin')
+        path.write_binary(b'\0' * (8 << 20))
+        dummy.attach(str(path))
+
+        tracemalloc.start()
+        try:
+            size = sum(len(x) for x in dummy.iter_wire())
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert size > 10 << 20
+        assert peak < 1 << 20
+
+
+class TestStreaming:
+
+    def test_normalize_chunks_split_anywhere(self):
+        data = b'.a\r\n.b\rc\n\n.d\r\r\n..e\r'
+        expected = escape_dots(normalize_newlines(data))
+        for size in range(1, len(data) + 1):
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            assert b''.join(normalize_chunks(chunks, escape=True)) == \
+                expected
+
+    def test_normalize_random_chunks(self):
+        data = bytes(bytearray(random.choice(b'.\r\nab')
+                               for _ in range(10000)))
+        cuts = sorted(random.sample(range(len(data)), 500))
+        chunks = [data[i:j] for i, j in zip([0] + cuts, cuts + [None])]
+        assert b''.join(normalize_chunks(chunks, b'\n', escape=True)) == \
+            escape_dots(normalize_newlines(data, b'\n'))
+
+    def test_large_text_is_streamed(self, dummy):
+        assert not dummy.streamed
+        dummy.text = u'.Привет\r\n' * 30000
+        assert dummy.streamed
+        chunks = list(dummy.iter_wire())
+        assert len(chunks) > 5
+        assert max(len(x) for x in chunks) <= Email.chunk_size * 2
+        assert b''.join(chunks) == dummy.serialize(escape=True)
+        assert dummy.to_wire().count(b'\r\n..') == 30000
+
+    def test_memory_is_flat(self, dummy):
+        tracemalloc = pytest.importorskip('tracemalloc')
+        dummy.text = '.leading dot\n' * (1 << 20)
+
+        tracemalloc.start()
+        try:
+            size = sum(len(x) for x in dummy.iter_wire())
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert size > 15 << 20
+        assert peak < 1 << 20
+
+
+class TestHtml:
+
+    @pytest.fixture
+    def html(self):
+        return u'<p>Привет, <b>мир</b></p>'
+
+    def test_text_and_html_are_alternatives(self, dummy, html):
+        dummy.html = html
+        message = dummy.to_message()
+        assert message.get_content_type() == 'multipart/alternative'
+        text, part = message.get_payload()
+        assert text.get_content_type() == 'text/plain'
+        assert text.get_payload() == 'Plain text'
+        assert part.get_content_type() == 'text/html'
+        assert html.encode('utf-8') + b'\r\n--' in dummy.as_bytes()
+
+    def test_html_only(self, dummy, html):
+        dummy.text = None
+        dummy.html = html
+        message = dummy.to_message()
+        assert message.get_content_type() == 'text/html'
+        assert dummy.as_bytes().endswith(b'\r\n\r\n' + html.encode('utf-8'))
+
+    def test_alternatives_with_attachments(self, dummy, html):
+        dummy.html = html
+        dummy.attach(io.BytesIO(b'data'), 'data.txt')
+        message = dummy.to_message()
+        assert message.get_content_type() == 'multipart/mixed'
+        body, attachment = message.get_payload()
+        assert body.get_content_type() == 'multipart/alternative'
+        assert [x.get_content_type() for x in body.get_payload()] == \
+            ['text/plain', 'text/html']
+        assert attachment.get_payload(decode=True) == b'data'
+
+    def test_body_is_encoded_once(self, html):
+        body_cache.clear()
+        messages = [Email('Subject', 'Text', 'to%d@example.com' % n,
+                          from_addr='me@example.com', html=html)
+                    for n in range(10)]
+        for message in messages:
+            message.to_wire()
+        assert body_cache.stats()['misses'] == 2
+        assert body_cache.stats()['hits'] == 18
+
+    def test_large_html_is_streamed(self, dummy):
+        dummy.html = u'<p>.Привет</p>\n' * 10000
+        assert dummy.streamed
+        assert b''.join(dummy.iter_wire()) == dummy.to_wire()
+        assert len(list(dummy.iter_wire())) > 3
+        # Only the short text is kept encoded.
+        body_cache.clear()
+        list(dummy.iter_wire())
+        assert body_cache.stats()['size'] == 1
+
+    def test_nothing_to_send(self, dummy):
+        dummy.text = None
+        with pytest.raises(ValueError):
+            dummy.to_wire()
+
+
+class TestTransferEncoding:
+
+    def test_choose_smaller_encoding(self):
+        assert transfer_encoding([b'Hello,\r\n', b'world=']) == '7bit'
+        assert transfer_encoding([u'Привет'.encode('utf-8')]) == 'base64'
+        assert transfer_encoding([u'Ça va bien'.encode('utf-8')]) == \
+            'quoted-printable'
+
+    def test_long_lines_are_encoded(self):
+        assert transfer_encoding([b'a' * 500, b'a' * 500]) == \
+            'quoted-printable'
+        assert transfer_encoding([b'a' * 500 + b'\n', b'a' * 500]) == '7bit'
+
+    @pytest.mark.parametrize('encoding', ['quoted-printable', 'base64'])
+    def test_encode_text_in_slices(self, encoding):
+        text = u'.Ça va très bien, merci\r\n' * 100 + u'x' * 500
+        expected = b''.join(encode_text(text, escape=True, size=len(text),
+                                        encoding=encoding))
+        for size in (7, 100, 1000):
+            assert b''.join(encode_text(text, escape=True, size=size,
+                                        encoding=encoding)) == expected
+        assert max(len(x) for x in expected.split(b'\r\n')) <= 76
+
+    def test_7bit_message(self, dummy):
+        data = dummy.as_bytes(eightbit=False)
+        assert data == dummy.as_bytes().replace(b'8bit', b'7bit')
+
+    def test_nonascii_message(self, dummy):
+        dummy.text = u'Привет, мир!\n.'
+        message = message_from_string(native_string(
+            dummy.as_bytes(eightbit=False)))
+        assert message['Content-Transfer-Encoding'] == 'base64'
+        assert message.get_payload(decode=True) == \
+            u'Привет, мир!\r\n.'.encode('utf-8')
+
+    def test_long_text_is_not_cached(self, dummy):
+        body_cache.clear()
+        dummy.text = u'Привет\n' * dummy.chunk_size
+        dummy.as_bytes(eightbit=False)
+        assert body_cache.stats()['size'] == 0
+        dummy.text = u'Привет'
+        dummy.as_bytes(eightbit=False)
+        assert body_cache.stats()['size'] == 2
+
+    def test_smtputf8_headers(self, dummy):
+        dummy.subject = u'Привет'
+        dummy.to = (u'Алиса', u'алиса@пример.рф')
+        dummy.cc = ('Bob, Jr.', 'bob@example.com')
+        assert dummy.international
+        headers = dict(dummy.headers(smtputf8=True))
+        assert headers['Subject'] == u'Привет'
+        assert headers['To'] == u'Алиса <алиса@пример.рф>'
+        assert headers['Cc'] == '"Bob, Jr." <bob@example.com>'
+        assert dummy.envelope(smtputf8=True) == (
+            'from@example.com',
+            [u'Алиса <алиса@пример.рф>', '"Bob, Jr." <bob@example.com>'])
+
+    def test_ascii_message_is_not_international(self, dummy):
+        assert not dummy.international
+        assert dummy.as_bytes(smtputf8=True) == dummy.as_bytes()
@@ -0,0 +1,153 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import io
+import itertools
+
+import pytest
+
+from flask_mailer import Email
+from flask_mailer.compat import text_type
+from flask_mailer.backends.smtp import SMTPMailer
+from flask_mailer.merge import SUBJECT
+from flask_mailer.merge import Template
+from flask_mailer.merge import split_fields
+from flask_mailer.signals import merge_row_skipped
+
+from .server import SMTPServer
+
+
+@pytest.fixture
+def email():
+    return Email(u'Привет, {name}', u'Dear {name},\n.your code is {code}\n',
+                 'nobody@example.com', from_addr='me@example.com',
+                 cc='boss@example.com')
+
+
+@pytest.fixture
+def template(email):
+    return Template(email, fields=['name', 'code'])
+
+
+def rows(count):
+    for n in itertools.islice(itertools.count(), count):
+        yield {'to': 'to%d@example.com' % n, 'name': u'Ёлка %d' % n,
+               'code': n}
+
+
+def test_split_fields():
+    assert split_fields('{a}-{b}-{c}', ['a', 'c']) == ['', 'a', '-{b}-', 'c', '']
+    assert split_fields('no fields', ['a']) == ['no fields']
+
+
+def test_merged_email_is_the_same_as_email(email, template):
+    mail = template.render({'to': ('Alice', 'alice@example.com'),
+                            'name': u'Алиса', 'code': 42})
+
+    email.to = ('Alice', 'alice@example.com')
+    email.subject = u'Привет, Алиса'
+    email.text = u'Dear Алиса,\n.your code is 42\n'
+    assert mail.as_bytes() == email.as_bytes()
+    assert mail.to_wire() == email.to_wire()
+    assert sorted(mail.send_to) == sorted(map(text_type, email.send_to))
+
+
+def test_merged_email_is_encoded_for_7bit_server(email, template):
+    mail = template.render({'to': 'alice@example.com',
+                            'name': u'Алиса', 'code': 42})
+    email.to = 'alice@example.com'
+    email.subject = u'Привет, Алиса'
+    email.text = u'Dear Алиса,\n.your code is 42\n'
+    assert mail.as_bytes(eightbit=False) == email.as_bytes(eightbit=False)
+    assert mail.to_wire(eightbit=False) == email.to_wire(eightbit=False)
+
+    mail = template.render({'to': 'alice@example.com',
+                            'name': 'Alice', 'code': 42})
+    assert b'Content-Transfer-Encoding: 7bit\r\n' in \
+        mail.as_bytes(eightbit=False)
+
+
+def test_static_subject_is_encoded_once(template):
+    email = Email(u'Новости', 'Text', 'nobody@example.com',
+                  from_addr='me@example.com')
+    template = Template(email)
+    mail = template.render('alice@example.com')
+    email.to = 'alice@example.com'
+    assert mail.as_bytes() == email.as_bytes()
+    assert SUBJECT not in template.parts
+
+
+def test_field_values_could_not_inject_headers(template):
+    mail = template.render({'to': 'alice@example.com',
+                            'name': 'Alice\r\nBcc: eve@example.com',
+                            'code': 42})
+    headers = mail.as_bytes().split(b'\r\n\r\n')[0]
+    assert b'\r\nBcc:' not in headers
+
+
+def test_merge_skips_invalid_rows(request, template):
+    skipped = []
+
+    def record(sender, row, error):
+        skipped.append(row)
+
+    merge_row_skipped.connect(record)
+    request.addfinalizer(lambda: merge_row_skipped.disconnect(record))
+    messages = list(template.merge([
+        {'to': 'alice@example.com', 'name': 'Alice', 'code': 1},
+        {'to': 'bob', 'name': 'Bob', 'code': 2},
+        {'to': 'carol@example.com', 'name': 'Carol'},
+    ]))
+    assert [mail.to for mail in messages] == ['alice@example.com']
+    assert template.invalid == 2
+    assert [row['to'] for row in skipped] == ['bob', 'carol@example.com']
+
+
+def test_merge_consumes_rows_lazily(template):
+    messages = template.merge(rows(None))
+    first = list(itertools.islice(messages, 3))
+    assert [mail.to for mail in first] == ['to0@example.com',
+                                           'to1@example.com',
+                                           'to2@example.com']
+
+
+def test_send_merged_messages(request, template):
+    smtpd = SMTPServer(extensions=['8BITMIME']).start()
+    request.addfinalizer(smtpd.stop)
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port)
+
+    assert smtp.send_many(template.merge(rows(5))) == [None] * 5
+    assert smtpd.connections == 1
+    for n, (_, recipients, data) in enumerate(smtpd.messages):
+        assert recipients == ['<to%d@example.com>' % n,
+                              '<boss@example.com>']
+        assert (u'Dear Ёлка %d,\r\n.your code is %d' % (n, n)).encode(
+            'utf-8') in data
+
+
+def test_send_merged_messages_to_7bit_server(request, template):
+    smtpd = SMTPServer().start()
+    request.addfinalizer(smtpd.stop)
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port)
+
+    assert smtp.send_many(template.merge(rows(2))) == [None] * 2
+    for _, _, data in smtpd.messages:
+        assert b'Content-Transfer-Encoding: 8bit' not in data
+        assert data.decode('ascii')
+
+
+def test_template_requires_text(email):
+    email.text = None
+    with pytest.raises(ValueError):
+        Template(email)
+
+
+def test_template_does_not_support_attachments(email):
+    email.attach(io.BytesIO(b'data'), 'data.txt')
+    with pytest.raises(ValueError):
+        Template(email)
+
+
+def test_template_does_not_support_html(email):
+    email.html = '<p>Dear {name}</p>'
+    with pytest.raises(ValueError):
+        Template(email)
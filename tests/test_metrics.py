@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import pytest
+
+from flask_mailer import metrics
+from flask_mailer.backends.smtp import SMTPMailer
+from flask_mailer.metrics import Histogram
+from flask_mailer.metrics import Registry
+from flask_mailer.signals import message_built
+from flask_mailer.signals import smtp_stage
+from flask_mailer.signals import timed
+
+from .test_mail import mail
+
+
+@pytest.fixture
+def registry(request):
+    registry = Registry()
+    metrics.enable(registry)
+    request.addfinalizer(lambda: metrics.disable(registry))
+    return registry
+
+
+@pytest.fixture
+def stages(request):
+    stages = []
+
+    def record(sender, stage, duration, error):
+        stages.append((stage, error))
+
+    smtp_stage.connect(record)
+    request.addfinalizer(lambda: smtp_stage.disconnect(record))
+    return stages
+
+
+def test_timed_does_nothing_without_receivers():
+    with timed(smtp_stage, None, stage='connect'):
+        pass
+
+
+def test_timed_reports_errors(stages):
+    error = ValueError()
+    with pytest.raises(ValueError):
+        with timed(smtp_stage, None, stage='connect'):
+            raise error
+    assert stages == [('connect', error)]
+
+
+def test_send_reports_stages(smtpd, mail, stages):
+    SMTPMailer(port=smtpd.port).send(mail)
+    assert stages == [('connect', None), ('envelope', None), ('data', None)]
+
+
+def test_message_built_is_not_sent_for_cached_result(request, mail):
+    built = []
+
+    def record(sender, kind, duration, size):
+        built.append((kind, size))
+
+    message_built.connect(record)
+    request.addfinalizer(lambda: message_built.disconnect(record))
+
+    data = mail.to_wire()
+    mail.to_wire()
+    assert built == [('wire', len(data))]
+
+
+def test_histogram_buckets():
+    histogram = Histogram(buckets=(1, 2))
+    for value in (0.5, 1, 1.5, 3):
+        histogram.observe(value)
+    assert histogram.snapshot() == {'count': 4, 'sum': 6,
+                                    'buckets': {1: 2, 2: 1}}
+    assert list(histogram.samples('h', ())) == [
+        ('h_bucket', (('le', 1),), 2),
+        ('h_bucket', (('le', 2),), 3),
+        ('h_bucket', (('le', '+Inf'),), 4),
+        ('h_sum', (), 6),
+        ('h_count', (), 4),
+    ]
+
+
+def test_registry_collects_send_metrics(smtpd, mail, registry):
+    SMTPMailer(port=smtpd.port).send(mail)
+    snapshot = registry.snapshot()
+
+    assert snapshot['mailer_messages_sent_total'] == 1
+    assert snapshot['mailer_recipients_total'] == 4
+    assert snapshot['mailer_recipients_refused_total'] == 0
+    assert snapshot['mailer_bytes_sent_total'] == len(mail.to_wire())
+    assert snapshot['mailer_build_seconds{kind="wire"}']['count'] == 1
+    for stage in ('connect', 'envelope', 'data'):
+        key = 'mailer_smtp_stage_seconds{stage="%s"}' % stage
+        assert snapshot[key]['count'] == 1
+
+
+def test_registry_counts_errors(mail, registry):
+    with pytest.raises(RuntimeError):
+        SMTPMailer(port=1).send(mail)
+    assert registry.snapshot()['mailer_smtp_errors_total{stage="connect"}'] == 1
+
+
+def test_registry_render(registry):
+    registry.counter('sent_total').inc(3)
+    registry.histogram('stage_seconds', stage='data').observe(0.02)
+
+    lines = registry.render().splitlines()
+    assert '# TYPE sent_total counter' in lines
+    assert 'sent_total 3' in lines
+    assert '# TYPE stage_seconds histogram' in lines
+    assert 'stage_seconds_bucket{stage="data",le="0.025"} 1' in lines
+    assert 'stage_seconds_count{stage="data"} 1' in lines
+
+
+def test_disable_stops_collecting(smtpd, mail):
+    registry = Registry()
+    metrics.enable(registry)
+    metrics.disable(registry)
+    SMTPMailer(port=smtpd.port).send(mail)
+    assert registry.snapshot() == {}
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import pytest
+
+from flask_mailer import Mailer
+from flask_mailer import send_email
+from flask_mailer import outbox
+from flask_mailer.backends.dummy import DummyMailer
+from flask_mailer.signals import deferred_send_failed
+
+from .test_mail import mail
+
+
+class BatchMailer(DummyMailer):
+    """Dummy mailer which records batches and refuses some recipients."""
+
+    def __init__(self, **kwargs):
+        super(BatchMailer, self).__init__(**kwargs)
+        self.batches = []
+
+    def send_many(self, messages):
+        messages = list(messages)
+        self.batches.append(messages)
+        self.outbox.extend(messages)
+        return [ValueError('Refused') if 'bad@example.com' in message.to
+                else None for message in messages]
+
+
+@pytest.fixture
+def mailer(app):
+    app.config['MAILER_TESTING'] = False
+    app.config['MAILER_BACKEND'] = 'tests.test_outbox.BatchMailer'
+    return Mailer(app)
+
+
+@pytest.fixture
+def failures(request):
+    failures = []
+
+    def record(sender, message, error):
+        failures.append((message, error))
+
+    deferred_send_failed.connect(record)
+    request.addfinalizer(lambda: deferred_send_failed.disconnect(record))
+    return failures
+
+
+def test_deferred_mails_sent_after_response(app, mailer):
+    @app.route('/')
+    def view():
+        send_email('Subject', 'Text', 'one@example.com', defer=True)
+        send_email('Subject', 'Text', 'two@example.com', defer=True)
+        assert mailer.outbox == []
+        return 'OK'
+
+    response = app.test_client().get('/')
+    assert response.status_code == 200
+    response.close()
+    assert len(mailer.batches) == 1
+    assert len(mailer.outbox) == 2
+
+
+def test_defer_option_sets_default(app, mailer):
+    app.config['MAILER_DEFER'] = True
+
+    @app.route('/')
+    def view():
+        send_email('Subject', 'Text', 'one@example.com')
+        assert mailer.outbox == []
+        return 'OK'
+
+    app.test_client().get('/').close()
+    assert len(mailer.outbox) == 1
+
+
+def test_failures_are_reported_not_raised(app, mailer, failures):
+    @app.route('/')
+    def view():
+        send_email('Subject', 'Text', 'bad@example.com', defer=True)
+        send_email('Subject', 'Text', 'one@example.com', defer=True)
+        return 'OK'
+
+    response = app.test_client().get('/')
+    response.close()
+    assert response.status_code == 200
+    assert len(failures) == 1
+    message, error = failures[0]
+    assert 'bad@example.com' in message.to
+    assert isinstance(error, ValueError)
+
+
+def test_flush_reports_backend_error(mail, failures):
+    class BrokenMailer(DummyMailer):
+        def send_many(self, messages):
+            raise RuntimeError('Connection refused')
+
+    results = outbox.flush(BrokenMailer(), [mail, mail])
+    assert [type(x) for x in results] == [RuntimeError, RuntimeError]
+    assert len(failures) == 2
+
+
+def test_defer_outside_request_sends_immediately(app, mailer, mail):
+    with app.app_context():
+        outbox.defer(app.extensions['mailer'], mail)
+    assert mailer.outbox == [mail]
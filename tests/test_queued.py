@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+
+from flask_mailer import Mailer
+from flask_mailer import send_email
+from flask_mailer.backends.base import Mailer as BaseMailer
+from flask_mailer.backends.dummy import DummyMailer
+from flask_mailer.backends.queued import QueuedMailer
+
+from .test_mail import mail
+
+
+class BlockingMailer(DummyMailer):
+    """Dummy mailer which waits for the event before send."""
+
+    def __init__(self, **kwargs):
+        super(BlockingMailer, self).__init__(**kwargs)
+        self.event = threading.Event()
+        self.started = threading.Event()
+
+    def send(self, message):
+        self.started.set()
+        self.event.wait(5)
+        if message is None:
+            raise ValueError('Empty message')
+        super(BlockingMailer, self).send(message)
+        return 42
+
+
+@pytest.fixture
+def blocking():
+    return BlockingMailer()
+
+
+def test_submit_returns_future(blocking, mail):
+    mailer = QueuedMailer(blocking)
+    future = mailer.submit(mail)
+    assert not future.done()
+    blocking.event.set()
+    assert future.result(5) == 42
+    assert blocking.outbox == [mail,]
+
+
+def test_future_holds_send_error(blocking):
+    mailer = QueuedMailer(blocking)
+    blocking.event.set()
+    with pytest.raises(ValueError):
+        mailer.submit(None).result(5)
+
+
+def test_send_quiet_waits_and_swallows_errors(blocking, mail):
+    mailer = QueuedMailer(blocking)
+    blocking.event.set()
+    assert mailer.send_quiet(mail) == 42
+    assert blocking.outbox == [mail]
+    assert mailer.send_quiet(None) is None
+
+
+def test_send_many_waits_for_all_messages(blocking, mail):
+    mailer = QueuedMailer(blocking, queue_workers=2)
+    blocking.event.set()
+    results = mailer.send_many([mail, None, mail])
+    assert results[0] is None
+    assert isinstance(results[1], ValueError)
+    assert results[2] is None
+
+
+def test_raise_policy(blocking, mail):
+    mailer = QueuedMailer(blocking, queue_size=1, queue_workers=1,
+                          queue_policy='raise')
+    mailer.submit(mail)
+    blocking.started.wait(5)
+    mailer.submit(mail)
+    with pytest.raises(RuntimeError):
+        mailer.submit(mail)
+    assert mailer.send_quiet(mail) is None
+    blocking.event.set()
+
+
+def test_drop_policy(blocking, mail):
+    mailer = QueuedMailer(blocking, queue_size=1, queue_workers=1,
+                          queue_policy='drop')
+    mailer.submit(mail)
+    blocking.started.wait(5)
+    mailer.submit(mail)
+    dropped = mailer.submit(mail)
+    assert isinstance(dropped.exception(0), RuntimeError)
+    blocking.event.set()
+
+
+def test_invalid_policy(blocking):
+    with pytest.raises(ValueError):
+        QueuedMailer(blocking, queue_policy='wtf')
+
+
+def test_shutdown_drains_queue(blocking, mail):
+    mailer = QueuedMailer(blocking, queue_workers=1)
+    futures = [mailer.submit(mail) for _ in range(3)]
+    blocking.event.set()
+    mailer.shutdown()
+    assert all(future.done() for future in futures)
+    assert len(blocking.outbox) == 3
+    with pytest.raises(RuntimeError):
+        mailer.submit(mail)
+
+
+def test_submit_racing_shutdown_never_loses_messages(mail):
+    backend = DummyMailer()
+    for _ in range(20):
+        mailer = QueuedMailer(backend, queue_workers=2)
+        futures = []
+
+        def submit():
+            for _ in range(50):
+                try:
+                    futures.append(mailer.submit(mail))
+                except RuntimeError:
+                    break
+
+        threads = [threading.Thread(target=submit) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        mailer.shutdown()
+        for thread in threads:
+            thread.join()
+        assert all(future.done() for future in futures)
+
+
+def test_base_mailer_submit_sends_immediately(mail):
+    future = BaseMailer().submit(mail)
+    assert isinstance(future.exception(), NotImplementedError)
+
+
+def test_extension_wraps_backend_into_queue(app):
+    app.config['MAILER_QUEUE_WORKERS'] = 1
+    mailer = Mailer(app)
+    backend = app.extensions['mailer']
+    assert isinstance(backend, QueuedMailer)
+    assert isinstance(backend.backend, DummyMailer)
+
+    with app.test_request_context():
+        future = send_email('Subject', 'Text', 'to@example.com', wait=False)
+        future.result(5)
+        assert len(mailer.outbox) == 1
+        # Waits until the email is sent by default.
+        send_email('Subject', 'Text', 'to@example.com')
+        assert len(mailer.outbox) == 2
+    backend.shutdown()
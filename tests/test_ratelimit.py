@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+
+from flask_mailer import Email
+from flask_mailer import Mailer
+from flask_mailer.backends.dummy import DummyMailer
+from flask_mailer.backends.throttled import ThrottledMailer
+from flask_mailer.ratelimit import RateLimiter
+from flask_mailer.ratelimit import TokenBucket
+
+from .test_mail import mail
+
+
+class Clock(object):
+    """Fake clock which advances only when somebody sleeps."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def message(*recipients):
+    return Email('Subject', 'Text', list(recipients),
+                 from_addr='me@example.com')
+
+
+def test_bucket_allows_burst(clock):
+    bucket = TokenBucket(rate=2, burst=3, clock=clock)
+    assert [bucket.reserve() for _ in range(3)] == [0, 0, 0]
+
+
+def test_bucket_spaces_requests_over_budget(clock):
+    bucket = TokenBucket(rate=2, clock=clock)
+    assert [bucket.reserve() for _ in range(5)] == [0, 0, 0.5, 1, 1.5]
+
+
+def test_bucket_refills_over_time(clock):
+    bucket = TokenBucket(rate=2, clock=clock)
+    bucket.reserve(2)
+    clock.now += 0.5
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0.5
+
+
+def test_bucket_is_thread_safe():
+    bucket = TokenBucket(rate=1000, burst=1000)
+    threads = [threading.Thread(target=lambda: [bucket.reserve()
+                                                for _ in range(100)])
+               for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert bucket.tokens < 100
+
+
+def test_limiter_without_limits_does_not_wait(clock, mail):
+    limiter = RateLimiter(clock=clock, sleep=clock.sleep)
+    for _ in range(100):
+        limiter.wait(mail)
+    assert clock.slept == []
+
+
+def test_limiter_smooths_messages(clock, mail):
+    limiter = RateLimiter(rate=10, clock=clock, sleep=clock.sleep)
+    for _ in range(20):
+        limiter.wait(mail)
+    assert len(clock.slept) == 10
+    assert clock.now == pytest.approx(1.0)
+
+
+def test_limiter_counts_recipients_per_domain(clock):
+    limiter = RateLimiter(domain_rates={'Example.com': 2},
+                          clock=clock, sleep=clock.sleep)
+    assert limiter.reserve(message('a@example.com', 'b@EXAMPLE.com')) == 0
+    assert limiter.reserve(message('c@other.com')) == 0
+    assert limiter.reserve(message('Carol <c@example.com>')) == 0.5
+
+
+def test_limiter_default_domain_rate(clock):
+    limiter = RateLimiter(domain_rates={'*': 1, 'fast.com': 100},
+                          clock=clock, sleep=clock.sleep)
+    limiter.reserve(message('a@one.com', 'a@two.com', 'a@fast.com'))
+    assert limiter.reserve(message('b@one.com')) == 1
+    assert limiter.reserve(message('b@two.com')) == 1
+    assert limiter.reserve(message('b@fast.com')) == 0
+
+
+def test_limiter_drops_refilled_domain_buckets(clock):
+    limiter = RateLimiter(domain_rates={'*': 1}, clock=clock,
+                          sleep=clock.sleep)
+    limiter.max_domains = limiter.limit = 10
+    limiter.reserve(message(*['%d@busy.com' % n for n in range(1000)]))
+    for n in range(100):
+        clock.now += 1
+        limiter.reserve(message('a@domain%d.com' % n))
+    assert len(limiter.domains) <= 10
+    # The bucket in use is kept.
+    assert 'busy.com' in limiter.domains
+
+
+def test_throttled_send_many_waits_between_messages(clock, mail):
+    backend = DummyMailer()
+    throttled = ThrottledMailer(backend, rate_limit=1)
+    throttled.limiter = RateLimiter(1, clock=clock, sleep=clock.sleep)
+
+    assert throttled.send_many([mail] * 3) == [None] * 3
+    assert clock.slept == [1, 1]
+    assert len(backend.outbox) == 3
+
+
+def test_extension_wraps_backend_into_throttle(app, mail):
+    app.config['MAILER_RATE_LIMIT'] = 100
+    mailer = Mailer(app)
+    backend = app.extensions['mailer']
+    assert isinstance(backend, ThrottledMailer)
+    assert isinstance(backend.backend, DummyMailer)
+
+    with app.test_request_context():
+        mailer.send(mail)
+        assert mailer.outbox == [mail]
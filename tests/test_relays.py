@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import socket
+from smtplib import SMTPSenderRefused
+
+import pytest
+
+from flask_mailer import Email
+from flask_mailer import Mailer
+from flask_mailer.backends.base import Mailer as BaseMailer
+from flask_mailer.backends.dummy import DummyMailer
+from flask_mailer.backends.relays import RelayMailer
+from flask_mailer.backends.relays import parse_relay
+from flask_mailer.backends.smtp import SMTPMailer
+
+from .server import SMTPServer
+from .test_mail import mail
+
+
+class RelayBackend(DummyMailer):
+    """Dummy mailer which fails with connection error while it is down."""
+
+    def __init__(self, host, port, **kwargs):
+        super(RelayBackend, self).__init__(**kwargs)
+        self.host = host
+        self.down = False
+
+    def check(self):
+        return not self.down
+
+    def send(self, message):
+        if self.down:
+            raise socket.error('Connection refused')
+        super(RelayBackend, self).send(message)
+
+
+@pytest.fixture
+def relays():
+    return RelayMailer(RelayBackend, ['one:25:3', 'two:25'],
+                       breaker_threshold=2, breaker_timeout=60)
+
+
+def backends(mailer):
+    return [relay.backend for relay in mailer.relays]
+
+
+def test_parse_relay():
+    assert parse_relay('smtp.example.com') == ('smtp.example.com', 25, 1)
+    assert parse_relay(['smtp.example.com', 2525]) == \
+        ('smtp.example.com', 2525, 1)
+    with pytest.raises(ValueError):
+        parse_relay('smtp.example.com:25:0')
+
+
+def test_invalid_balance_strategy():
+    with pytest.raises(ValueError):
+        RelayMailer(RelayBackend, ['one'], balance='random')
+
+
+def test_round_robin_respects_weights(relays, mail):
+    for _ in range(8):
+        relays.send(mail)
+    one, two = backends(relays)
+    assert len(one.outbox) == 6
+    assert len(two.outbox) == 2
+
+
+def test_least_outstanding():
+    relays = RelayMailer(RelayBackend, ['one', 'two'],
+                         balance='least-outstanding')
+    relays.relays[0].outstanding = 2
+    assert relays.choose() is relays.relays[1]
+
+
+def test_latency_weighted():
+    relays = RelayMailer(RelayBackend, ['one', 'two'], balance='latency')
+    relays.relays[0].latency = 0.5
+    relays.relays[1].latency = 0.1
+    assert relays.choose() is relays.relays[1]
+
+
+def test_failover_and_ejection(relays, mail):
+    one, two = backends(relays)
+    one.down = True
+    for _ in range(4):
+        relays.send(mail)
+    assert len(two.outbox) == 4
+
+    stats = relays.stats()
+    assert stats[0]['state'] == 'open'
+    assert stats[0]['failed'] == 2
+    assert stats[1]['sent'] == 4
+
+
+def test_permanent_error_counted_as_failure(relays, mail):
+    relay = relays.relays[0]
+    relay.latency = 0.5
+    for _ in range(3):
+        relay.done(0, SMTPSenderRefused(550, 'Rejected', 'me@example.com'))
+
+    stats = relay.stats()
+    assert stats['state'] == 'closed'
+    assert stats['failed'] == 3
+    assert stats['sent'] == 0
+    assert stats['latency'] == 0.5
+
+
+def test_send_many_fails_over_undelivered_messages():
+    class Backend(RelayBackend):
+        """Loses the connection after the first message sent."""
+
+        def send(self, message):
+            if self.outbox and self.host == 'one':
+                raise socket.error('Connection reset')
+            super(Backend, self).send(message)
+
+        def send_many(self, messages):
+            return BaseMailer.send_many(self, messages)
+
+    relays = RelayMailer(Backend, ['one', 'two'], balance='least-outstanding')
+    relays.batch_size = 2
+    messages = [Email('Subject', 'Text', 'to%d@example.com' % n,
+                      from_addr='me@example.com') for n in range(3)]
+    assert relays.send_many(iter(messages)) == [None] * 3
+
+    one, two = backends(relays)
+    # Every message is delivered once.
+    assert one.outbox == messages[:1]
+    assert two.outbox == messages[1:]
+
+
+def test_ejected_relay_readmitted_after_health_check(relays, mail):
+    one, two = backends(relays)
+    one.down = True
+    relays.send(mail)
+    relays.send(mail)
+
+    breaker = relays.relays[0].breaker
+    breaker.timeout = 0
+    assert not relays.relays[0].available()
+    one.down = False
+    assert relays.relays[0].available()
+    assert breaker.state == 'closed'
+
+
+def test_raises_when_all_relays_fail(relays, mail):
+    for backend in backends(relays):
+        backend.down = True
+    with pytest.raises(socket.error):
+        relays.send(mail)
+    for relay in relays.relays:
+        relay.breaker.failure()
+    with pytest.raises(RuntimeError):
+        relays.send(mail)
+
+
+def test_smtp_relays(request, mail):
+    smtpd = SMTPServer().start()
+    request.addfinalizer(smtpd.stop)
+    dead = socket.socket()
+    dead.bind(('127.0.0.1', 0))
+    dead_port = dead.getsockname()[1]
+    dead.close()
+
+    relays = RelayMailer(SMTPMailer, [('127.0.0.1', dead_port),
+                                      ('127.0.0.1', smtpd.port)])
+    assert relays.send_many([mail, mail]) == [None, None]
+    relays.send(mail)
+    assert len(smtpd.messages) == 3
+
+
+def test_extension_creates_relays(app):
+    app.config['MAILER_TESTING'] = False
+    app.config['MAILER_HOSTS'] = ['one:25', 'two:2525:2']
+    Mailer(app)
+    backend = app.extensions['mailer']
+    assert isinstance(backend, RelayMailer)
+    assert [relay.name for relay in backend.relays] == ['one:25', 'two:2525']
+    assert isinstance(backend.relays[0].backend, SMTPMailer)
+
+
+def test_relays_use_default_port():
+    relays = RelayMailer(RelayBackend, ['one:2525', 'two'], port=587)
+    assert [relay.name for relay in relays.relays] == ['one:2525', 'two:587']
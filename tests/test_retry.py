@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import socket
+from smtplib import SMTPDataError
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPSenderRefused
+from smtplib import SMTPServerDisconnected
+
+import pytest
+
+from flask_mailer.backends.smtp import SMTPMailer
+from flask_mailer.retry import CircuitBreaker
+from flask_mailer.retry import backoff
+from flask_mailer.retry import is_transient
+from flask_mailer.signals import circuit_state_changed
+
+from .server import SMTPServer
+from .test_mail import mail
+
+
+@pytest.fixture
+def breaker():
+    return CircuitBreaker(threshold=2, timeout=60)
+
+
+@pytest.fixture
+def transitions(request, breaker):
+    transitions = []
+
+    def record(sender, old, new):
+        transitions.append((old, new))
+
+    circuit_state_changed.connect(record, sender=breaker)
+    request.addfinalizer(
+        lambda: circuit_state_changed.disconnect(record, sender=breaker))
+    return transitions
+
+
+def test_transient_errors():
+    assert is_transient(socket.error())
+    assert is_transient(SMTPServerDisconnected())
+    assert is_transient(SMTPDataError(451, 'Try again later'))
+    assert is_transient(SMTPRecipientsRefused({'a': (450, 'Busy')}))
+
+
+def test_permanent_errors():
+    assert not is_transient(ValueError())
+    assert not is_transient(SMTPDataError(554, 'Rejected'))
+    assert not is_transient(SMTPRecipientsRefused({'a': (450, 'Busy'),
+                                                  'b': (550, 'No user')}))
+
+
+def test_transient_error_reason():
+    error = RuntimeError('Connection refused')
+    error.reason = socket.error()
+    assert is_transient(error)
+    assert not is_transient(RuntimeError('Circuit breaker is open'))
+
+
+def test_backoff_is_capped():
+    for attempt in range(10):
+        assert 0 <= backoff(attempt, base=0.5, cap=2) <= min(2, 0.5 * 2 ** attempt)
+
+
+def test_breaker_opens_after_threshold(breaker, transitions):
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert transitions == [('closed', 'open')]
+
+
+def test_breaker_success_resets_failures(breaker):
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_probes_half_open(breaker, transitions):
+    breaker.timeout = 0
+    breaker.failure()
+    breaker.failure()
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert transitions == [('closed', 'open'), ('open', 'half-open'),
+                           ('half-open', 'open'), ('open', 'half-open'),
+                           ('half-open', 'closed')]
+
+
+def test_smtp_retries_transient_errors(request, mail):
+    smtpd = SMTPServer(failures=2).start()
+    request.addfinalizer(smtpd.stop)
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port,
+                      retries=2, retry_backoff=0)
+    smtp.send(mail)
+    assert len(smtpd.messages) == 1
+    assert smtpd.connections == 3
+
+
+def test_smtp_gives_up_after_retries(request, mail):
+    smtpd = SMTPServer(failures=2).start()
+    request.addfinalizer(smtpd.stop)
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port,
+                      retries=1, retry_backoff=0)
+    with pytest.raises(SMTPSenderRefused):
+        smtp.send(mail)
+
+
+def test_smtp_does_not_retry_permanent_errors(request, mail):
+    smtpd = SMTPServer(refuse=['one@example.com', 'two@example.com',
+                               'cc@example.com', 'bcc@example.com']).start()
+    request.addfinalizer(smtpd.stop)
+    smtp = SMTPMailer(host=smtpd.host, port=smtpd.port,
+                      retries=2, retry_backoff=0)
+    with pytest.raises(SMTPRecipientsRefused):
+        smtp.send(mail)
+    assert smtpd.connections == 1
+
+
+def test_smtp_breaker_fails_fast(mail):
+    smtp = SMTPMailer(host='127.0.0.1', port=1, breaker_threshold=2)
+    for _ in range(2):
+        with pytest.raises(RuntimeError) as exc:
+            smtp.send(mail)
+        assert exc.value.reason is not None
+    with pytest.raises(RuntimeError) as exc:
+        smtp.send(mail)
+    assert 'Circuit breaker is open' in str(exc.value)
+    assert smtp.breaker.state == CircuitBreaker.OPEN
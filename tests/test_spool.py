@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+
+from flask_mailer import Email
+from flask_mailer.backends.smtp import SMTPMailer
+from flask_mailer.backends.spool import SpoolMailer
+from flask_mailer.backends.spool import SpoolDrainer
+from flask_mailer.backends.spool import open_spool
+
+from .server import SMTPServer
+from .test_mail import mail
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('mailer.spool'))
+
+
+@pytest.fixture
+def spool(path):
+    return SpoolMailer(spool_path=path, default_sender='me@example.com')
+
+
+def count(path):
+    return open_spool(path).execute(
+        'SELECT COUNT(*) FROM spool').fetchone()[0]
+
+
+def test_send_appends_message_to_spool(spool, path, mail):
+    spool.send(mail)
+    spool.send_many([mail, mail])
+    assert count(path) == 3
+
+
+def test_concurrent_sends_are_committed(spool, path, mail):
+    threads = [threading.Thread(target=spool.send, args=(mail,))
+               for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert spool.committed == spool.written == 10
+    assert count(path) == 10
+
+
+def test_drainer_delivers_spooled_messages(spool, path, smtpd, mail):
+    spool.send(mail)
+    message = Email('Subject', u'Привет', 'to@example.com')
+    spool.send(message)
+    backend = SMTPMailer(host=smtpd.host, port=smtpd.port)
+    drainer = SpoolDrainer(path, backend)
+
+    assert drainer.drain() == 2
+    assert count(path) == 0
+    assert smtpd.connections == 1
+    sender, recipients, data = smtpd.messages[1]
+    assert sender == '<me@example.com>'
+    assert recipients == ['<to@example.com>']
+    # The server does not support 8BITMIME, the text is encoded.
+    assert data.rstrip(b'\r\n') == \
+        message.as_bytes(eightbit=False).rstrip(b'\r\n')
+    assert b'Content-Transfer-Encoding: base64' in data
+
+
+def test_drainer_retries_failed_messages(spool, path, mail):
+    spool.send(mail)
+    drainer = SpoolDrainer(path, SMTPMailer(host='127.0.0.1', port=1))
+
+    assert drainer.drain() == 0
+    assert count(path) == 1
+    assert drainer.pending() == []
+
+    message, = drainer.pending(now=float('inf'))
+    assert message.attempts == 1
+
+
+def test_drainer_retries_only_refused_recipients(request, spool, path):
+    smtpd = SMTPServer(refuse=['bad@example.com']).start()
+    request.addfinalizer(smtpd.stop)
+    spool.send(Email('Subject', 'Text', ['bad@example.com', 'to@example.com']))
+    drainer = SpoolDrainer(path, SMTPMailer(host=smtpd.host, port=smtpd.port))
+
+    assert drainer.drain() == 0
+    assert len(smtpd.messages) == 1
+    message, = drainer.pending(now=float('inf'))
+    assert message.send_to == ['bad@example.com']